@@ -32,6 +32,9 @@ def clean():
 def make(env='.env'):
     local('source %s/bin/activate && python setup.py build_ext --inplace' % env)
 
+def make_profile(env='.env'):
+    local('source %s/bin/activate && python setup.py build_ext --inplace --force --profile' % env)
+
 def test():
     local('py.test')
 
@@ -1,12 +1,49 @@
 from libc.stdint cimport uint64_t, int64_t
+from cymem.cymem cimport Pool
+from preshed.maps cimport PreshMap
+
+
+# The binary index format is a header, then a StringRef for each code from 0
+# to n_codes - 1, then the strings. See Index.save.
+cdef struct IndexHeader:
+    char magic[8]
+    uint64_t version
+    uint64_t n_codes
+    uint64_t chars_size
+
+
+cdef struct StringRef:
+    uint64_t start
+    int64_t length # -1 if the code has no string
 
 
 cdef class Index:
-    cdef size_t i
-    cdef dict table
-    cdef dict reverse
-    
-    cpdef size_t lookup(self, bytes entry)
+    cdef Pool mem
+    cdef PreshMap table # Hash of the string to its code
+    cdef size_t i # The highest code
+    cdef StringRef* refs
+    cdef size_t n_refs
+    cdef char* chars
+    cdef size_t chars_size
+    cdef size_t chars_used
+    cdef dict loaded # Code to string, for the codes load has set
+
+    cpdef size_t lookup(self, bytes entry) except 0
     cpdef bytes get_str(self, size_t code)
     cpdef save(self, path)
     cpdef load(self, path)
+
+    cdef size_t encode(self, const char* chars, int length) nogil
+    cdef const char* decode(self, size_t code, int* length) nogil
+    cdef int alias(self, const char* chars, int length, size_t code) except -1
+
+    cdef int _set(self, size_t code, const char* chars, int length) except -1
+
+
+cdef Index get_pos_idx()
+cdef Index get_label_idx()
+
+cpdef size_t encode_pos(bytes pos) except 0
+cpdef bytes decode_pos(size_t i)
+cpdef size_t encode_label(bytes label) except 0
+cpdef bytes decode_label(size_t i)
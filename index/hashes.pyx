@@ -1,106 +1,253 @@
-# cython: profile=True
-
-from libc.stdint cimport uint64_t
+"""
+Encode strings, such as POS tags and dependency labels, as small integer
+codes, and decode them back.
+
+An Index keeps its strings end to end in one buffer, with an array giving
+each code's string, and a hash table from the strings' hashes to their
+codes. So encode and decode are O(1), and can be called without the GIL.
+Adding a string needs the GIL, and goes through lookup.
+"""
+from libc.stdint cimport uint64_t, int64_t
 from libc.string cimport memcpy
 from cymem.cymem cimport Pool
+from murmurhash.mrmr cimport hash64
+from preshed.maps cimport PreshMap
 
 import os.path
 
 
+DEF MAGIC = b'RSIDX\0\0\0'
+DEF FORMAT_VERSION = 1
+
+
 cdef class Index:
     def __init__(self, entries):
+        self.mem = Pool()
+        self.table = PreshMap()
         self.i = 0
-        self.table = {}
-        self.reverse = {}
+        self.n_refs = 0
+        self.chars_size = 0
+        self.chars_used = 0
+        self.loaded = {}
+        _reserve_refs(self, 16)
+        _reserve_chars(self, 256)
         for entry in entries:
             self.lookup(entry)
 
-    cpdef size_t lookup(self, bytes entry):
-        if entry in self.table:
-            return self.table[entry]
-        else:
-            self.i += 1
-            self.table[entry] = self.i
-            self.reverse[self.i] = entry
-            return self.i
+    cpdef size_t lookup(self, bytes entry) except 0:
+        '''Get the entry's code, giving it the next one if it's new.'''
+        if entry is None:
+            raise TypeError("Can't index None")
+        cdef size_t code = self.encode(<char*>entry, len(entry))
+        if code == 0:
+            code = self.i + 1
+            self._set(code, <char*>entry, len(entry))
+        return code
 
     cpdef bytes get_str(self, size_t code):
-        return self.reverse.get(code, 'UNK')
+        cdef int length
+        cdef const char* chars = self.decode(code, &length)
+        if chars == NULL:
+            return b'UNK'
+        return chars[:length]
+
+    cdef size_t encode(self, const char* chars, int length) nogil:
+        '''The code of the string, or 0 if it's not in the index.'''
+        return <size_t>self.table.get(hash64(<void*>chars, length, 0))
+
+    cdef const char* decode(self, size_t code, int* length) nogil:
+        '''The code's string, with its length in length, or NULL if the code
+        has no string. The string isn't null-terminated, and only lasts until
+        the next string is added.'''
+        if code > self.i or self.refs[code].length < 0:
+            return NULL
+        length[0] = self.refs[code].length
+        return &self.chars[self.refs[code].start]
+
+    cdef int alias(self, const char* chars, int length, size_t code) except -1:
+        '''Have the string encode to an existing code, without a code of its
+        own. Aliases aren't saved.'''
+        self.table.set(hash64(<void*>chars, length, 0), <void*>code)
 
     cpdef save(self, path):
-        with open(path, 'w') as out_file:
-            entries = self.reverse.items()
-            entries.sort()
-            for i, entry in entries:
-                out_file.write('%d\t%s\n' % (i, entry))
+        cdef IndexHeader header
+        memcpy(header.magic, <char*>MAGIC, 8)
+        header.version = FORMAT_VERSION
+        header.n_codes = self.i + 1
+        header.chars_size = self.chars_used
+        with open(path, 'wb') as out_file:
+            out_file.write((<char*>&header)[:sizeof(IndexHeader)])
+            out_file.write((<char*>self.refs)[:header.n_codes * sizeof(StringRef)])
+            out_file.write(self.chars[:self.chars_used])
 
     cpdef load(self, path):
-        for line in open(path):
-            if not line.strip():
-                continue
-            i, entry = line.split()
-            i = int(i)
-            self.table[entry] = i
-            self.reverse[i] = entry
-        self.i = i + 1
+        '''Add the codes saved in the file at path, in the binary format of
+        save, or the text format older versions wrote. A code that's already
+        in use gets the file's string, unless an earlier load gave it another
+        string, or gave the string another code. Then the files come from
+        models with different codes, which can't share the index, so
+        ValueError is raised and the index is left as it was.'''
+        with open(path, 'rb') as file_:
+            data = file_.read()
+        if data[:8] == MAGIC:
+            entries = _read_bin(path, data)
+        else:
+            entries = _read_text(data)
+        cdef size_t code, prev
+        cdef bytes entry
+        for code, entry in entries:
+            prev = self.encode(<char*>entry, len(entry))
+            if self.loaded.get(code, entry) != entry:
+                raise ValueError("Index %s gives code %d to %s, but a loaded index gave it to %s" %
+                                 (path, code, entry, self.loaded[code]))
+            if prev != code and self.loaded.get(prev) == entry:
+                raise ValueError("Index %s gives %s code %d, but a loaded index gave it %d" %
+                                 (path, entry, code, prev))
+        for code, entry in entries:
+            if self.loaded.get(code) != entry:
+                self._set(code, <char*>entry, len(entry))
+                self.loaded[code] = entry
+
+    cdef int _set(self, size_t code, const char* chars, int length) except -1:
+        _reserve_refs(self, code + 1)
+        _reserve_chars(self, self.chars_used + length)
+        memcpy(&self.chars[self.chars_used], chars, length)
+        self.refs[code].start = self.chars_used
+        self.refs[code].length = length
+        self.chars_used += length
+        self.table.set(hash64(<void*>chars, length, 0), <void*>code)
+        if code > self.i:
+            self.i = code
+
+
+def _read_bin(path, bytes data):
+    '''The (code, string) pairs in the binary format of Index.save.'''
+    cdef char* chars = <char*>data
+    if len(data) < sizeof(IndexHeader):
+        raise ValueError("Index %s is truncated or corrupt" % path)
+    cdef IndexHeader* header = <IndexHeader*>chars
+    if header.version != FORMAT_VERSION:
+        raise ValueError("Index %s has version %d, expected %d" %
+                         (path, header.version, FORMAT_VERSION))
+    if len(data) != (sizeof(IndexHeader) + header.n_codes * sizeof(StringRef)
+                     + header.chars_size):
+        raise ValueError("Index %s is truncated or corrupt" % path)
+    cdef StringRef* refs = <StringRef*>(header + 1)
+    cdef char* strings = <char*>(refs + header.n_codes)
+    cdef size_t code
+    entries = []
+    for code in range(header.n_codes):
+        if refs[code].length >= 0:
+            if refs[code].start + refs[code].length > header.chars_size:
+                raise ValueError("Index %s is truncated or corrupt" % path)
+            entries.append((code, strings[refs[code].start :
+                                          refs[code].start + refs[code].length]))
+    return entries
+
+
+def _read_text(bytes data):
+    '''The (code, string) pairs in the text format older versions wrote.'''
+    entries = []
+    for line in data.split(b'\n'):
+        if not line.strip():
+            continue
+        code, entry = line.split()
+        entries.append((int(code), entry))
+    return entries
+
+
+cdef int _reserve_refs(Index idx, size_t n) except -1:
+    if n <= idx.n_refs:
+        return 0
+    cdef size_t size = max(n, idx.n_refs * 2)
+    if idx.n_refs == 0:
+        idx.refs = <StringRef*>idx.mem.alloc(size, sizeof(StringRef))
+    else:
+        idx.refs = <StringRef*>idx.mem.realloc(idx.refs, size * sizeof(StringRef))
+    cdef size_t code
+    for code in range(idx.n_refs, size):
+        idx.refs[code].start = 0
+        idx.refs[code].length = -1
+    idx.n_refs = size
+
+
+cdef int _reserve_chars(Index idx, size_t n) except -1:
+    if n <= idx.chars_size:
+        return 0
+    cdef size_t size = max(n, idx.chars_size * 2)
+    if idx.chars_size == 0:
+        idx.chars = <char*>idx.mem.alloc(size, sizeof(char))
+    else:
+        idx.chars = <char*>idx.mem.realloc(idx.chars, size)
+    idx.chars_size = size
+
 
+cdef Index _pos_idx = Index(['ROOT', 'NONE', 'OOB', 'UNK'])
+cdef Index _label_idx = Index(['ERR', 'ROOT', 'P', 'erased'])
 
-_pos_idx = Index(['ROOT', 'NONE', 'OOB', 'UNK'])
-_label_idx = Index(['ERR', 'ROOT', 'P', 'erased'])
+
+cdef Index get_pos_idx():
+    return _pos_idx
+
+
+cdef Index get_label_idx():
+    return _label_idx
 
 
 def load_pos_idx(path):
-    global _pos_idx
     _pos_idx.load(path)
 
 
 def load_label_idx(path):
-    global _label_idx
     print "Load labels", path
     _label_idx.load(path)
 
 
 def save_pos_idx(path):
-    global _pos_idx
     _pos_idx.save(path)
 
 def save_label_idx(path):
-    global _label_idx
     _label_idx.save(path)
 
 
-cpdef encode_pos(object pos):
-    global _pos_idx
-    cdef Index idx = _pos_idx
-    return idx.lookup(pos)
+cpdef size_t encode_pos(bytes pos) except 0:
+    return _pos_idx.lookup(pos)
 
 
-def decode_pos(size_t i):
-    global _pos_idx
+cpdef bytes decode_pos(size_t i):
     return _pos_idx.get_str(i)
 
 def get_nr_pos():
-    global _pos_idx
-    cdef Index idx = _pos_idx
-    return idx.i + 1
-
-def encode_label(object label):
-    global _label_idx
-    cdef Index idx = _label_idx
-    if label.upper() == 'ROOT':
-        label = 'ROOT'
-    elif label.upper() == 'PUNCT':
-        label = 'P'
-    return idx.lookup(label)
-
-
-def decode_label(size_t i):
-    global _label_idx
+    return _pos_idx.i + 1
+
+cpdef size_t encode_label(bytes label) except 0:
+    if label is None:
+        raise TypeError("Can't index None")
+    # Labels are stored once they're normalised, and other spellings of them
+    # are aliased, so a label that's found doesn't need normalising
+    cdef size_t code = _label_idx.encode(<char*>label, len(label))
+    if code != 0:
+        return code
+    upper = label.upper()
+    if upper == b'ROOT':
+        code = _label_idx.lookup(b'ROOT')
+    elif upper == b'PUNCT':
+        code = _label_idx.lookup(b'P')
+    else:
+        return _label_idx.lookup(label)
+    _label_idx.alias(<char*>label, len(label), code)
+    return code
+
+
+def get_nr_labels():
+    return _label_idx.i + 1
+
+
+cpdef bytes decode_label(size_t i):
     return _label_idx.get_str(i)
 
 def is_root_label(label):
-    global _label_idx
     if type(label) == str:
-        return encode_label(label) == encode_label('ROOT')
+        return encode_label(label) == encode_label(b'ROOT')
     else:
-        return label == encode_label('ROOT')
+        return label == encode_label(b'ROOT')
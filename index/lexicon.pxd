@@ -7,6 +7,15 @@ cpdef size_t lookup(bytes word)
 
 cpdef bytes get_str(size_t word)
 
+# Unknown words get a Lexeme from mem, cached in oovs, unless
+# set_intern_oov(True) has been called. oovs maps each word to its Lexeme's
+# address, and the address back to the word.
+cdef Lexeme* lookup_in(bytes word, Pool mem, dict oovs) except NULL
+
+# As lookup_in, but only makes a bytes object for the word if it's unknown.
+cdef Lexeme* lookup_chars(const char* chars, int length, Pool mem,
+                          dict oovs) except NULL
+
 cdef struct Lexeme:
     size_t orig
     size_t norm
@@ -20,8 +29,35 @@ cdef struct Lexeme:
 
 cdef Lexeme BLANK_WORD
 
+# The binary lexicon format is a header, then the Lexeme array, then an
+# open-addressed hash index over it, then the word strings. See Lexicon.build.
+cdef struct BinHeader:
+    char magic[8]
+    uint64_t lexeme_size
+    uint64_t n_words
+    uint64_t n_buckets
+    uint64_t strings_size
+
+
+cdef struct BinBucket:
+    uint64_t key
+    uint64_t word # Index into the Lexeme array, plus 1; 0 means empty
+
+
 cdef class Lexicon:
     cdef Pool mem
     cdef PreshMap words
     cdef dict strings
+
+    cdef void* _map
+    cdef size_t _map_size
+    cdef Lexeme* _lexemes
+    cdef uint64_t _n_lexemes
+    cdef BinBucket* _buckets
+    cdef uint64_t _n_buckets
+    cdef uint64_t* _str_offsets
+    cdef char* _str_data
+
     cdef size_t lookup(self, bytes word)
+    cdef Lexeme* _find_mapped(self, uint64_t key)
+    cdef Lexeme* _get(self, uint64_t key)
@@ -1,13 +1,21 @@
 from cymem.cymem cimport Pool
 from libc.stdint cimport uint64_t
+from libc.string cimport memcpy, memcmp
 from murmurhash.mrmr cimport hash64
+from posix.mman cimport mmap, munmap, PROT_READ, MAP_SHARED, MAP_FAILED
+from posix.fcntl cimport open as c_open, O_RDONLY
+from posix.unistd cimport close as c_close
+from posix.stat cimport struct_stat, fstat
 
 import os.path
 
 
 BLANK_WORD = Lexeme(0, 0, 0, 0, False, False, False)
 
+DEF MAGIC = b'RSLEX01\0'
+
 cdef Lexicon _LEXICON = None
+cdef bint INTERN_OOV = False
 
 def load(): # Called in index/__init__.py
     global _LEXICON
@@ -24,7 +32,47 @@ cpdef bytes get_str(size_t word):
     global _LEXICON
     if _LEXICON is None:
         _LEXICON = Lexicon()
-    return _LEXICON.strings.get(word, '')
+    return _LEXICON.get_str(word)
+
+def set_intern_oov(val):
+    '''Have lookup_in add unknown words to the lexicon, as lookup does. This
+    is the old behaviour. By default each sentence gets its own Lexemes for
+    the words the lexicon doesn't know, so a process that parses forever
+    doesn't keep every word it has ever seen. The Lexemes are the same
+    either way, so models train the same whichever is set.'''
+    global INTERN_OOV
+    INTERN_OOV = val
+
+
+cdef Lexeme* lookup_in(bytes word, Pool mem, dict oovs) except NULL:
+    global _LEXICON
+    if _LEXICON is None:
+        _LEXICON = Lexicon()
+    cdef Lexeme* w = _LEXICON._get(_hash_str(word))
+    if w != NULL:
+        return w
+    if INTERN_OOV:
+        return <Lexeme*>_LEXICON.lookup(word)
+    # Features compare Lexeme addresses, so repeats of an unknown word must
+    # share one within a sentence.
+    if word in oovs:
+        return <Lexeme*><size_t>oovs[word]
+    w = init_word(mem, word, 0, 0.0, 0.0, 0)
+    oovs[word] = <size_t>w
+    oovs[<size_t>w] = word
+    return w
+
+
+cdef Lexeme* lookup_chars(const char* chars, int length, Pool mem,
+                          dict oovs) except NULL:
+    global _LEXICON
+    if _LEXICON is None:
+        _LEXICON = Lexicon()
+    cdef Lexeme* w = _LEXICON._get(hash64(<char*>chars, length, 0))
+    if w != NULL:
+        return w
+    return lookup_in(chars[:length], mem, oovs)
+
 
 def lexicon_size():
     global _LEXICON
@@ -33,43 +81,191 @@ def lexicon_size():
     return _LEXICON.mem.size
 
 
+def default_loc():
+    '''The compiled lexicon if it has been built, else the cluster file.'''
+    bin_loc = os.path.join(os.path.dirname(__file__), 'lexicon.bin')
+    if os.path.exists(bin_loc):
+        return bin_loc
+    return os.path.join(os.path.dirname(__file__), 'bllip-clusters')
+
+
+def build(out_loc, clusters_loc=None, case_loc=None):
+    '''Compile the cluster and case files into the binary format that Lexicon
+    memory-maps, and return the number of words. The file holds Lexeme structs
+    as they're laid out in memory, so it's specific to the platform that built
+    it.
+
+    Args:
+        out_loc (str): Where to write the compiled lexicon.
+        clusters_loc (str): The Brown cluster file. Defaults to index/bllip-clusters.
+        case_loc (str): The case statistics file. Defaults to index/english.case.
+    '''
+    cdef Pool mem = Pool()
+    cdef Lexeme* w
+    # Later entries replace earlier ones, as when loading the text files
+    by_key = {}
+    for word, cluster, upper_pc, title_pc, freq in _read_vocab(clusters_loc, case_loc):
+        by_key[_hash_str(word)] = (word, cluster, upper_pc, title_pc, freq)
+    cdef uint64_t n_words = len(by_key)
+    cdef uint64_t n_buckets = 1
+    while n_buckets < n_words * 2:
+        n_buckets *= 2
+    cdef Lexeme* lexemes = <Lexeme*>mem.alloc(n_words, sizeof(Lexeme))
+    cdef BinBucket* buckets = <BinBucket*>mem.alloc(n_buckets, sizeof(BinBucket))
+    cdef uint64_t* str_offsets = <uint64_t*>mem.alloc(n_words + 1, sizeof(uint64_t))
+    cdef uint64_t i, key, bucket
+    strings = []
+    for i, key in enumerate(sorted(by_key)):
+        word, cluster, upper_pc, title_pc, freq = by_key[key]
+        w = init_word(mem, word, cluster, upper_pc, title_pc, freq)
+        lexemes[i] = w[0]
+        bucket = key & (n_buckets - 1)
+        while buckets[bucket].word != 0:
+            bucket = (bucket + 1) & (n_buckets - 1)
+        buckets[bucket].key = key
+        buckets[bucket].word = i + 1
+        strings.append(word)
+        str_offsets[i + 1] = str_offsets[i] + len(word)
+    cdef BinHeader header
+    memcpy(header.magic, <char*>MAGIC, 8)
+    header.lexeme_size = sizeof(Lexeme)
+    header.n_words = n_words
+    header.n_buckets = n_buckets
+    header.strings_size = str_offsets[n_words]
+    with open(out_loc, 'wb') as file_:
+        file_.write((<char*>&header)[:sizeof(BinHeader)])
+        file_.write((<char*>lexemes)[:n_words * sizeof(Lexeme)])
+        file_.write((<char*>buckets)[:n_buckets * sizeof(BinBucket)])
+        file_.write((<char*>str_offsets)[:(n_words + 1) * sizeof(uint64_t)])
+        file_.write(b''.join(strings))
+    return n_words
+
+
+def _read_vocab(clusters_loc=None, case_loc=None):
+    if clusters_loc is None:
+        clusters_loc = os.path.join(os.path.dirname(__file__), 'bllip-clusters')
+    if case_loc is None:
+        case_loc = os.path.join(os.path.dirname(__file__), 'english.case')
+    case_stats = {}
+    for line in open(case_loc):
+        word, upper, title = line.split()
+        case_stats[word] = (float(upper), float(title))
+    for line in open(clusters_loc):
+        cluster_str, word, freq_str = line.split()
+        # Decode as a little-endian string, so that we can do & 15 to get
+        # the first 4 bits. See _parse_features.pyx
+        cluster = int(cluster_str[::-1], 2)
+        #upper_pc = float(pieces[1])
+        #title_pc = float(pieces[2])
+        upper_pc, title_pc = case_stats.get(word.lower(), (0.0, 0.0))
+        yield word, cluster, upper_pc, title_pc, int(freq_str)
+
+
 cdef class Lexicon:
-    def __cinit__(self, loc=None):
+    def __cinit__(self, loc=None, case_loc=None):
         self.mem = Pool()
         self.words = PreshMap()
         self.strings = {}
-        cdef object line
-        cdef size_t i, word_id, freq
-        cdef float upper_pc, title_pc
         if loc is None:
-            loc = os.path.join(os.path.dirname(__file__), 'bllip-clusters')
-        case_stats = {}
-        for line in open(os.path.join(os.path.dirname(__file__), 'english.case')):
-            word, upper, title = line.split()
-            case_stats[word] = (float(upper), float(title))
+            loc = default_loc()
         print "Loading vocab from ", loc 
+        if loc.endswith('.bin'):
+            self._load_bin(loc)
+            return
         cdef Lexeme* w
-        for line in open(loc):
-            cluster_str, word, freq_str = line.split()
-            # Decode as a little-endian string, so that we can do & 15 to get
-            # the first 4 bits. See _parse_features.pyx
-            cluster = int(cluster_str[::-1], 2)
-            #upper_pc = float(pieces[1])
-            #title_pc = float(pieces[2])
-            upper_pc, title_pc = case_stats.get(word.lower(), (0.0, 0.0))
-            w = init_word(self.mem, word, cluster, upper_pc, title_pc, int(freq_str))
+        for word, cluster, upper_pc, title_pc, freq in _read_vocab(loc, case_loc):
+            w = init_word(self.mem, word, cluster, upper_pc, title_pc, freq)
             self.words.set(_hash_str(word), w)
             self.strings[<size_t>w] = word
 
+    def __dealloc__(self):
+        if self._map != NULL:
+            munmap(self._map, self._map_size)
+
+    def _load_bin(self, loc):
+        # The map is read-only and shared, so processes that load the same
+        # file share its pages.
+        cdef struct_stat st
+        if isinstance(loc, unicode):
+            loc = loc.encode('utf8')
+        cdef int fd = c_open(loc, O_RDONLY)
+        if fd == -1:
+            raise IOError("Could not open lexicon %s" % loc)
+        if fstat(fd, &st) != 0:
+            c_close(fd)
+            raise IOError("Could not stat lexicon %s" % loc)
+        if <size_t>st.st_size < sizeof(BinHeader):
+            c_close(fd)
+            raise ValueError("Not a compiled lexicon: %s" % loc)
+        cdef void* data = mmap(NULL, st.st_size, PROT_READ, MAP_SHARED, fd, 0)
+        c_close(fd)
+        if data == MAP_FAILED:
+            raise IOError("Could not map lexicon %s" % loc)
+        self._map = data
+        self._map_size = st.st_size
+        cdef BinHeader* header = <BinHeader*>data
+        if memcmp(header.magic, <char*>MAGIC, 8) != 0:
+            raise ValueError("Not a compiled lexicon: %s" % loc)
+        if header.lexeme_size != sizeof(Lexeme):
+            raise ValueError("Lexicon %s was built on an incompatible platform. "
+                             "Rebuild it with scripts/build_lexicon.py" % loc)
+        cdef size_t expected = (sizeof(BinHeader)
+                                + header.n_words * sizeof(Lexeme)
+                                + header.n_buckets * sizeof(BinBucket)
+                                + (header.n_words + 1) * sizeof(uint64_t)
+                                + header.strings_size)
+        if expected != self._map_size:
+            raise ValueError("Lexicon %s is truncated or corrupt" % loc)
+        self._n_lexemes = header.n_words
+        self._n_buckets = header.n_buckets
+        self._lexemes = <Lexeme*>(header + 1)
+        self._buckets = <BinBucket*>(self._lexemes + self._n_lexemes)
+        self._str_offsets = <uint64_t*>(self._buckets + self._n_buckets)
+        self._str_data = <char*>(self._str_offsets + self._n_lexemes + 1)
+
+    cdef Lexeme* _find_mapped(self, uint64_t key):
+        if self._n_buckets == 0:
+            return NULL
+        cdef uint64_t bucket = key & (self._n_buckets - 1)
+        while self._buckets[bucket].word != 0:
+            if self._buckets[bucket].key == key:
+                return &self._lexemes[self._buckets[bucket].word - 1]
+            bucket = (bucket + 1) & (self._n_buckets - 1)
+        return NULL
+
     cdef size_t lookup(self, bytes word):
         cdef uint64_t hashed = _hash_str(word)
-        cdef Lexeme* w = <Lexeme*>self.words.get(hashed)
+        cdef Lexeme* w = self._get(hashed)
         if w == NULL:
             w = init_word(self.mem, word, 0, 0.0, 0.0, 0)
             self.words.set(hashed, w)
             self.strings[<size_t>w] = word
         return <size_t>w
 
+    def __contains__(self, bytes word):
+        return self._get(_hash_str(word)) != NULL
+
+    def __getitem__(self, bytes word):
+        '''Get a word's Lexeme as a dict, without adding the word if it's unknown.'''
+        cdef Lexeme* w = self._get(_hash_str(word))
+        if w == NULL:
+            raise KeyError(word)
+        return w[0]
+
+    cdef Lexeme* _get(self, uint64_t key):
+        cdef Lexeme* w = self._find_mapped(key)
+        if w == NULL:
+            w = <Lexeme*>self.words.get(key)
+        return w
+
+    def get_str(self, size_t word):
+        cdef size_t i
+        cdef size_t start = <size_t>self._lexemes
+        if self._n_lexemes and start <= word < <size_t>(self._lexemes + self._n_lexemes):
+            i = (word - start) / sizeof(Lexeme)
+            return self._str_data[self._str_offsets[i]:self._str_offsets[i + 1]]
+        return self.strings.get(word, '')
+
 
 cpdef bytes normalize_word(word):
     if '-' in word and word[0] != '-':
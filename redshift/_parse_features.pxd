@@ -1,5 +1,13 @@
-from redshift.sentence cimport Token
+from redshift.sentence cimport Token, Sentence
 from redshift._state cimport SlotTokens
 from thinc.typedefs cimport atom_t, weight_t
 
-cdef int fill_context(atom_t* context, SlotTokens* tokens, Token* parse) except -1
+# The atoms of a token that don't depend on the parse: norm, tag, cluster and
+# two cluster prefixes.
+cdef enum:
+    N_WORD_ATOMS = 5
+
+cdef int fill_word_atoms(atom_t* words, Sentence* sent) except -1 nogil
+
+cdef int fill_context(atom_t* context, SlotTokens* tokens, Token* parse,
+                      atom_t* words) except -1 nogil
@@ -1,4 +1,3 @@
-# cython: profile=True
 """
 Fill an array, context, with every _atomic_ value our features reference.
 We then write the _actual features_ as tuples of the atoms. The machinery
@@ -10,7 +9,7 @@ can refer to them.
 """
 
 from redshift._state cimport SlotTokens
-from redshift.sentence cimport Token
+from redshift.sentence cimport Token, Sentence
 from index.lexicon cimport Lexeme
 from itertools import combinations
 # Context elements
@@ -289,25 +288,41 @@ def get_kernel_tokens():
 def context_size():
     return CONTEXT_SIZE
 
-cdef inline void fill_token(atom_t* context, size_t i, Token token) nogil:
-    cdef Lexeme* word = token.word
-    context[i] = word.norm
-    context[i+1] = token.tag
-    # We've read in the string little-endian, so now we can take & (2**n)-1
-    # to get the first n bits of the cluster.
-    # e.g. s = "1110010101"
-    # s = ''.join(reversed(s))
-    # first_4_bits = int(s, 2)
-    # print first_4_bits
-    # 5
-    # print "{0:b}".format(prefix).ljust(4, '0')
-    # 1110
-    # What we're doing here is picking a number where all bits are 1, e.g.
-    # 15 is 1111, 63 is 111111 and doing bitwise AND, so getting all bits in
-    # the source that are set to 1.
-    context[i+2] = word.cluster
-    context[i+3] = word.cluster & 63
-    context[i+4] = word.cluster & 15
+cdef int fill_word_atoms(atom_t* words, Sentence* sent) except -1 nogil:
+    """Fill words with the atoms of each token that don't depend on the parse,
+    N_WORD_ATOMS per token. Build it after the sentence is tagged."""
+    cdef size_t i
+    cdef Lexeme* word
+    for i in range(sent.n):
+        word = sent.tokens[i].word
+        words[0] = word.norm
+        words[1] = sent.tokens[i].tag
+        # We've read in the string little-endian, so now we can take & (2**n)-1
+        # to get the first n bits of the cluster.
+        # e.g. s = "1110010101"
+        # s = ''.join(reversed(s))
+        # first_4_bits = int(s, 2)
+        # print first_4_bits
+        # 5
+        # print "{0:b}".format(prefix).ljust(4, '0')
+        # 1110
+        # What we're doing here is picking a number where all bits are 1, e.g.
+        # 15 is 1111, 63 is 111111 and doing bitwise AND, so getting all bits in
+        # the source that are set to 1.
+        words[2] = word.cluster
+        words[3] = word.cluster & 63
+        words[4] = word.cluster & 15
+        words += N_WORD_ATOMS
+
+
+cdef inline void fill_token(atom_t* context, size_t i, Token* token,
+                            atom_t* words) nogil:
+    words += token.i * N_WORD_ATOMS
+    context[i] = words[0]
+    context[i+1] = words[1]
+    context[i+2] = words[2]
+    context[i+3] = words[3]
+    context[i+4] = words[4]
     context[i+5] = token.label
     context[i+6] = token.l_valency
     context[i+7] = token.r_valency
@@ -318,35 +333,36 @@ cdef inline void zero_token(size_t* context, size_t i):
         context[i+j] = 0
 
 
-cdef int fill_context(atom_t* context, SlotTokens* t, Token* parse) except -1:
+cdef int fill_context(atom_t* context, SlotTokens* t, Token* parse,
+                      atom_t* words) except -1 nogil:
     cdef size_t c
     for c in range(CONTEXT_SIZE):
         context[c] = 0
     # This fills in the basic properties of each of our "slot" tokens, e.g.
     # word on top of the stack, word at the front of the buffer, etc.
-    fill_token(context, S2w, t.s2)
-    fill_token(context, S1w, t.s1)
-    fill_token(context, S1rw, t.s1r)
-    fill_token(context, S0le_w, t.s0le)
-    fill_token(context, S0lw, t.s0l)
-    fill_token(context, S0l2w, t.s0l2)
-    fill_token(context, S0l0w, t.s0l0)
-    fill_token(context, S0w, t.s0)
-    fill_token(context, S0nw, t.s0n)
-    fill_token(context, S0nnw, t.s0nn)
-    fill_token(context, S0r0w, t.s0r0)
-    fill_token(context, S0r2w, t.s0r2)
-    fill_token(context, S0rw, t.s0r)
-    fill_token(context, S0re_w, t.s0re)
-    fill_token(context, N0le_w, t.n0le)
-    fill_token(context, N0lw, t.n0l)
-    fill_token(context, N0l2w, t.n0l2)
-    fill_token(context, N0l0w, t.n0l0)
-    fill_token(context, P2w, t.p2)
-    fill_token(context, P1w, t.p1)
-    fill_token(context, N0w, t.n0)
-    fill_token(context, N1w, t.n1)
-    fill_token(context, N2w, t.n2)
+    fill_token(context, S2w, t.s2, words)
+    fill_token(context, S1w, t.s1, words)
+    fill_token(context, S1rw, t.s1r, words)
+    fill_token(context, S0le_w, t.s0le, words)
+    fill_token(context, S0lw, t.s0l, words)
+    fill_token(context, S0l2w, t.s0l2, words)
+    fill_token(context, S0l0w, t.s0l0, words)
+    fill_token(context, S0w, t.s0, words)
+    fill_token(context, S0nw, t.s0n, words)
+    fill_token(context, S0nnw, t.s0nn, words)
+    fill_token(context, S0r0w, t.s0r0, words)
+    fill_token(context, S0r2w, t.s0r2, words)
+    fill_token(context, S0rw, t.s0r, words)
+    fill_token(context, S0re_w, t.s0re, words)
+    fill_token(context, N0le_w, t.n0le, words)
+    fill_token(context, N0lw, t.n0l, words)
+    fill_token(context, N0l2w, t.n0l2, words)
+    fill_token(context, N0l0w, t.n0l0, words)
+    fill_token(context, P2w, t.p2, words)
+    fill_token(context, P1w, t.p1, words)
+    fill_token(context, N0w, t.n0, words)
+    fill_token(context, N1w, t.n1, words)
+    fill_token(context, N2w, t.n2, words)
 
     cdef int i
     if t.s0.i != 0:
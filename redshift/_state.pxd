@@ -2,48 +2,121 @@ from libc.string cimport const_void
 from libc.stdint cimport uint64_t, int64_t
 
 from cymem.cymem cimport Pool
+from thinc.typedefs cimport weight_t
 
 from .sentence cimport Sentence, Token
 
 
-include "compile_time_options.pxi"
-IF TRANSITION_SYSTEM == 'arc_eager':
-    from .arc_eager cimport *
-ELSE:
-    from .arc_hybrid cimport *
-
-
 # From left-to-right in the string, the slot tokens are:
 # S2, S1, S0le, S0l, S0l2, S0l0, S0, S0r0, S0r2, S0r, S0re
 # N0le, N0l, N0l2, N0l0
+# The slots point into the state's pages, so they're only good until the state
+# is next written to.
 
 cdef struct SlotTokens:
-    Token s2
-    Token s1
-    Token s1r
-    Token s0le
-    Token s0l
-    Token s0l2
-    Token s0l0
-    Token s0
-    Token s0r0
-    Token s0r2
-    Token s0r
-    Token s0re
-    Token n0le
-    Token n0l
-    Token n0l2
-    Token n0l0
-    Token n0
-    Token n1
-    Token n2
+    Token* s2
+    Token* s1
+    Token* s1r
+    Token* s0le
+    Token* s0l
+    Token* s0l2
+    Token* s0l0
+    Token* s0
+    Token* s0r0
+    Token* s0r2
+    Token* s0r
+    Token* s0re
+    Token* n0le
+    Token* n0l
+    Token* n0l2
+    Token* n0l0
+    Token* n0
+    Token* n1
+    Token* n2
 
     # Previous to n0
-    Token p1
-    Token p2
+    Token* p1
+    Token* p2
     # After S0
-    Token s0n
-    Token s0nn
+    Token* s0n
+    Token* s0nn
+
+
+# A token's dependents are kept as a linked list on each side, threaded through
+# the dependents themselves: the head records the first and last child it took
+# on each side, and each child records the sibling attached just before it.
+# Only entries for tokens with a non-zero valency on that side are meaningful.
+cdef struct Children:
+    size_t l_first
+    size_t l_last
+    size_t r_first
+    size_t r_last
+    size_t prev_sib
+
+
+cdef enum:
+    PAGE_BITS = 2
+    PAGE_SIZE = 4 # 1 << PAGE_BITS
+    PAGE_MASK = 3 # PAGE_SIZE - 1
+    NODE_BITS = 4
+    NODE_SIZE = 16 # 1 << NODE_BITS
+    NODE_MASK = 15 # NODE_SIZE - 1
+
+
+# The per-token parts of a state are kept in fixed-size pages, which are the
+# leaves of a radix tree of NODE_SIZE-way nodes, a level deeper for every
+# factor of NODE_SIZE in the number of pages. A state shares its tree with the
+# states copied from it, so copying a state only takes a reference to the root.
+# A write copies the page it touches, and the nodes on the path down to it,
+# if they're shared, so it costs O(NODE_SIZE * depth), or O(log n). Nodes and
+# pages are reference counted, and recycled through the Arena they came from.
+cdef struct Page:
+    size_t refs
+    Page* next_free
+    Token tokens[PAGE_SIZE]
+    Children children[PAGE_SIZE]
+    # The word beneath each token when it's on the stack
+    size_t below[PAGE_SIZE]
+    bint on_stack[PAGE_SIZE]
+
+
+# The items of a node are Page* at the bottom level of the tree, and Node*
+# above it.
+cdef struct Node:
+    size_t refs
+    size_t length
+    Node* next_free
+    void* items[NODE_SIZE]
+
+
+cdef struct Arena:
+    void* mem
+    size_t nr_page
+    size_t depth # Levels of nodes above the pages
+    size_t shift # Bits of a token's index below the root's item
+    Page* free_pages
+    Node* free_nodes
+
+
+# The gold-standard parse, plus an index of each word's gold children in order,
+# so the oracle can count them without scanning the sentence.
+cdef struct GoldParse:
+    Token* tokens
+    size_t n
+    size_t* children
+    size_t* first_child
+
+
+# A move of the transition system: see arc_eager.pyx and arc_hybrid.pyx. The
+# score, cost and validity are set for a state by the scorer, fill_costs and
+# fill_valid.
+cdef struct Transition:
+    size_t clas
+    size_t move
+    size_t label
+    weight_t score
+    int cost
+    bint is_valid
 
 
 cdef struct State:
@@ -55,48 +128,92 @@ cdef struct State:
     size_t top
     int cost
 
-    size_t* stack
-    
-    size_t** l_children
-    size_t** r_children
-    Token* parse
-    Transition* history
+    Sentence* sent
+    Arena* arena
+    Node* root
     SlotTokens slots
 
 
-cdef int fill_slots(State* s) except -1
+cdef int fill_slots(State* s) except -1 nogil
+
+cdef int add_dep(State *s, size_t head, size_t child, size_t label) except -1 nogil
+cdef int del_l_child(State *s, size_t head) except -1 nogil
+cdef int del_r_child(State *s, size_t head) except -1 nogil
+
+cdef size_t pop_stack(State *s) except 0 nogil
+cdef int push_stack(State *s) except -1 nogil
+cdef int push_word(State *s, size_t word) except -1 nogil
+
+cdef Page* own_page(State* s, size_t i) except NULL nogil
+
+cdef inline Page* get_page(State* s, size_t i) nogil:
+    cdef Node* node = s.root
+    cdef size_t shift = s.arena.shift
+    while shift != PAGE_BITS:
+        node = <Node*>node.items[(i >> shift) & NODE_MASK]
+        shift -= NODE_BITS
+    return <Page*>node.items[(i >> PAGE_BITS) & NODE_MASK]
+
+cdef inline Token* get_token(State* s, size_t i) nogil:
+    return &get_page(s, i).tokens[i & PAGE_MASK]
+
+cdef inline Children* get_children(State* s, size_t i) nogil:
+    return &get_page(s, i).children[i & PAGE_MASK]
 
-cdef int add_dep(State *s, size_t head, size_t child, size_t label) except -1
-cdef int del_l_child(State *s, size_t head) except -1
-cdef int del_r_child(State *s, size_t head) except -1
+cdef inline size_t get_below(State* s, size_t i) nogil:
+    return get_page(s, i).below[i & PAGE_MASK]
 
-cdef size_t pop_stack(State *s) except 0
-cdef int push_stack(State *s) except -1
+cdef inline bint is_on_stack(State* s, size_t i) nogil:
+    return get_page(s, i).on_stack[i & PAGE_MASK]
+
+# The edit_* functions give a pointer that can be written to, copying the page
+# first if it's shared. Pointers from the get_* functions must not be written
+# through.
+cdef inline Token* edit_token(State* s, size_t i) except NULL nogil:
+    return &own_page(s, i).tokens[i & PAGE_MASK]
+
+cdef inline Children* edit_children(State* s, size_t i) except NULL nogil:
+    return &own_page(s, i).children[i & PAGE_MASK]
 
 cdef inline size_t get_s1(State *s) nogil:
     if s.stack_len < 2:
         return 0
-    return s.stack[s.stack_len - 2]
+    return get_below(s, s.top)
+
+cdef inline size_t get_s2(State *s) nogil:
+    if s.stack_len < 3:
+        return 0
+    return get_below(s, get_below(s, s.top))
 
 cdef inline size_t get_l(State *s, size_t head) nogil:
-    if s.parse[head].l_valency == 0:
+    if get_token(s, head).l_valency == 0:
         return 0
-    return s.l_children[head][s.parse[head].l_valency - 1]
+    return get_children(s, head).l_last
 
 cdef inline size_t get_l2(State *s, size_t head) nogil:
-    if s.parse[head].l_valency < 2:
+    if get_token(s, head).l_valency < 2:
         return 0
-    return s.l_children[head][s.parse[head].l_valency - 2]
+    return get_children(s, get_children(s, head).l_last).prev_sib
+
+cdef inline size_t get_l0(State *s, size_t head) nogil:
+    if get_token(s, head).l_valency == 0:
+        return 0
+    return get_children(s, head).l_first
 
 cdef inline size_t get_r(State *s, size_t head) nogil:
-    if s.parse[head].r_valency == 0:
+    if get_token(s, head).r_valency == 0:
         return 0
-    return s.r_children[head][s.parse[head].r_valency - 1]
+    return get_children(s, head).r_last
 
 cdef inline size_t get_r2(State *s, size_t head) nogil:
-    if s.parse[head].r_valency < 2:
+    if get_token(s, head).r_valency < 2:
+        return 0
+    return get_children(s, get_children(s, head).r_last).prev_sib
+
+cdef inline size_t get_r0(State *s, size_t head) nogil:
+    if get_token(s, head).r_valency == 0:
         return 0
-    return s.r_children[head][s.parse[head].r_valency - 2]
+    return get_children(s, head).r_first
 
 
 cdef inline bint at_eol(State *s) nogil:
@@ -106,10 +223,15 @@ cdef inline bint is_final(State *s) nogil:
     return at_eol(s) and s.stack_len == 0
 
 
-cdef int has_child_in_buffer(State *s, size_t word, Token* gold) except -1
-cdef int has_head_in_buffer(State *s, size_t word, Token* gold) except -1
-cdef int has_child_in_stack(State *s, size_t word, Token* gold) except -1
-cdef int has_head_in_stack(State *s, size_t word, Token* gold) except -1
+cdef int has_child_in_buffer(State *s, size_t word, GoldParse* gold) except -1 nogil
+cdef int has_head_in_buffer(State *s, size_t word, GoldParse* gold) except -1 nogil
+cdef int has_child_in_stack(State *s, size_t word, GoldParse* gold) except -1 nogil
+cdef int has_head_in_stack(State *s, size_t word, GoldParse* gold) except -1 nogil
+
+cdef GoldParse* init_gold(Token* tokens, size_t n, Pool pool) except NULL
 
+cdef Arena* new_arena(size_t length, Pool pool) except NULL
 cdef State* init_state(Sentence* sent, Pool pool)
+cdef State* new_state(Arena* arena, Pool pool) except NULL
+cdef int reset_state(State* s, Sentence* sent) except -1
 cdef int copy_state(State* s, State* old) except -1
@@ -1,138 +1,345 @@
-# cython: profile=True
-from libc.string cimport memcpy, memset
+from libc.string cimport memset
 from cymem.cymem cimport Pool
 
-DEF MAX_VALENCY = 200
 
-cdef int add_dep(State *s, size_t head, size_t child, size_t label) except -1:
-    s.parse[child].head = head
-    s.parse[child].label = label
+cdef int add_dep(State *s, size_t head, size_t child, size_t label) except -1 nogil:
+    cdef size_t prev_sib
+    cdef Token* c = edit_token(s, child)
+    c.head = head
+    c.label = label
+    cdef size_t left_edge = c.left_edge
+    cdef Token* h = edit_token(s, head)
+    cdef Children* kids = edit_children(s, head)
     if child < head:
-        s.parse[head].left_edge = s.parse[child].left_edge
-        if s.parse[head].l_valency < MAX_VALENCY:
-            s.l_children[head][s.parse[head].l_valency] = child
-            s.parse[head].l_valency += 1
-    elif s.parse[head].r_valency < MAX_VALENCY:
-        s.r_children[head][s.parse[head].r_valency] = child
-        s.parse[head].r_valency += 1
+        h.left_edge = left_edge
+        prev_sib = kids.l_last if h.l_valency != 0 else 0
+        if h.l_valency == 0:
+            kids.l_first = child
+        kids.l_last = child
+        h.l_valency += 1
+    else:
+        prev_sib = kids.r_last if h.r_valency != 0 else 0
+        if h.r_valency == 0:
+            kids.r_first = child
+        kids.r_last = child
+        h.r_valency += 1
+    edit_children(s, child).prev_sib = prev_sib
 
 
-cdef int del_r_child(State *s, size_t head) except -1:
+cdef int del_r_child(State *s, size_t head) except -1 nogil:
     cdef size_t child = get_r(s, head)
-    s.r_children[head][s.parse[head].r_valency - 1] = 0
-    s.parse[head].r_valency -= 1
-    s.parse[child].head = 0
-    s.parse[child].label = 0
+    cdef Children* child_kids = edit_children(s, child)
+    cdef size_t prev_sib = child_kids.prev_sib
+    child_kids.prev_sib = 0
+    cdef Token* c = edit_token(s, child)
+    c.head = 0
+    c.label = 0
+    edit_children(s, head).r_last = prev_sib
+    edit_token(s, head).r_valency -= 1
 
 
-cdef int del_l_child(State *s, size_t head) except -1:
+cdef int del_l_child(State *s, size_t head) except -1 nogil:
     cdef size_t child = get_l(s, head)
-    s.l_children[head][s.parse[head].l_valency - 1] = 0
-    s.parse[head].l_valency -= 1
-    s.parse[child].head = 0
-    s.parse[child].label = 0
-    # This assertion ensures the left-edge above stays correct.
-    assert s.parse[head].head == 0 or s.parse[head].head <= head
-    if s.parse[head].l_valency != 0:
-        s.parse[head].left_edge = s.parse[get_l(s, head)].left_edge
+    cdef Children* child_kids = edit_children(s, child)
+    cdef size_t prev_sib = child_kids.prev_sib
+    child_kids.prev_sib = 0
+    cdef Token* c = edit_token(s, child)
+    c.head = 0
+    c.label = 0
+    edit_children(s, head).l_last = prev_sib
+    cdef Token* h = edit_token(s, head)
+    h.l_valency -= 1
+    # This check ensures the left-edge above stays correct.
+    if h.head != 0 and h.head > head:
+        with gil:
+            raise AssertionError(head)
+    if h.l_valency != 0:
+        h.left_edge = get_token(s, prev_sib).left_edge
     else:
-        s.parse[head].left_edge = head
+        h.left_edge = head
 
 
-cdef size_t pop_stack(State *s) except 0:
+cdef size_t pop_stack(State *s) except 0 nogil:
     cdef size_t popped
-    assert s.stack_len >= 1
+    if s.stack_len < 1:
+        with gil:
+            raise AssertionError(s.stack_len)
     popped = s.top
+    own_page(s, popped).on_stack[popped & PAGE_MASK] = False
     s.top = get_s1(s)
     s.stack_len -= 1
-    assert s.top <= s.n, s.top
-    assert popped != 0
+    if s.top > s.n or popped == 0:
+        with gil:
+            raise AssertionError((s.top, popped))
     return popped
 
 
-cdef int push_stack(State *s) except -1:
-    s.top = s.i
-    s.stack[s.stack_len] = s.i
-    s.stack_len += 1
-    assert s.top <= s.n
+cdef int push_stack(State *s) except -1 nogil:
+    push_word(s, s.i)
     s.i += 1
-    s.parse[s.i].sent_id = s.parse[s.top].sent_id
-
-
-cdef int fill_slots(State *s) except -1:
-    s.slots.s2 = s.parse[s.stack[s.stack_len - 3] if s.stack_len >= 3 else 0]
-    s.slots.s1 = s.parse[get_s1(s)]
-    s.slots.s1r = s.parse[get_r(s, get_s1(s))]
-    s.slots.s0le = s.parse[s.parse[s.top].left_edge]
-    s.slots.s0l = s.parse[get_l(s, s.top)]
-    s.slots.s0l2 = s.parse[get_l2(s, s.top)]
-    s.slots.s0l0 = s.parse[s.l_children[s.top][0]]
-    s.slots.s0 = s.parse[s.top]
-    s.slots.s0r = s.parse[get_r(s, s.top)]
-    s.slots.s0r2 = s.parse[get_r2(s, s.top)]
-    s.slots.s0r0 = s.parse[s.r_children[s.top][0]]
-    assert s.parse[s.i].left_edge != 0
+    cdef size_t sent_id = get_token(s, s.top).sent_id
+    # Usually unchanged, so avoid copying the page over
+    if get_token(s, s.i).sent_id != sent_id:
+        edit_token(s, s.i).sent_id = sent_id
+
+
+cdef int push_word(State *s, size_t word) except -1 nogil:
+    """Put word on top of the stack. Unlike push_stack, doesn't advance the
+    buffer."""
+    if word > s.n:
+        with gil:
+            raise AssertionError(word)
+    cdef Page* page = own_page(s, word)
+    page.below[word & PAGE_MASK] = s.top
+    page.on_stack[word & PAGE_MASK] = True
+    s.top = word
+    s.stack_len += 1
+
+
+cdef int fill_slots(State *s) except -1 nogil:
+    s.slots.s2 = get_token(s, get_s2(s))
+    s.slots.s1 = get_token(s, get_s1(s))
+    s.slots.s1r = get_token(s, get_r(s, get_s1(s)))
+    s.slots.s0le = get_token(s, get_token(s, s.top).left_edge)
+    s.slots.s0l = get_token(s, get_l(s, s.top))
+    s.slots.s0l2 = get_token(s, get_l2(s, s.top))
+    s.slots.s0l0 = get_token(s, get_l0(s, s.top))
+    s.slots.s0 = get_token(s, s.top)
+    s.slots.s0r = get_token(s, get_r(s, s.top))
+    s.slots.s0r2 = get_token(s, get_r2(s, s.top))
+    s.slots.s0r0 = get_token(s, get_r0(s, s.top))
+    cdef size_t n0_edge = get_token(s, s.i).left_edge
+    if n0_edge == 0:
+        with gil:
+            raise AssertionError(s.i)
     # IE S0re is the word before N0le
-    s.slots.s0re = s.parse[s.parse[s.i].left_edge - 1]
-    s.slots.n0le = s.parse[s.parse[s.i].left_edge]
-    s.slots.n0l = s.parse[get_l(s, s.i)]
-    s.slots.n0l2 = s.parse[get_l2(s, s.i)]
-    s.slots.n0l0 = s.parse[s.l_children[s.i][0]]
-    s.slots.n0 = s.parse[s.i]
-    s.slots.n1 = s.parse[s.i + 1 if s.i < (s.n - 1) else 0]
-    s.slots.n2 = s.parse[s.i + 2 if s.i < (s.n - 2) else 0]
-
-    s.slots.p1 = s.parse[s.i - 1 if s.i >= 1 else 0]
-    s.slots.p2 = s.parse[s.i - 2 if s.i >= 2 else 0]
-    s.slots.s0n = s.parse[s.top + 1 if s.top and s.top < (s.n - 1) else 0]
-    s.slots.s0nn = s.parse[s.top + 1 if s.top and s.top < (s.n - 2) else 0]
-
-cdef int has_child_in_buffer(State *s, size_t word, Token* gold) except -1:
-    assert word != 0
-    cdef size_t buff_i
+    s.slots.s0re = get_token(s, n0_edge - 1)
+    s.slots.n0le = get_token(s, n0_edge)
+    s.slots.n0l = get_token(s, get_l(s, s.i))
+    s.slots.n0l2 = get_token(s, get_l2(s, s.i))
+    s.slots.n0l0 = get_token(s, get_l0(s, s.i))
+    s.slots.n0 = get_token(s, s.i)
+    s.slots.n1 = get_token(s, s.i + 1 if s.i < (s.n - 1) else 0)
+    s.slots.n2 = get_token(s, s.i + 2 if s.i < (s.n - 2) else 0)
+
+    s.slots.p1 = get_token(s, s.i - 1 if s.i >= 1 else 0)
+    s.slots.p2 = get_token(s, s.i - 2 if s.i >= 2 else 0)
+    s.slots.s0n = get_token(s, s.top + 1 if s.top and s.top < (s.n - 1) else 0)
+    s.slots.s0nn = get_token(s, s.top + 1 if s.top and s.top < (s.n - 2) else 0)
+
+cdef int has_child_in_buffer(State *s, size_t word, GoldParse* gold) except -1 nogil:
+    if word == 0:
+        with gil:
+            raise AssertionError(word)
+    # The children are in order, so count back from the last one until we
+    # leave the buffer.
+    cdef size_t j = gold.first_child[word + 1]
     cdef int n = 0
-    for buff_i in range(s.i, s.n):
-        if gold[buff_i].head == word:
+    while j > gold.first_child[word] and gold.children[j - 1] >= s.i:
+        j -= 1
+        if gold.children[j] < s.n:
             n += 1
     return n
 
 
-cdef int has_head_in_buffer(State *s, size_t word, Token* gold) except -1:
-    assert word != 0
-    cdef size_t buff_i
-    for buff_i in range(s.i, s.n):
-        if gold[word].head == buff_i:
-            return 1
-    return 0
+cdef int has_head_in_buffer(State *s, size_t word, GoldParse* gold) except -1 nogil:
+    if word == 0:
+        with gil:
+            raise AssertionError(word)
+    cdef size_t head = gold.tokens[word].head
+    return s.i <= head and head < s.n
 
 
-cdef int has_child_in_stack(State *s, size_t word, Token* gold) except -1:
-    assert word != 0
-    cdef size_t i, stack_i
+cdef int has_child_in_stack(State *s, size_t word, GoldParse* gold) except -1 nogil:
+    if word == 0:
+        with gil:
+            raise AssertionError(word)
+    cdef size_t j
     cdef int n = 0
-    for i in range(s.stack_len):
-        stack_i = s.stack[i]
+    for j in range(gold.first_child[word], gold.first_child[word + 1]):
         # Should this be sensitive to whether the word has a head already?
-        if gold[stack_i].head == word:
+        if is_on_stack(s, gold.children[j]):
             n += 1
     return n
 
 
-cdef int has_head_in_stack(State *s, size_t word, Token* gold) except -1:
-    assert word != 0
-    cdef size_t i, stack_i
-    for i in range(s.stack_len):
-        stack_i = s.stack[i]
-        if gold[word].head == stack_i:
-            return 1
-    return 0
+cdef int has_head_in_stack(State *s, size_t word, GoldParse* gold) except -1 nogil:
+    if word == 0:
+        with gil:
+            raise AssertionError(word)
+    return is_on_stack(s, gold.tokens[word].head)
+
+
+cdef GoldParse* init_gold(Token* tokens, size_t n, Pool pool) except NULL:
+    """Index the gold-standard parse of an n-token sentence for the oracle."""
+    cdef size_t i, head
+    cdef GoldParse* gold = <GoldParse*>pool.alloc(1, sizeof(GoldParse))
+    gold.tokens = tokens
+    gold.n = n
+    gold.children = <size_t*>pool.alloc(n, sizeof(size_t))
+    gold.first_child = <size_t*>pool.alloc(n + 1, sizeof(size_t))
+    # Count the children of each word, then fill them in, in order
+    for i in range(n):
+        assert tokens[i].head < n
+        gold.first_child[tokens[i].head + 1] += 1
+    for head in range(n):
+        gold.first_child[head + 1] += gold.first_child[head]
+    cdef size_t* filled = <size_t*>pool.alloc(n, sizeof(size_t))
+    for i in range(n):
+        head = tokens[i].head
+        gold.children[gold.first_child[head] + filled[head]] = i
+        filled[head] += 1
+    return gold
 
 DEF PADDING = 5
 
 
-cdef State* init_state(Sentence* sent, Pool pool):
+cdef Page* alloc_page(Arena* arena) except NULL nogil:
+    cdef Page* page = arena.free_pages
+    if page is NULL:
+        with gil:
+            page = <Page*>(<Pool>arena.mem).alloc(1, sizeof(Page))
+    else:
+        arena.free_pages = page.next_free
+    page.refs = 1
+    page.next_free = NULL
+    return page
+
+
+cdef Node* alloc_node(Arena* arena) except NULL nogil:
+    cdef Node* node = arena.free_nodes
+    if node is NULL:
+        with gil:
+            node = <Node*>(<Pool>arena.mem).alloc(1, sizeof(Node))
+    else:
+        arena.free_nodes = node.next_free
+    node.refs = 1
+    node.length = 0
+    node.next_free = NULL
+    return node
+
+
+cdef void release_page(Arena* arena, Page* page) nogil:
+    page.refs -= 1
+    if page.refs == 0:
+        page.next_free = arena.free_pages
+        arena.free_pages = page
+
+
+cdef void release_node(Arena* arena, Node* node, size_t height) nogil:
+    """Drop a reference to a node height levels above the pages, releasing
+    its items too if that was the last one."""
+    cdef size_t i
+    node.refs -= 1
+    if node.refs == 0:
+        for i in range(node.length):
+            if height == 1:
+                release_page(arena, <Page*>node.items[i])
+            else:
+                release_node(arena, <Node*>node.items[i], height - 1)
+        node.next_free = arena.free_nodes
+        arena.free_nodes = node
+
+
+cdef Node* copy_node(Arena* arena, Node* node, size_t height) except NULL nogil:
+    """Copy a shared node, so the copy and the original share its items."""
+    cdef size_t i
+    cdef Node* copy = alloc_node(arena)
+    copy.length = node.length
+    for i in range(node.length):
+        copy.items[i] = node.items[i]
+        if height == 1:
+            (<Page*>node.items[i]).refs += 1
+        else:
+            (<Node*>node.items[i]).refs += 1
+    release_node(arena, node, height)
+    return copy
+
+
+cdef Page* own_page(State* s, size_t i) except NULL nogil:
+    """Give s its own copy of the page holding token i, and of the nodes on
+    the path to it, if they're shared."""
+    cdef size_t height = s.arena.depth
+    cdef size_t shift = s.arena.shift
+    cdef void** slot = <void**>&s.root
+    cdef Node* node
+    while height != 0:
+        node = <Node*>slot[0]
+        if node.refs != 1:
+            node = copy_node(s.arena, node, height)
+            slot[0] = node
+        slot = &node.items[(i >> shift) & NODE_MASK]
+        shift -= NODE_BITS
+        height -= 1
+    cdef Page* copy
+    cdef Page* page = <Page*>slot[0]
+    if page.refs != 1:
+        copy = alloc_page(s.arena)
+        copy[0] = page[0]
+        copy.refs = 1
+        copy.next_free = NULL
+        slot[0] = copy
+        release_page(s.arena, page)
+        page = copy
+    return page
+
+
+cdef Node* new_tree(Arena* arena, size_t height, size_t nr_page) except NULL:
+    """Build a tree of blank pages, height levels of nodes deep, with
+    nr_page pages."""
     cdef size_t i
+    cdef Page* page
+    cdef Node* node = alloc_node(arena)
+    # The number of pages under each of the node's items
+    cdef size_t span = 1 << (NODE_BITS * (height - 1))
+    node.length = (nr_page + span - 1) / span
+    for i in range(node.length):
+        if height == 1:
+            page = alloc_page(arena)
+            memset(page.tokens, 0, PAGE_SIZE * sizeof(Token))
+            memset(page.children, 0, PAGE_SIZE * sizeof(Children))
+            memset(page.below, 0, PAGE_SIZE * sizeof(size_t))
+            memset(page.on_stack, 0, PAGE_SIZE * sizeof(bint))
+            node.items[i] = page
+        else:
+            node.items[i] = new_tree(arena, height - 1, min(span, nr_page - i * span))
+    return node
+
+
+cdef Arena* new_arena(size_t length, Pool pool) except NULL:
+    """Make an arena for states over sentences of up to length tokens. States
+    copied from each other must share an arena, which must not outlive pool."""
+    cdef Arena* arena = <Arena*>pool.alloc(1, sizeof(Arena))
+    arena.mem = <void*>pool
+    arena.nr_page = (length + PADDING + PAGE_SIZE - 1) >> PAGE_BITS
+    arena.depth = 1
+    while (1 << (NODE_BITS * arena.depth)) < arena.nr_page:
+        arena.depth += 1
+    arena.shift = PAGE_BITS + NODE_BITS * (arena.depth - 1)
+    return arena
+
+
+cdef State* init_state(Sentence* sent, Pool pool):
+    cdef State* s = new_state(new_arena(sent.n, pool), pool)
+    reset_state(s, sent)
+    return s
+
+
+cdef State* new_state(Arena* arena, Pool pool) except NULL:
+    """Allocate a blank state, drawing its pages from arena. Call reset_state
+    to set it up for a particular sentence."""
     cdef State* s = <State*>pool.alloc(1, sizeof(State))
+    s.arena = arena
+    return s
+
+
+cdef int reset_state(State* s, Sentence* sent) except -1:
+    """Return a state allocated by new_state to the initial configuration for
+    sent, so that its memory can be reused across sentences."""
+    cdef size_t i
+    cdef Token* token
+    n = sent.n + PADDING
+    assert n <= s.arena.nr_page * PAGE_SIZE
     s.n = sent.n
     s.m = 0
     s.i = 1
@@ -140,29 +347,20 @@ cdef State* init_state(Sentence* sent, Pool pool):
     s.score = 0
     s.top = 0
     s.stack_len = 0
-    n = sent.n + PADDING
-    s.stack = <size_t*>pool.alloc(n, sizeof(size_t))
-    s.l_children = <size_t**>pool.alloc(n, sizeof(size_t*))
-    s.r_children = <size_t**>pool.alloc(n, sizeof(size_t*))
-    s.parse = <Token*>pool.alloc(n, sizeof(Token))
+    s.sent = sent
+    if s.root is not NULL:
+        release_node(s.arena, s.root, s.arena.depth)
+    s.root = new_tree(s.arena, s.arena.depth, (n + PAGE_SIZE - 1) >> PAGE_BITS)
     for i in range(n):
-        s.parse[i].i = i
+        token = get_token(s, i)
+        token.i = i
         # TODO: Control whether these get filled
-        s.parse[i].word = sent.tokens[i].word
-        s.parse[i].tag = sent.tokens[i].tag
-        s.parse[i].left_edge = i
-        s.l_children[i] = <size_t*>pool.alloc(MAX_VALENCY, sizeof(size_t))
-        s.r_children[i] = <size_t*>pool.alloc(MAX_VALENCY, sizeof(size_t))
-    s.history = <Transition*>pool.alloc(n * 3, sizeof(Transition))
-    return s
+        token.word = sent.tokens[i].word
+        token.tag = sent.tokens[i].tag
+        token.left_edge = i
 
 
 cdef int copy_state(State* s, State* old) except -1:
-    cdef size_t nbytes, i
-    if s.i > old.i:
-        nbytes = (s.i + 1) * sizeof(size_t)
-    else:
-        nbytes = (old.i + 1) * sizeof(size_t)
     s.score = old.score
     s.i = old.i
     s.m = old.m
@@ -170,13 +368,10 @@ cdef int copy_state(State* s, State* old) except -1:
     s.stack_len = old.stack_len
     s.top = old.top
     s.cost = old.cost
-    # Be thrifty in what we copy, as in large beams it starts to matter 
-    memcpy(s.stack, old.stack, (old.stack_len + 1) * sizeof(size_t))
-    # Only have to look up to (and including) the start of the buffer 
-    for i in range(old.i + 1):
-        memcpy(s.l_children[i], old.l_children[i], old.parse[i].l_valency * sizeof(size_t))
-        memcpy(s.r_children[i], old.r_children[i], old.parse[i].r_valency * sizeof(size_t))
-    # TODO: This seems to change feature calculations, if we limit to (old.i + 1)
-    # Why?
-    memcpy(s.parse, old.parse, old.n * sizeof(Token))
-    memcpy(s.history, old.history, old.m * sizeof(Transition))
+    s.sent = old.sent
+    # Share the tree, until one of the states writes to it. Take the
+    # reference first, in case s already holds the root.
+    old.root.refs += 1
+    if s.root is not NULL:
+        release_node(s.arena, s.root, s.arena.depth)
+    s.root = old.root
@@ -2,14 +2,11 @@ from cymem.cymem cimport Pool
 
 from libc.stdint cimport uint32_t
 from libcpp.pair cimport pair
-from libcpp.queue cimport priority_queue
-from libcpp.vector cimport vector
 
 from thinc.typedefs cimport weight_t, class_t
 
 ctypedef pair[size_t, size_t] Candidate
 ctypedef pair[weight_t, Candidate] Entry
-ctypedef priority_queue[Entry] Queue
 
 
 cdef class Beam:
@@ -17,11 +14,14 @@ cdef class Beam:
     cdef class_t nr_class
     cdef class_t width
     cdef class_t size
-    cdef Queue q
+    cdef Entry* top
+    cdef class_t n_top
     cdef void** parents
     cdef void** states
 
     cdef int fill(self, weight_t** scores) except -1
+    cdef int fill_classes(self, weight_t** scores, const class_t* classes,
+                          class_t n_classes) except -1
     cpdef pair[size_t, size_t] pop(self) except *
 
 
@@ -1,4 +1,5 @@
 from cymem.cymem cimport Pool
+from libcpp.algorithm cimport sort
 
 
 cdef class Beam:
@@ -8,6 +9,8 @@ cdef class Beam:
         self.mem = Pool()
         self.parents = <void**>self.mem.alloc(self.width, sizeof(void*))
         self.states = <void**>self.mem.alloc(self.width, sizeof(void*))
+        self.top = <Entry*>self.mem.alloc(self.width, sizeof(Entry))
+        self.n_top = 0
         self.size = 1
         cdef class_t i
         if state_size != 0:
@@ -16,7 +19,7 @@ cdef class Beam:
 
     property score:
         def __get__(self):
-            return self.q.top().first
+            return self.top[self.n_top - 1].first
 
     def fill_from_list(self, list scores):
         mem = Pool()
@@ -26,32 +29,88 @@ cdef class Beam:
             for j, score in enumerate(clas_scores):
                 c_scores[i][j] = score
         self.fill(c_scores)
-        return self.q.top().first
+        return self.top[self.n_top - 1].first
 
     cdef int fill(self, weight_t** scores) except -1:
-        """Populate the queue from a k * n matrix of scores, where k is the
-        beam-width, and n is the number of classes.
+        """Find the best width candidates in a k * n matrix of scores, where k
+        is the current size of the beam, and n is the number of classes.
+
+        Candidates are ordered by score, then parent, then class, as a
+        priority queue of (score, (parent, class)) would pop them. Only the
+        current best width are kept, in a min-heap, so a score below the
+        worst of them is skipped with one comparison. Most of the n * k
+        candidates go that way, and heap work is only done for the few that
+        make it in.
         """
-        cdef Candidate candidate
-        cdef Entry entry
-        cdef weight_t score
-        while not self.q.empty():
-            self.q.pop()
-        for i in range(self.width):
+        cdef weight_t* row
+        cdef class_t i, j
+        cdef class_t n = 0
+        # Rows past the current size hold stale scores from earlier calls.
+        for i in range(self.size):
+            row = scores[i]
             for j in range(self.nr_class):
-                entry = Entry(scores[i][j], Candidate(i, j))
-                self.q.push(entry)
+                if n < self.width or row[j] >= self.top[0].first:
+                    n = _push(self.top, n, self.width, Entry(row[j], Candidate(i, j)))
+        # Sort ascending, so that pop takes from the end
+        sort(self.top, self.top + n)
+        self.n_top = n
+
+    cdef int fill_classes(self, weight_t** scores, const class_t* classes,
+                          class_t n_classes) except -1:
+        """As fill, but only consider the n_classes classes in classes. If
+        there are fewer than width candidates, pop runs out early."""
+        cdef weight_t* row
+        cdef class_t i, j, clas
+        cdef class_t n = 0
+        for i in range(self.size):
+            row = scores[i]
+            for j in range(n_classes):
+                clas = classes[j]
+                if n < self.width or row[clas] >= self.top[0].first:
+                    n = _push(self.top, n, self.width, Entry(row[clas], Candidate(i, clas)))
+        sort(self.top, self.top + n)
+        self.n_top = n
 
     cpdef pair[size_t, size_t] pop(self) except *:
         """Pop the current top candidate from the beam, returning the parent
         and class.
         """
-        if self.q.empty():
+        if self.n_top == 0:
             raise StopIteration
-        cdef weight_t score
-        score, (parent, clas) = self.q.top()
-        self.q.pop()
-        return pair[size_t, size_t](parent, clas)
+        self.n_top -= 1
+        return self.top[self.n_top].second
+
+
+cdef inline class_t _push(Entry* top, class_t n, class_t width, Entry entry) nogil:
+    # Add entry to the first n of top, if it's among the best width, and
+    # return the new n. Once there are width, top is a min-heap.
+    if n < width:
+        top[n] = entry
+        n += 1
+        if n == width:
+            # Sorted ascending is a valid min-heap
+            sort(top, top + n)
+    elif top[0] < entry:
+        top[0] = entry
+        _sift_down(top, n)
+    return n
+
+
+cdef inline void _sift_down(Entry* heap, class_t n) nogil:
+    # Restore the min-heap after its root has been replaced
+    cdef class_t i = 0
+    cdef class_t child
+    cdef Entry tmp
+    while 2 * i + 1 < n:
+        child = 2 * i + 1
+        if child + 1 < n and heap[child + 1] < heap[child]:
+            child += 1
+        if not heap[child] < heap[i]:
+            break
+        tmp = heap[i]
+        heap[i] = heap[child]
+        heap[child] = tmp
+        i = child
 
 
 cdef class MaxViolation:
@@ -71,7 +71,8 @@ def context_size():
 
 
 cdef int fill_context(atom_t* context, Sentence* sent, size_t ptag, size_t pptag,
-                      size_t i):
+                      size_t i) nogil:
+    cdef size_t j
     for j in range(CONTEXT_SIZE):
         context[j] = 0
     context[P1p] = ptag
@@ -89,7 +90,7 @@ cdef int fill_context(atom_t* context, Sentence* sent, size_t ptag, size_t pptag
         fill_token(context, P2w, sent.tokens[i-2].word)
 
 
-cdef inline void fill_token(atom_t* context, size_t i, Lexeme* word):
+cdef inline void fill_token(atom_t* context, size_t i, Lexeme* word) nogil:
     context[i] = word.norm
     # We've read in the string little-endian, so now we can take & (2**n)-1
     # to get the first n bits of the cluster.
@@ -0,0 +1,225 @@
+"""
+Per-call scratch space for feature extraction and scoring.
+
+thinc's Extractor.get_feats and LinearModel.get_scores write into buffers owned
+by the Extractor and LinearModel, so two calls can't be in flight at once. The
+functions here do the same work, but write into a Workspace owned by the caller,
+and don't need the GIL. This lets several threads share one model.
+
+A Workspace has room for a batch of rows, e.g. one per beam item. The context,
+feats and scores arrays hold the rows back to back; extract_feats and
+score_feats work on the first row alone.
+
+A Workspace can also memoise scores, keyed by a hash of the context row, so
+that beam items with the same context are only scored once. See find_scores.
+The memo lives as long as the Workspace, so the Workspace mustn't outlive an
+update to the model.
+"""
+from libc.string cimport memset, memcpy
+from libc.stdint cimport uint64_t
+
+from cymem.cymem cimport Pool
+from murmurhash.mrmr cimport hash64
+from preshed.maps cimport MapStruct
+
+from thinc.typedefs cimport atom_t, weight_t, class_t
+from thinc.features cimport Extractor, Template, Feature
+from thinc.learner cimport LinearModel
+from thinc.weights cimport WeightLine, gather_weights, set_scores, get_nr_rows
+
+
+DEF MAX_TEMPLATE_LEN = 10
+
+
+cdef struct Workspace:
+    atom_t* context
+    Feature* feats
+    WeightLine* lines
+    weight_t* scores
+    Template* templates
+    int n_templ
+    MapStruct* weights
+    class_t nr_class
+    size_t context_size
+    int width
+    int* n_feats
+    # The memo is direct-mapped: a key goes in slot key & (memo_size - 1),
+    # replacing what was there. memo_size is 0 if there's no memo.
+    uint64_t* memo_keys
+    weight_t* memo_scores
+    size_t memo_size
+    # The key of each row of context, and where each beam item's scores are
+    uint64_t* row_keys
+    weight_t** item_scores
+    size_t n_lookups
+    size_t n_hits
+
+
+cdef inline Workspace* init_workspace(Pool mem, Extractor extractor, LinearModel model,
+                                      size_t context_size, int width,
+                                      size_t memo_size=0) except NULL:
+    """Make a Workspace with width rows. With memo_size above 0, the scores of
+    at least that many contexts are memoised (rounded up to a power of two)."""
+    cdef Workspace* ws = <Workspace*>mem.alloc(1, sizeof(Workspace))
+    ws.context = <atom_t*>mem.alloc(width * context_size, sizeof(atom_t))
+    ws.feats = <Feature*>mem.alloc(width * extractor.n_templ, sizeof(Feature))
+    # Each feature contributes at most one weight line per row of classes
+    ws.lines = <WeightLine*>mem.alloc(extractor.n_templ * get_nr_rows(model.nr_class),
+                                      sizeof(WeightLine))
+    ws.scores = <weight_t*>mem.alloc(width * model.nr_class, sizeof(weight_t))
+    ws.n_feats = <int*>mem.alloc(width, sizeof(int))
+    ws.templates = extractor.templates
+    ws.n_templ = extractor.n_templ
+    ws.weights = model.weights.c_map
+    ws.nr_class = model.nr_class
+    ws.context_size = context_size
+    ws.width = width
+    ws.memo_size = 0
+    if memo_size != 0:
+        ws.memo_size = 1
+        while ws.memo_size < memo_size:
+            ws.memo_size *= 2
+        ws.memo_keys = <uint64_t*>mem.alloc(ws.memo_size, sizeof(uint64_t))
+        ws.memo_scores = <weight_t*>mem.alloc(ws.memo_size * model.nr_class,
+                                              sizeof(weight_t))
+    ws.row_keys = <uint64_t*>mem.alloc(width, sizeof(uint64_t))
+    ws.item_scores = <weight_t**>mem.alloc(width, sizeof(weight_t*))
+    return ws
+
+
+cdef inline int extract_feats(Workspace* ws) nogil:
+    """Hash the templates over ws.context into ws.feats, returning the number
+    of features. Matches Extractor.set_feats."""
+    cdef atom_t[MAX_TEMPLATE_LEN] atoms
+    cdef const atom_t* context = ws.context
+    cdef const Template* templ = ws.templates
+    cdef Feature* feat = ws.feats
+    cdef bint seen_non_zero
+    cdef int templ_id, i
+    feat.i = 0
+    feat.key = 1
+    feat.value = 1
+    feat += 1
+    for templ_id in range(ws.n_templ - 1):
+        seen_non_zero = False
+        for i in range(templ.length):
+            atoms[i] = context[templ.indices[i]]
+            seen_non_zero = seen_non_zero or atoms[i]
+        if seen_non_zero:
+            feat.i = templ_id
+            feat.key = hash64(atoms, templ.length * sizeof(atom_t), templ_id)
+            feat.value = 1
+            feat += 1
+        templ += 1
+    return feat - ws.feats
+
+
+cdef inline int score_feats(weight_t* scores, Workspace* ws, int n_feats) nogil:
+    """Write the model's scores for the first n_feats of ws.feats into scores."""
+    memset(scores, 0, ws.nr_class * sizeof(weight_t))
+    cdef int nr_rows = gather_weights(ws.weights, ws.nr_class, ws.lines, ws.feats,
+                                      n_feats)
+    set_scores(scores, ws.lines, nr_rows, ws.nr_class)
+    return 0
+
+
+cdef inline int extract_batch(Workspace* ws, int n_rows) nogil:
+    """Hash the templates over the first n_rows rows of ws.context, into the
+    same rows of ws.feats, and set ws.n_feats. Each row matches extract_feats.
+    The rows are visited together for each template, and beam items often share
+    most of their context, so a row whose atoms match the previous row's reuses
+    its hash."""
+    cdef atom_t[MAX_TEMPLATE_LEN] atoms
+    cdef atom_t[MAX_TEMPLATE_LEN] prev_atoms
+    cdef const atom_t* context
+    cdef const Template* templ = ws.templates
+    cdef Feature* feat
+    cdef bint seen_non_zero, same
+    cdef int row, templ_id, i
+    cdef uint64_t key = 0
+    for row in range(n_rows):
+        feat = &ws.feats[row * ws.n_templ]
+        feat.i = 0
+        feat.key = 1
+        feat.value = 1
+        ws.n_feats[row] = 1
+    for templ_id in range(ws.n_templ - 1):
+        context = ws.context
+        for row in range(n_rows):
+            seen_non_zero = False
+            same = row != 0
+            for i in range(templ.length):
+                atoms[i] = context[templ.indices[i]]
+                seen_non_zero = seen_non_zero or atoms[i]
+                same = same and atoms[i] == prev_atoms[i]
+                prev_atoms[i] = atoms[i]
+            if seen_non_zero:
+                if not same:
+                    key = hash64(atoms, templ.length * sizeof(atom_t), templ_id)
+                feat = &ws.feats[row * ws.n_templ + ws.n_feats[row]]
+                feat.i = templ_id
+                feat.key = key
+                feat.value = 1
+                ws.n_feats[row] += 1
+            context += ws.context_size
+        templ += 1
+    return 0
+
+
+cdef inline int score_batch(Workspace* ws, int n_rows) nogil:
+    """Score the first n_rows rows of ws.feats into the same rows of ws.scores."""
+    cdef int row, nr_rows
+    cdef weight_t* scores = ws.scores
+    cdef Feature* feats = ws.feats
+    for row in range(n_rows):
+        memset(scores, 0, ws.nr_class * sizeof(weight_t))
+        nr_rows = gather_weights(ws.weights, ws.nr_class, ws.lines, feats,
+                                 ws.n_feats[row])
+        set_scores(scores, ws.lines, nr_rows, ws.nr_class)
+        scores += ws.nr_class
+        feats += ws.n_templ
+    return 0
+
+
+cdef inline bint find_scores(Workspace* ws, int item, int row) nogil:
+    """Look for the scores of the context in the given row, in the memo or in
+    an earlier row of this batch, and point ws.item_scores[item] at them. If
+    they aren't found, point it at the row of ws.scores that score_batch will
+    fill, and return False: the caller should keep the row in the batch.
+
+    Rows are matched by a 64-bit hash of their context, as features are by the
+    hash of their atoms, so a collision is possible, but vanishingly rare."""
+    cdef const atom_t* context = &ws.context[row * ws.context_size]
+    cdef uint64_t key = hash64(<void*>context, ws.context_size * sizeof(atom_t), 0)
+    cdef size_t slot
+    cdef int prev
+    ws.row_keys[row] = key
+    if ws.memo_size != 0:
+        ws.n_lookups += 1
+        slot = key & (ws.memo_size - 1)
+        if key != 0 and ws.memo_keys[slot] == key:
+            ws.item_scores[item] = &ws.memo_scores[slot * ws.nr_class]
+            ws.n_hits += 1
+            return True
+        for prev in range(row):
+            if ws.row_keys[prev] == key:
+                ws.item_scores[item] = &ws.scores[prev * ws.nr_class]
+                ws.n_hits += 1
+                return True
+    ws.item_scores[item] = &ws.scores[row * ws.nr_class]
+    return False
+
+
+cdef inline int save_scores(Workspace* ws, int n_rows) nogil:
+    """Add the first n_rows rows of ws.scores to the memo. Call this once the
+    item_scores from find_scores have been used, as it can overwrite them."""
+    cdef int row
+    cdef size_t slot
+    if ws.memo_size == 0:
+        return 0
+    for row in range(n_rows):
+        slot = ws.row_keys[row] & (ws.memo_size - 1)
+        ws.memo_keys[slot] = ws.row_keys[row]
+        memcpy(&ws.memo_scores[slot * ws.nr_class], &ws.scores[row * ws.nr_class],
+               ws.nr_class * sizeof(weight_t))
+    return 0
@@ -1,4 +1,3 @@
-# cython: profile=True
 from _state cimport *
 import index.hashes
 
@@ -34,16 +33,17 @@ cdef inline bint can_right(State* s) nogil:
 
 
 cdef inline bint can_left(State* s) nogil:
-    return s.stack_len >= 1 and s.parse[s.top].head == 0
+    return s.stack_len >= 1 and get_token(s, s.top).head == 0
 
 
 cdef inline bint can_reduce(State* s) nogil:
-    return s.stack_len >= 2 and s.parse[s.top].head != 0
+    return s.stack_len >= 2 and get_token(s, s.top).head != 0
 
 
-cdef bint USE_EDIT = False
+# Only parsers with Edit moves ask about them, so there's no need to check the
+# parser has any.
 cdef inline bint can_edit(State* s) nogil:
-    return USE_EDIT and s.stack_len >= 1
+    return s.stack_len >= 1
 
 
 # Edit oracle:
@@ -57,27 +57,31 @@ cdef inline bint can_edit(State* s) nogil:
 # - You can only LeftArc from a disfluent word to a disfluent word if it has no
 #   fluent children
 # - You can only Reduce a disfluent word if its head is disfluent
-cdef int shift_cost(State* s, Token* gold):
-    assert not at_eol(s)
-    cost = 0
+cdef int shift_cost(State* s, GoldParse* gold) except -1 nogil:
+    cdef int cost = 0
+    if at_eol(s):
+        with gil:
+            raise AssertionError(s.i)
     # - You can always Shift a disfluent word
-    if gold[s.i].is_edit:
+    if gold.tokens[s.i].is_edit:
         return cost
     cost += has_head_in_stack(s, s.i, gold)
     cost += has_child_in_stack(s, s.i, gold)
     return cost
 
 
-cdef int right_cost(State* s, Token* gold):
-    assert s.stack_len >= 1
-    cost = 0
-    if gold[s.i].head == s.top:
+cdef int right_cost(State* s, GoldParse* gold) except -1 nogil:
+    cdef int cost = 0
+    if s.stack_len < 1:
+        with gil:
+            raise AssertionError(s.stack_len)
+    if gold.tokens[s.i].head == s.top:
         return cost
     # - You can always RightArc to a disfluent word
-    if gold[s.i].is_edit:
+    if gold.tokens[s.i].is_edit:
         return cost
     # - You can't RightArc from a disfluent word to a fluent word
-    elif gold[s.top].is_edit or gold[s.i].is_edit:
+    elif gold.tokens[s.top].is_edit or gold.tokens[s.i].is_edit:
         cost += 1
     cost += has_head_in_buffer(s, s.i, gold)
     cost += has_child_in_stack(s, s.i, gold)
@@ -85,43 +89,53 @@ cdef int right_cost(State* s, Token* gold):
     return cost
 
 
-cdef int left_cost(State* s, Token* gold):
-    assert s.stack_len >= 1
-    cost = 0
+cdef int left_cost(State* s, GoldParse* gold) except -1 nogil:
+    cdef size_t child
+    cdef int cost = 0
+    if s.stack_len < 1:
+        with gil:
+            raise AssertionError(s.stack_len)
     # - You can always LeftArc from a disfluent word to a fluent word
-    if gold[s.i].is_edit and not gold[s.top].is_edit:
+    if gold.tokens[s.i].is_edit and not gold.tokens[s.top].is_edit:
         return cost
     # - You can only LeftArc from a disfluent word to a disfluent word if it has no
     #   fluent children
-    if gold[s.i].is_edit and gold[s.top].is_edit:
-        for i in range(s.parse[s.top].l_valency):
-            if not gold[s.l_children[s.top][i]].is_edit:
+    if gold.tokens[s.i].is_edit and gold.tokens[s.top].is_edit:
+        child = get_l(s, s.top)
+        while child != 0:
+            if not gold.tokens[child].is_edit:
                 cost += 1
+            child = get_children(s, child).prev_sib
     # - You can never arc from a fluent word to a disfluent word
-    if not gold[s.i].is_edit and gold[s.top].is_edit:
+    if not gold.tokens[s.i].is_edit and gold.tokens[s.top].is_edit:
         cost += 1
-    if gold[s.top].head == s.i:
+    if gold.tokens[s.top].head == s.i:
         return cost
     cost += has_head_in_buffer(s, s.top, gold)
     cost += has_child_in_buffer(s, s.top, gold)
     return cost
 
 
-cdef int reduce_cost(State* s, Token* gold):
-    assert s.stack_len >= 2
-    cost = 0
-    if gold[s.top].is_edit and not gold[s.parse[s.top].head].is_edit:
+cdef int reduce_cost(State* s, GoldParse* gold) except -1 nogil:
+    cdef int cost = 0
+    if s.stack_len < 2:
+        with gil:
+            raise AssertionError(s.stack_len)
+    if gold.tokens[s.top].is_edit and not gold.tokens[get_token(s, s.top).head].is_edit:
         cost += 1
     cost += has_child_in_buffer(s, s.top, gold)
     return cost
 
 
-cdef int edit_cost(State* s, Token* gold):
-    assert s.stack_len >= 1
-    return 0 if gold[s.top].is_edit else 1
+cdef int edit_cost(State* s, GoldParse* gold) except -1 nogil:
+    if s.stack_len < 1:
+        with gil:
+            raise AssertionError(s.stack_len)
+    return 0 if gold.tokens[s.top].is_edit else 1
 
 
-cdef int fill_valid(State* s, Transition* classes, size_t n) except -1:
+cdef int fill_valid(State* s, Transition* classes, size_t n) except -1 nogil:
+    cdef size_t i
     cdef bint[N_MOVES] valid
     valid[SHIFT] = can_shift(s)
     valid[LEFT] = can_left(s)
@@ -134,11 +148,13 @@ cdef int fill_valid(State* s, Transition* classes, size_t n) except -1:
         if classes[i].is_valid:
             break
     else:
-        props = (s.i, s.n, s.stack_len)
-        raise StandardError('No valid classes. i=%d, n=%d, stack_len=%d' % props)
+        with gil:
+            props = (s.i, s.n, s.stack_len)
+            raise StandardError('No valid classes. i=%d, n=%d, stack_len=%d' % props)
 
 
-cdef int fill_costs(State* s, Transition* classes, size_t n, Token* gold) except -1:
+cdef int fill_costs(State* s, Transition* classes, size_t n, GoldParse* gold) except -1 nogil:
+    cdef size_t i
     cdef int[N_MOVES] costs
     costs[SHIFT] = shift_cost(s, gold) if can_shift(s) else -1
     costs[LEFT] = left_cost(s, gold) if can_left(s) else -1
@@ -148,23 +164,23 @@ cdef int fill_costs(State* s, Transition* classes, size_t n, Token* gold) except
     for i in range(n):
         classes[i].cost = costs[classes[i].move]
         if classes[i].move == LEFT and classes[i].cost == 0 and \
-          gold[s.top].head == s.i:
-            classes[i].cost += gold[s.top].label != classes[i].label
+          gold.tokens[s.top].head == s.i:
+            classes[i].cost += gold.tokens[s.top].label != classes[i].label
         elif classes[i].move == RIGHT and classes[i].cost == 0 and \
-          gold[s.i].head == s.top:
-            classes[i].cost += gold[s.i].label != classes[i].label
-        elif classes[i].move == EDIT and classes[i].cost == 0 and gold[s.top].is_edit:
-            classes[i].cost = gold[s.top].label != classes[i].label
+          gold.tokens[s.i].head == s.top:
+            classes[i].cost += gold.tokens[s.i].label != classes[i].label
+        elif classes[i].move == EDIT and classes[i].cost == 0 and gold.tokens[s.top].is_edit:
+            classes[i].cost = gold.tokens[s.top].label != classes[i].label
         # Set is_valid here as well, so we can just over-write it if we don't
         # want to follow gold
         classes[i].is_valid = classes[i].cost == 0
 
 
-cdef int transition(Transition* t, State *s) except -1:
+cdef int transition(Transition* t, State *s) except -1 nogil:
     cdef size_t edited
     cdef size_t child
     cdef size_t i
-    s.history[s.m] = t[0]
+    cdef Token* token
     s.m += 1 
     if t.move == SHIFT:
         push_stack(s)
@@ -178,28 +194,26 @@ cdef int transition(Transition* t, State *s) except -1:
         pop_stack(s)
     elif t.move == EDIT:
         edited = pop_stack(s)
-        while s.parse[edited].l_valency:
+        while get_token(s, edited).l_valency:
             child = get_l(s, edited)
             del_l_child(s, edited)
-            s.top = child
-            s.stack[s.stack_len] = child
-            s.stack_len += 1
-        for i in range(edited, s.parse[s.i].left_edge):
+            push_word(s, child)
+        for i in range(edited, get_token(s, s.i).left_edge):
             # We might have already set these as edits, under a different
             # label.
-            if s.parse[i].is_edit:
+            if get_token(s, i).is_edit:
                 break
-            s.parse[i].head = i
-            s.parse[i].label = t.label
-            s.parse[i].is_edit = True
+            token = edit_token(s, i)
+            token.head = i
+            token.label = t.label
+            token.is_edit = True
     else:
-        raise StandardError(t.move)
+        with gil:
+            raise StandardError(t.move)
 
 
 cdef size_t get_nr_moves(list left_labels, list right_labels, list dfl_labels,
                          bint use_break):
-    global USE_EDIT
-    USE_EDIT = bool(dfl_labels) 
     return 2 + len(left_labels) + len(right_labels) + len(dfl_labels)
 
 
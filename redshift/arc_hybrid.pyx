@@ -1,4 +1,3 @@
-# cython: profile=True
 from ._state cimport *
 import index.hashes
 
@@ -26,26 +25,28 @@ cdef unicode move_name(Transition* t):
 
 
 
-cdef inline bint can_shift(State* s):
+cdef inline bint can_shift(State* s) nogil:
     return not at_eol(s)
 
 
-cdef inline bint can_right(State* s):
+cdef inline bint can_right(State* s) nogil:
     return s.stack_len >= 2
 
 
-cdef inline bint can_left(State* s):
+cdef inline bint can_left(State* s) nogil:
     return s.stack_len >= 1
 
 
-cdef bint USE_EDIT = False
-cdef inline bint can_edit(State* s):
-    return USE_EDIT and s.stack_len
+# Which of the Edit and Break moves a parser has is decided by its moves
+# array, so that parsers with different moves can share a process. Only
+# parsers with the moves ask whether they're valid, so there's no need to
+# check here. The oracle needs to know about Break: see fill_costs.
+cdef inline bint can_edit(State* s) nogil:
+    return s.stack_len
 
 
-cdef bint USE_BREAK = False
-cdef inline bint can_break(State* s):
-    return USE_BREAK and s.stack_len == 1 and not s.parse[s.i].l_valency and not at_eol(s)
+cdef inline bint can_break(State* s) nogil:
+    return s.stack_len == 1 and not get_token(s, s.i).l_valency and not at_eol(s)
 
 
 # Edit oracle:
@@ -55,63 +56,72 @@ cdef inline bint can_break(State* s):
 # - You can't RightArc from a disfluent word to a fluent word
 # - You can always Shift an Edit word
 
-cdef int shift_cost(State* s, Token* gold):
-    assert not at_eol(s)
-    cost = 0
-    if can_break(s):
-        cost += gold[s.top].sent_id != gold[s.i].sent_id
-    if gold[s.i].head == s.top:
+cdef int shift_cost(State* s, GoldParse* gold, bint use_break) except -1 nogil:
+    cdef int cost = 0
+    if at_eol(s):
+        with gil:
+            raise AssertionError(s.i)
+    if use_break and can_break(s):
+        cost += gold.tokens[s.top].sent_id != gold.tokens[s.i].sent_id
+    if gold.tokens[s.i].head == s.top:
         return cost
-    if gold[s.i].is_edit:
+    if gold.tokens[s.i].is_edit:
         return cost
     cost += has_head_in_stack(s, s.i, gold)
     cost += has_child_in_stack(s, s.i, gold)
     return cost
 
 
-cdef int right_cost(State* s, Token* gold):
-    assert s.stack_len >= 2
-    assert not can_break(s)
-    cost = 0
-    if gold[get_s1(s)].is_edit and gold[s.top].is_edit:
+cdef int right_cost(State* s, GoldParse* gold) except -1 nogil:
+    cdef int cost = 0
+    if s.stack_len < 2 or can_break(s):
+        with gil:
+            raise AssertionError(s.stack_len)
+    if gold.tokens[get_s1(s)].is_edit and gold.tokens[s.top].is_edit:
         return cost
-    elif gold[get_s1(s)].is_edit or gold[s.top].is_edit:
+    elif gold.tokens[get_s1(s)].is_edit or gold.tokens[s.top].is_edit:
         cost += 1
     cost += has_head_in_buffer(s, s.top, gold)
     cost += has_child_in_buffer(s, s.top, gold)
     return cost
 
 
-cdef int left_cost(State* s, Token* gold):
-    assert s.stack_len
-    cost = 0
-    if can_break(s):
-        cost += gold[s.top].sent_id != gold[s.i].sent_id
+cdef int left_cost(State* s, GoldParse* gold, bint use_break) except -1 nogil:
+    cdef int cost = 0
+    if s.stack_len < 1:
+        with gil:
+            raise AssertionError(s.stack_len)
+    if use_break and can_break(s):
+        cost += gold.tokens[s.top].sent_id != gold.tokens[s.i].sent_id
     # TODO: This is wrong!! What if s.top is an Edit, with fluent children??
-    if gold[s.i].is_edit:
+    if gold.tokens[s.i].is_edit:
         return cost
-    if not gold[s.i].is_edit and gold[s.top].is_edit:
+    if not gold.tokens[s.i].is_edit and gold.tokens[s.top].is_edit:
         return cost + 1
-    if gold[s.top].head == s.i:
+    if gold.tokens[s.top].head == s.i:
         return cost
-    cost += gold[s.top].head == get_s1(s)
+    cost += gold.tokens[s.top].head == get_s1(s)
     cost += has_head_in_buffer(s, s.top, gold)
     cost += has_child_in_buffer(s, s.top, gold)
     return cost
 
 
-cdef int edit_cost(State *s, Token* gold):
-    assert s.stack_len >= 1
-    return 0 if gold[s.top].is_edit else 1
+cdef int edit_cost(State *s, GoldParse* gold) except -1 nogil:
+    if s.stack_len < 1:
+        with gil:
+            raise AssertionError(s.stack_len)
+    return 0 if gold.tokens[s.top].is_edit else 1
 
 
-cdef int break_cost(State* s, Token* gold):
-    assert s.stack_len == 1
-    assert not at_eol(s)
-    return 0 if gold[s.top].sent_id != gold[s.i].sent_id else 1
+cdef int break_cost(State* s, GoldParse* gold) except -1 nogil:
+    if s.stack_len != 1 or at_eol(s):
+        with gil:
+            raise AssertionError(s.stack_len)
+    return 0 if gold.tokens[s.top].sent_id != gold.tokens[s.i].sent_id else 1
 
 
-cdef int fill_valid(State* s, Transition* classes, size_t n) except -1:
+cdef int fill_valid(State* s, Transition* classes, size_t n) except -1 nogil:
+    cdef size_t i
     cdef bint[N_MOVES] valid
     valid[SHIFT] = can_shift(s)
     valid[LEFT] = can_left(s)
@@ -124,33 +134,42 @@ cdef int fill_valid(State* s, Transition* classes, size_t n) except -1:
         if classes[i].is_valid:
             break
     else:
-        raise StandardError
+        with gil:
+            raise StandardError
 
 
-cdef int fill_costs(State* s, Transition* classes, size_t n, Token* gold) except -1:
+cdef int fill_costs(State* s, Transition* classes, size_t n, GoldParse* gold) except -1 nogil:
+    cdef size_t i
     cdef int[N_MOVES] costs
-    costs[SHIFT] = shift_cost(s, gold) if can_shift(s) else -1
-    costs[LEFT] = left_cost(s, gold) if can_left(s) else -1
+    # Breaking changes the cost of Shift and Left, if the parser can Break
+    cdef bint use_break = False
+    for i in range(n):
+        if classes[i].move == BREAK:
+            use_break = True
+            break
+    costs[SHIFT] = shift_cost(s, gold, use_break) if can_shift(s) else -1
+    costs[LEFT] = left_cost(s, gold, use_break) if can_left(s) else -1
     costs[RIGHT] = right_cost(s, gold) if can_right(s) else -1
     costs[EDIT] = edit_cost(s, gold) if can_edit(s) else -1
     costs[BREAK] = break_cost(s, gold) if can_break(s) else -1
     for i in range(n):
         classes[i].cost = costs[classes[i].move]
         if classes[i].move == LEFT and classes[i].cost == 0 and \
-          gold[s.top].head == s.i:
-            classes[i].cost += gold[s.top].label != classes[i].label
+          gold.tokens[s.top].head == s.i:
+            classes[i].cost += gold.tokens[s.top].label != classes[i].label
         elif classes[i].move == RIGHT and classes[i].cost == 0 and \
-          gold[s.top].head == get_s1(s):
-            classes[i].cost = gold[s.top].label != classes[i].label
-        elif classes[i].move == EDIT and classes[i].cost == 0 and gold[s.top].is_edit:
-            classes[i].cost = gold[s.top].label != classes[i].label
+          gold.tokens[s.top].head == get_s1(s):
+            classes[i].cost = gold.tokens[s.top].label != classes[i].label
+        elif classes[i].move == EDIT and classes[i].cost == 0 and gold.tokens[s.top].is_edit:
+            classes[i].cost = gold.tokens[s.top].label != classes[i].label
         # Set is_valid here as well, so we can just over-write it if we don't
         # want to follow gold
         classes[i].is_valid = classes[i].cost == 0
 
 
-cdef int transition(Transition* t, State *s) except -1:
-    s.history[s.m] = t[0]
+cdef int transition(Transition* t, State *s) except -1 nogil:
+    cdef size_t edited, child, i
+    cdef Token* token
     s.m += 1 
     if t.move == SHIFT:
         push_stack(s)
@@ -162,34 +181,33 @@ cdef int transition(Transition* t, State *s) except -1:
         pop_stack(s)
     elif t.move == EDIT:
         edited = pop_stack(s)
-        while s.parse[edited].l_valency:
+        while get_token(s, edited).l_valency:
             child = get_l(s, edited)
             del_l_child(s, edited)
-            s.top = child
-            s.stack[s.stack_len] = child
-            s.stack_len += 1
-        for i in range(edited, s.parse[s.i].left_edge):
+            push_word(s, child)
+        for i in range(edited, get_token(s, s.i).left_edge):
             # We might have already set these as edits, under a different
             # label.
-            if s.parse[i].is_edit:
+            if get_token(s, i).is_edit:
                 break
-            s.parse[i].head = i
-            s.parse[i].label = t.label
-            s.parse[i].is_edit = True
+            token = edit_token(s, i)
+            token.head = i
+            token.label = t.label
+            token.is_edit = True
     elif t.move == BREAK:
-        assert s.stack_len == 1
+        if s.stack_len != 1:
+            with gil:
+                raise AssertionError(s.stack_len)
         add_dep(s, s.n - 1, s.top, t.label)
-        s.parse[s.i].sent_id = s.parse[s.top].sent_id + 1
+        edit_token(s, s.i).sent_id = get_token(s, s.top).sent_id + 1
         pop_stack(s)
     else:
-        raise StandardError(t.move)
+        with gil:
+            raise StandardError(t.move)
 
 
 cdef size_t get_nr_moves(list left_labels, list right_labels, list dfl_labels,
                          bint use_break):
-    global USE_BREAK, USE_EDIT
-    USE_BREAK = use_break
-    USE_EDIT = bool(dfl_labels) 
     return 1 + use_break + len(left_labels) + len(right_labels) + len(dfl_labels)
 
 
@@ -0,0 +1,171 @@
+"""
+Benchmarks for the parser and tagger, on inputs synthesized from a fixed
+corpus, so that runs on the same machine can be compared. See scripts/bench.py.
+
+Results are a flat dict of name to number. Names ending in _per_sec are
+throughputs, where higher is better; the others are times in seconds or sizes
+in KB, where lower is better.
+"""
+from __future__ import division
+
+import os
+import os.path
+import json
+import random
+import resource
+import shutil
+import tempfile
+import time
+
+import index.lexicon
+import redshift.parser
+import redshift.tagger
+from redshift.sentence import Input
+from redshift.util import Config
+
+
+FORMAT_VERSION = 1
+LENGTHS = (5, 15, 30, 60)
+BEAM_WIDTHS = (1, 4, 8, 16)
+
+
+def default_corpus():
+    return os.path.join(os.path.dirname(os.path.dirname(__file__)), 'tests',
+                        'train.10.conll')
+
+
+def synthesize(tokens, n_sents, length, seed=0):
+    '''Make n_sents sentences of the given length, as lists of (word, tag)
+    pairs. Each is a run of tokens, starting at a point picked by a generator
+    seeded with seed, so the same arguments always give the same sentences.'''
+    rng = random.Random(seed)
+    sents = []
+    for _ in range(n_sents):
+        start = rng.randrange(len(tokens))
+        sents.append([tokens[(start + i) % len(tokens)] for i in range(length)])
+    return sents
+
+
+def read_tokens(conll_loc):
+    '''Get the (word, tag) pairs of the CoNLL file at conll_loc, in order.'''
+    tokens = []
+    for sent in Input.iter_conll(conll_loc):
+        for token in sent.tokens:
+            tokens.append((token.word, token.tag))
+    return tokens
+
+
+def run(conll_loc=None, n_tokens=3000, lengths=LENGTHS, beam_widths=BEAM_WIDTHS,
+        n_iter=3, repeat=3, seed=0):
+    '''Run the benchmarks, and return a dict with the settings used and the
+    results. Each timing is the best of repeat runs.
+
+    A model is trained on the corpus at conll_loc, which defaults to
+    tests/train.10.conll, and then used for the parsing and tagging runs, with
+    its beam width set to each of beam_widths. Each length bucket has about
+    n_tokens tokens, in sentences of that length synthesized from the corpus,
+    so short sentences are timed over as much text as long ones.
+    '''
+    if conll_loc is None:
+        conll_loc = default_corpus()
+    results = {}
+    tmp_dir = tempfile.mkdtemp()
+    try:
+        results['lexicon_load_seconds'] = _best_of(
+            repeat, lambda: index.lexicon.Lexicon(index.lexicon.default_loc()))
+        model_dir = os.path.join(tmp_dir, 'model')
+        metrics = []
+        random.seed(seed)
+        redshift.parser.train_sents(list(Input.iter_conll(conll_loc)), model_dir,
+                                    n_iter=n_iter, seed=seed,
+                                    on_iter=metrics.append)
+        results['train_iter_seconds'] = min(m['seconds'] for m in metrics)
+        results['model_load_seconds'] = _best_of(
+            repeat, lambda: redshift.parser.Parser(model_dir))
+
+        tokens = read_tokens(conll_loc)
+        buckets = dict((length, synthesize(tokens, max(1, n_tokens // length),
+                                           length, seed=seed))
+                       for length in lengths)
+        tagger = redshift.tagger.Tagger(model_dir)
+        for length, sents in sorted(buckets.items()):
+            inputs = _get_inputs(sents)
+            secs = _best_of(repeat, lambda: [tagger.tag(sent) for sent in inputs])
+            results['tag_len%d_tokens_per_sec' % length] = (len(sents) * length) / secs
+        for beam_width in beam_widths:
+            parser = redshift.parser.Parser(_with_beam_width(model_dir, tmp_dir,
+                                                             beam_width))
+            for length, sents in sorted(buckets.items()):
+                inputs = _get_inputs(sents)
+                secs = _best_of(repeat, lambda: parser.parse_batch(inputs))
+                name = 'parse_beam%d_len%d_tokens_per_sec' % (beam_width, length)
+                results[name] = (len(sents) * length) / secs
+        results['peak_rss_kb'] = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    finally:
+        shutil.rmtree(tmp_dir)
+    return {
+        'version': FORMAT_VERSION,
+        'settings': {'corpus': os.path.basename(conll_loc), 'n_tokens': n_tokens,
+                     'lengths': list(lengths), 'beam_widths': list(beam_widths),
+                     'n_iter': n_iter, 'repeat': repeat, 'seed': seed},
+        'results': results
+    }
+
+
+def save(report, loc):
+    with open(loc, 'w') as file_:
+        json.dump(report, file_, indent=2, sort_keys=True)
+
+
+def load(loc):
+    with open(loc) as file_:
+        report = json.load(file_)
+    if report.get('version') != FORMAT_VERSION:
+        raise ValueError("Benchmark report %s has version %s, expected %d" %
+                         (loc, report.get('version'), FORMAT_VERSION))
+    return report
+
+
+def compare(report, baseline, tolerance=0.1):
+    '''Compare the results of two runs, returning a list of (name, baseline
+    value, new value, change) for the results that got worse by more than
+    tolerance, as a fraction of the baseline. Results missing from either
+    run are skipped.'''
+    regressions = []
+    for name, old in sorted(baseline['results'].items()):
+        new = report['results'].get(name)
+        if new is None or not old:
+            continue
+        change = (new - old) / old
+        worse = -change if name.endswith('_per_sec') else change
+        if worse > tolerance:
+            regressions.append((name, old, new, change))
+    return regressions
+
+
+def _best_of(repeat, func):
+    best = None
+    for _ in range(repeat):
+        start = time.time()
+        func()
+        secs = time.time() - start
+        if best is None or secs < best:
+            best = secs
+    return best
+
+
+def _get_inputs(sents):
+    return [Input.from_pos(b' '.join(b'%s/%s' % (word, tag) for word, tag in sent))
+            for sent in sents]
+
+
+def _with_beam_width(model_dir, tmp_dir, beam_width):
+    # The beam width is read from the config, so each width gets a copy of the
+    # model directory
+    out_dir = os.path.join(tmp_dir, 'beam%d' % beam_width)
+    if not os.path.exists(out_dir):
+        shutil.copytree(model_dir, out_dir)
+        cfg = json.load(open(os.path.join(out_dir, 'config.json')))
+        cfg['beam_width'] = beam_width
+        Config.write(out_dir, 'config', **cfg)
+    return out_dir
@@ -1 +0,0 @@
-DEF TRANSITION_SYSTEM = 'arc_eager'
@@ -0,0 +1,51 @@
+from libc.stdint cimport uint64_t
+from cymem.cymem cimport Pool
+
+from index.lexicon cimport Lexeme
+from .sentence cimport Input, Token
+
+
+# A compiled corpus is a header, then these arrays, back to back:
+#   uint64_t sent_starts[n_sents + 1]     Offsets of each sentence's tokens
+#   Token tokens[n_tokens]                With word set to a word ID, see below
+#   uint64_t node_starts[n_tokens + 1]    Offsets of each token's lattice nodes
+#   uint64_t node_words[n_nodes]          Word IDs of the lattice nodes
+#   double node_probs[n_nodes]
+#   uint64_t str_offsets[n_strings + 1]
+#   char strings[strings_size]            The words, then tags, then labels
+# Word ID 0 is BLANK_WORD, and word ID i is the i-1th string. Tag and label
+# codes are the ones the corpus was compiled with, and the strings for codes
+# 1..n_tags and 1..n_labels are stored so they can be re-encoded on loading.
+cdef struct CorpusHeader:
+    char magic[8]
+    uint64_t token_size
+    uint64_t n_sents
+    uint64_t n_tokens
+    uint64_t n_nodes
+    uint64_t n_words
+    uint64_t n_tags
+    uint64_t n_labels
+    uint64_t strings_size
+
+
+cdef class Corpus:
+    cdef Pool mem
+    cdef void* _map
+    cdef size_t _map_size
+    cdef CorpusHeader* header
+    cdef uint64_t* sent_starts
+    cdef Token* tokens
+    cdef uint64_t* node_starts
+    cdef uint64_t* node_words
+    cdef double* node_probs
+    cdef uint64_t* str_offsets
+    cdef char* strings
+    cdef Lexeme** words
+    cdef size_t* tags
+    cdef size_t* labels
+
+    cdef Input get(self, size_t i)
+    cdef Lexeme* _get_word(self, uint64_t word_id, Input py_sent) except NULL
+    cdef char* _get_chars(self, uint64_t i)
+    cdef int _get_length(self, uint64_t i)
+    cdef bytes _get_string(self, uint64_t i)
@@ -0,0 +1,261 @@
+"""
+Compile CoNLL files into a binary corpus, which can be memory-mapped and read
+back without parsing text or encoding strings. See corpus.pxd for the format.
+"""
+from libc.stdint cimport uint64_t
+from libc.string cimport memcpy, memcmp
+from posix.mman cimport mmap, munmap, PROT_READ, MAP_SHARED, MAP_FAILED
+from posix.fcntl cimport open as c_open, O_RDONLY
+from posix.unistd cimport close as c_close
+from posix.stat cimport struct_stat, fstat
+
+import shutil
+import tempfile
+
+from cymem.cymem cimport Pool
+from preshed.maps cimport PreshMap
+
+cimport index.lexicon
+from index.lexicon cimport Lexeme, BLANK_WORD
+from index.hashes import encode_pos, encode_label, decode_pos, decode_label
+from index.hashes import get_nr_pos, get_nr_labels
+
+from .sentence cimport Input, Sentence, Token, Step
+
+
+DEF MAGIC = b'RSCORP1\0'
+
+
+def is_compiled(loc):
+    '''Check whether the file at loc is a compiled corpus, rather than text.'''
+    with open(loc, 'rb') as file_:
+        return file_.read(8) == MAGIC
+
+
+def compile_corpus(conll_loc, out_loc):
+    '''Read the CoNLL file at conll_loc, and write it to out_loc as a compiled
+    corpus, returning the number of sentences. Tokens are written as they're
+    laid out in memory, so the file is specific to the platform that built it.
+    '''
+    cdef Input py_sent
+    cdef Sentence* sent
+    cdef Pool mem
+    cdef Token* tokens
+    cdef uint64_t* node_words
+    cdef uint64_t* node_starts
+    cdef uint64_t n_sents = 0
+    cdef uint64_t n_tokens = 0
+    cdef uint64_t n_nodes = 0
+    cdef size_t i, j
+    cdef PreshMap word_ids = PreshMap()
+    strings = []
+    sent_starts_file = tempfile.TemporaryFile()
+    tokens_file = tempfile.TemporaryFile()
+    node_starts_file = tempfile.TemporaryFile()
+    node_words_file = tempfile.TemporaryFile()
+    node_probs_file = tempfile.TemporaryFile()
+    for py_sent in Input.iter_conll(conll_loc):
+        sent = py_sent.c_sent
+        mem = Pool()
+        tokens = <Token*>mem.alloc(sent.n, sizeof(Token))
+        node_starts = <uint64_t*>mem.alloc(sent.n, sizeof(uint64_t))
+        memcpy(tokens, sent.tokens, sent.n * sizeof(Token))
+        sent_starts_file.write((<char*>&n_tokens)[:sizeof(uint64_t)])
+        for i in range(sent.n):
+            node_starts[i] = n_nodes
+            node_words = <uint64_t*>mem.alloc(sent.lattice[i].n, sizeof(uint64_t))
+            for j in range(sent.lattice[i].n):
+                node_words[j] = _word_id(sent.lattice[i].nodes[j], py_sent,
+                                         word_ids, strings)
+            node_words_file.write((<char*>node_words)[:sent.lattice[i].n * sizeof(uint64_t)])
+            node_probs_file.write((<char*>sent.lattice[i].probs)[:sent.lattice[i].n * sizeof(double)])
+            n_nodes += sent.lattice[i].n
+            tokens[i].word = <Lexeme*><size_t>_word_id(tokens[i].word, py_sent,
+                                                      word_ids, strings)
+        tokens_file.write((<char*>tokens)[:sent.n * sizeof(Token)])
+        node_starts_file.write((<char*>node_starts)[:sent.n * sizeof(uint64_t)])
+        n_tokens += sent.n
+        n_sents += 1
+    sent_starts_file.write((<char*>&n_tokens)[:sizeof(uint64_t)])
+    node_starts_file.write((<char*>&n_nodes)[:sizeof(uint64_t)])
+
+    cdef CorpusHeader header
+    memcpy(header.magic, <char*>MAGIC, 8)
+    header.token_size = sizeof(Token)
+    header.n_sents = n_sents
+    header.n_tokens = n_tokens
+    header.n_nodes = n_nodes
+    header.n_words = len(strings)
+    header.n_tags = get_nr_pos() - 1
+    header.n_labels = get_nr_labels() - 1
+    strings.extend([decode_pos(code) for code in range(1, header.n_tags + 1)])
+    strings.extend([decode_label(code) for code in range(1, header.n_labels + 1)])
+    mem = Pool()
+    cdef uint64_t* str_offsets = <uint64_t*>mem.alloc(len(strings) + 1, sizeof(uint64_t))
+    for i, string in enumerate(strings):
+        str_offsets[i + 1] = str_offsets[i] + len(string)
+    header.strings_size = str_offsets[len(strings)]
+    with open(out_loc, 'wb') as file_:
+        file_.write((<char*>&header)[:sizeof(CorpusHeader)])
+        for part in (sent_starts_file, tokens_file, node_starts_file,
+                     node_words_file, node_probs_file):
+            part.seek(0)
+            shutil.copyfileobj(part, file_)
+            part.close()
+        file_.write((<char*>str_offsets)[:(len(strings) + 1) * sizeof(uint64_t)])
+        file_.write(b''.join(strings))
+    return n_sents
+
+
+cdef uint64_t _word_id(Lexeme* word, Input py_sent, PreshMap word_ids,
+                       list strings) except? 0:
+    if word == &BLANK_WORD:
+        return 0
+    cdef uint64_t word_id = <uint64_t>word_ids.get(word.orig)
+    if word_id == 0:
+        strings.append(py_sent._get_str(word))
+        word_id = len(strings)
+        word_ids.set(word.orig, <void*>word_id)
+    return word_id
+
+
+cdef class Corpus:
+    '''A compiled corpus, memory-mapped. Sentences are read out as Input
+    objects. The tokens are copied out of the map, because their Lexeme
+    pointers can't be stored in the file, and have to be set.
+
+    Tags and labels are re-encoded when the corpus is loaded, so they get the
+    codes the current process uses. In a fresh process, these are the codes
+    they were compiled with.
+    '''
+    def __cinit__(self, loc):
+        cdef struct_stat st
+        if isinstance(loc, unicode):
+            loc = loc.encode('utf8')
+        cdef int fd = c_open(loc, O_RDONLY)
+        if fd == -1:
+            raise IOError("Could not open corpus %s" % loc)
+        if fstat(fd, &st) != 0:
+            c_close(fd)
+            raise IOError("Could not stat corpus %s" % loc)
+        if <size_t>st.st_size < sizeof(CorpusHeader):
+            c_close(fd)
+            raise ValueError("Not a compiled corpus: %s" % loc)
+        cdef void* data = mmap(NULL, st.st_size, PROT_READ, MAP_SHARED, fd, 0)
+        c_close(fd)
+        if data == MAP_FAILED:
+            raise IOError("Could not map corpus %s" % loc)
+        self._map = data
+        self._map_size = st.st_size
+        self.header = <CorpusHeader*>data
+        if memcmp(self.header.magic, <char*>MAGIC, 8) != 0:
+            raise ValueError("Not a compiled corpus: %s" % loc)
+        if self.header.token_size != sizeof(Token):
+            raise ValueError("Corpus %s was compiled on an incompatible platform. "
+                             "Recompile it with scripts/compile_corpus.py" % loc)
+        cdef uint64_t n_strings = (self.header.n_words + self.header.n_tags
+                                   + self.header.n_labels)
+        cdef size_t expected = (sizeof(CorpusHeader)
+                                + (self.header.n_sents + 1) * sizeof(uint64_t)
+                                + self.header.n_tokens * sizeof(Token)
+                                + (self.header.n_tokens + 1) * sizeof(uint64_t)
+                                + self.header.n_nodes * sizeof(uint64_t)
+                                + self.header.n_nodes * sizeof(double)
+                                + (n_strings + 1) * sizeof(uint64_t)
+                                + self.header.strings_size)
+        if expected != self._map_size:
+            raise ValueError("Corpus %s is truncated or corrupt" % loc)
+        self.sent_starts = <uint64_t*>(self.header + 1)
+        self.tokens = <Token*>(self.sent_starts + self.header.n_sents + 1)
+        self.node_starts = <uint64_t*>(self.tokens + self.header.n_tokens)
+        self.node_words = self.node_starts + self.header.n_tokens + 1
+        self.node_probs = <double*>(self.node_words + self.header.n_nodes)
+        self.str_offsets = <uint64_t*>(self.node_probs + self.header.n_nodes)
+        self.strings = <char*>(self.str_offsets + n_strings + 1)
+
+        self.mem = Pool()
+        # Words the lexicon doesn't know are left NULL, and each Input gets
+        # its own Lexeme for them, as when reading text.
+        self.words = <Lexeme**>self.mem.alloc(self.header.n_words + 1, sizeof(Lexeme*))
+        self.words[0] = &BLANK_WORD
+        cdef Lexeme* word
+        cdef Pool scratch = Pool()
+        cdef dict oovs = {}
+        cdef uint64_t i
+        for i in range(self.header.n_words):
+            n_oovs = len(oovs)
+            word = index.lexicon.lookup_chars(self._get_chars(i), self._get_length(i),
+                                              scratch, oovs)
+            self.words[i + 1] = word if len(oovs) == n_oovs else NULL
+        self.tags = <size_t*>self.mem.alloc(self.header.n_tags + 1, sizeof(size_t))
+        for i in range(self.header.n_tags):
+            self.tags[i + 1] = encode_pos(self._get_string(self.header.n_words + i))
+        self.labels = <size_t*>self.mem.alloc(self.header.n_labels + 1, sizeof(size_t))
+        for i in range(self.header.n_labels):
+            self.labels[i + 1] = encode_label(self._get_string(
+                self.header.n_words + self.header.n_tags + i))
+
+    def __dealloc__(self):
+        if self._map != NULL:
+            munmap(self._map, self._map_size)
+
+    def __len__(self):
+        return self.header.n_sents
+
+    def __getitem__(self, size_t i):
+        if i >= self.header.n_sents:
+            raise IndexError(i)
+        return self.get(i)
+
+    def __iter__(self):
+        cdef size_t i
+        for i in range(self.header.n_sents):
+            yield self.get(i)
+
+    cdef Input get(self, size_t i):
+        cdef Input py_sent = Input.__new__(Input)
+        py_sent._pool = Pool()
+        py_sent._oovs = {}
+        cdef uint64_t start = self.sent_starts[i]
+        cdef uint64_t n = self.sent_starts[i + 1] - start
+        cdef uint64_t first_node = self.node_starts[start]
+        cdef uint64_t n_nodes = self.node_starts[start + n] - first_node
+        cdef Sentence* s = <Sentence*>py_sent._pool.alloc(1, sizeof(Sentence))
+        s.n = n
+        s.tokens = <Token*>py_sent._pool.alloc(n, sizeof(Token))
+        s.lattice = <Step*>py_sent._pool.alloc(n, sizeof(Step))
+        cdef Lexeme** nodes = <Lexeme**>py_sent._pool.alloc(n_nodes, sizeof(Lexeme*))
+        cdef double* probs = <double*>py_sent._pool.alloc(n_nodes, sizeof(double))
+        memcpy(s.tokens, &self.tokens[start], n * sizeof(Token))
+        memcpy(probs, &self.node_probs[first_node], n_nodes * sizeof(double))
+        cdef uint64_t j, k
+        cdef Token* token
+        for j in range(n):
+            token = &s.tokens[j]
+            token.word = self._get_word(<uint64_t>token.word, py_sent)
+            token.tag = self.tags[token.tag]
+            token.label = self.labels[token.label]
+            s.lattice[j].n = self.node_starts[start + j + 1] - self.node_starts[start + j]
+            s.lattice[j].nodes = &nodes[self.node_starts[start + j] - first_node]
+            s.lattice[j].probs = &probs[self.node_starts[start + j] - first_node]
+            for k in range(s.lattice[j].n):
+                s.lattice[j].nodes[k] = self._get_word(
+                    self.node_words[self.node_starts[start + j] + k], py_sent)
+        py_sent.c_sent = s
+        return py_sent
+
+    cdef Lexeme* _get_word(self, uint64_t word_id, Input py_sent) except NULL:
+        if self.words[word_id] != NULL:
+            return self.words[word_id]
+        return index.lexicon.lookup_chars(self._get_chars(word_id - 1),
+                                          self._get_length(word_id - 1),
+                                          py_sent._pool, py_sent._oovs)
+
+    cdef char* _get_chars(self, uint64_t i):
+        return self.strings + self.str_offsets[i]
+
+    cdef int _get_length(self, uint64_t i):
+        return self.str_offsets[i + 1] - self.str_offsets[i]
+
+    cdef bytes _get_string(self, uint64_t i):
+        return self._get_chars(i)[:self._get_length(i)]
@@ -1,4 +1,3 @@
-# cython: profile=True
 """
 MALT-style dependency parser
 """
@@ -8,22 +7,31 @@ import os.path
 from os.path import join as pjoin
 import shutil
 import json
+import multiprocessing
+import time
+import resource
 
 from libc.string cimport memcpy, memset
+from posix.time cimport clock_gettime, timespec, CLOCK_MONOTONIC
 
 from cymem.cymem cimport Pool, Address
 from thinc.typedefs cimport weight_t, class_t, feat_t, atom_t
-from thinc.search cimport Beam, MaxViolation
+from thinc.search cimport Beam, MaxViolation, init_func_t
 
 from _state cimport *
 from sentence cimport Input, Sentence, Token, Step
+from .corpus import Corpus, is_compiled
 
 from tagger cimport Tagger
+from tagger import count_tags, make_tagdict, save_tagdict
+from tagger import TAGDICT_FREQ, TAGDICT_AMBIGUITY
 from util import Config
 
 from thinc.features cimport Extractor
 from thinc.features cimport Feature
 from thinc.features cimport count_feats
+from ._workspace cimport Workspace, init_workspace, extract_feats
+from ._workspace cimport extract_batch, score_batch, find_scores, save_scores
 import _parse_features
 from _parse_features cimport *
 
@@ -32,12 +40,7 @@ cimport index.hashes
 
 from thinc.learner cimport LinearModel
 
-
-include "compile_time_options.pxi"
-IF TRANSITION_SYSTEM == 'arc_eager':
-    from .arc_eager cimport *
-ELSE:
-    from .arc_hybrid cimport *
+from .transition_system cimport *
 
 
 VOCAB_SIZE = 1e6
@@ -52,7 +55,8 @@ def set_debug(val):
 
 def train(train_str, model_dir, n_iter=15, beam_width=8,
           train_tagger=True, feat_set=u'bitags+clusters', feat_thresh=0, seed=0,
-          use_edit=False, use_break=False, use_filler=False):
+          use_edit=False, use_break=False, use_filler=False, n_workers=1,
+          on_iter=None, transition_system=u'arc_eager'):
     """Train a model from a CoNLL-formatted training string, creating a model in
     model_dir.
 
@@ -78,8 +82,7 @@ def train(train_str, model_dir, n_iter=15, beam_width=8,
             clusters+bitags and clusters/bitags will add the "clusters" and "bitags"
             feature sets. The basic feature set is added by default.
         feat_thresh (int): Post-prune the feature set, removing features that occur
-            N or fewer times. This is currently not recommended --- it performs
-            poorly with the ADADELTA training.
+            N or fewer times. This is currently not recommended.
         seed (int): Seed the shuffling of sentences between iterations. This is
             useful to conduct N trials of an experimental configuration, allowing
             significance testing. Variance is often 0.1-0.3% UAS, making this
@@ -89,34 +92,289 @@ def train(train_str, model_dir, n_iter=15, beam_width=8,
             parsing.
         use_break (bint): Controls whether to use the Break transition, for
             speech parsing.
+        n_workers (int): Train with iterative parameter mixing, over this many
+            worker processes. In each iteration the sentences are split between
+            workers forked from the current model, and the updates the workers
+            make are averaged into it. The sentences of an iteration are held
+            in memory. Default 1, which trains in this process.
+        on_iter (callable): Called after each iteration with a dict of
+            training metrics: throughput, time per phase, update rates,
+            feature counts and memory use. See _iter_metrics.
+        transition_system (unicode): u'arc_eager' or u'arc_hybrid'. Saved in
+            the model's config, so models of both kinds can be loaded by the
+            same build.
+
+    Tags and labels are coded by process-wide indexes, which a model saves
+    and Parser loads, so models can only share a process if their codes
+    agree. Models trained in the same process do. Loading a model that
+    gives a tag or label a different code from a model that's already
+    loaded raises ValueError.
         """
+    return train_sents(list(Input.iter_conll_str(train_str)), model_dir,
+                       n_iter=n_iter, beam_width=beam_width,
+                       train_tagger=train_tagger, feat_set=feat_set,
+                       feat_thresh=feat_thresh, seed=seed, use_edit=use_edit,
+                       use_break=use_break, use_filler=use_filler,
+                       n_workers=n_workers, on_iter=on_iter,
+                       transition_system=transition_system)
+
+
+def train_sents(list sents, model_dir, n_iter=15, beam_width=8,
+                train_tagger=True, feat_set=u'bitags+clusters', feat_thresh=0,
+                seed=0, use_edit=False, use_break=False, use_filler=False,
+                n_workers=1, on_iter=None, transition_system=u'arc_eager'):
+    """Train a model from a list of Input objects, like train. The sentences'
+    tags are overwritten by the tagger during training."""
+    indices = list(range(len(sents)))
+    def get_iter(n):
+        if n >= 1:
+            random.shuffle(indices)
+        return [sents[i] for i in indices]
+    return _train(model_dir, get_labels(sents), get_iter, n_iter=n_iter,
+                  beam_width=beam_width, train_tagger=train_tagger,
+                  feat_set=feat_set, feat_thresh=feat_thresh, seed=seed,
+                  use_break=use_break, n_workers=n_workers, on_iter=on_iter,
+                  transition_system=transition_system)
+
+
+def train_stream(train_loc, model_dir, n_iter=15, beam_width=8,
+                 train_tagger=True, feat_set=u'bitags+clusters', feat_thresh=0,
+                 seed=0, use_edit=False, use_break=False, use_filler=False,
+                 shuffle_buffer=10000, n_workers=1, on_iter=None,
+                 transition_system=u'arc_eager'):
+    """Train a model from a CoNLL-formatted file, like train, but without
+    holding the corpus in memory. The file is read once to find the labels,
+    and then again in each iteration. The file can also be a corpus compiled
+    by redshift.corpus.compile_corpus, which is memory-mapped instead.
+
+    Args:
+        train_loc (bytes): The path of the CoNLL-formatted training file.
+        model_dir (bytes): The path that the model will be saved in.
+        shuffle_buffer (int): After the first iteration, sentences are
+            shuffled within a window of this many, so memory use depends on
+            this, not the size of the corpus. A compiled corpus is shuffled
+            whole, as it can be read in any order. The shuffle is seeded by seed.
+
+    The other arguments are as for train.
+    """
+    rng = random.Random(seed)
+    if is_compiled(train_loc):
+        corpus = Corpus(train_loc)
+        order = list(range(len(corpus)))
+        def get_iter(n):
+            if n >= 1:
+                rng.shuffle(order)
+            return (corpus[i] for i in order)
+        sents = corpus
+    else:
+        def get_iter(n):
+            sents = Input.iter_conll(train_loc)
+            if n >= 1:
+                sents = _shuffle_window(sents, shuffle_buffer, rng)
+            return sents
+        sents = Input.iter_conll(train_loc)
+    return _train(model_dir, get_labels(sents), get_iter,
+                  n_iter=n_iter, beam_width=beam_width, train_tagger=train_tagger,
+                  feat_set=feat_set, feat_thresh=feat_thresh, seed=seed,
+                  use_break=use_break, n_workers=n_workers, on_iter=on_iter,
+                  transition_system=transition_system)
+
+
+def train_trials(train_loc, out_dir, trials, dev_loc=None, n_workers=None):
+    """Train a model for each of several configurations, e.g. seeds for a
+    significance test, or feature sets, on a pool of worker processes. The
+    corpora are read once, and the workers are forked from this process, so
+    they share them instead of reloading them. Each trial gets a fresh worker,
+    so the trials don't see each other's index.hashes entries, or the tags
+    training writes into the sentences.
 
+    Args:
+        train_loc (bytes): A CoNLL file, or a corpus compiled by
+            redshift.corpus.compile_corpus.
+        out_dir (bytes): Each trial's model is saved in a directory in here.
+        trials (list[dict]): Keyword arguments to train_sents for each trial.
+            A 'name' key names the trial's directory, which is otherwise
+            trial<i>. The seed seeds the shuffling of the sentences.
+        dev_loc (bytes): A CoNLL file or compiled corpus to evaluate each model
+            on. Optional.
+        n_workers (int): The number of worker processes. Defaults to the number
+            of CPUs.
+
+    Returns:
+        report (list[dict]): For each trial, its name, config, training time
+            and, with a dev_loc, its UAS, LAS and parsing time. The report is
+            also saved in out_dir/report.json.
+    """
+    global _TRIAL_JOB
+    if not os.path.exists(out_dir):
+        os.mkdir(out_dir)
+    jobs = []
+    for i, config in enumerate(trials):
+        config = dict(config)
+        name = config.pop('name', 'trial%d' % i)
+        jobs.append((name, config))
+    # Set before the pool forks, so the workers inherit the corpora without
+    # pickling them.
+    _TRIAL_JOB = (_read_corpus(train_loc), _read_corpus(dev_loc) if dev_loc else [],
+                  out_dir)
+    pool = multiprocessing.Pool(n_workers, maxtasksperchild=1)
+    try:
+        report = pool.map(_run_trial, jobs, chunksize=1)
+    finally:
+        pool.close()
+        pool.join()
+        _TRIAL_JOB = None
+    with open(pjoin(out_dir, 'report.json'), 'w') as file_:
+        json.dump(report, file_, indent=2)
+    return report
+
+
+def _train_mixed(Parser parser, list sents, int n_workers, bint train_tagger):
+    '''Train for one iteration with iterative parameter mixing (McDonald et al.,
+    2010). The workers are forked from this process, so they start from the
+    current weights, and each trains on every n_workers-th sentence. Their
+    updates are then made here, scaled by 1/n_workers. LinearModel.update
+    is a perceptron update, which adds the update to the weights, so this
+    moves the weights to the average of the workers'. See _mix_updates.
+    The updates are interleaved in the order they were made, so the
+    averaging sees a time step for each one, as in serial training.'''
+    global _TRAIN_JOB
+    # Each shard needs a fork of the current model, so a worker can't be
+    # reused for a second shard.
+    _TRAIN_JOB = (parser, sents, n_workers, train_tagger)
+    pool = multiprocessing.Pool(n_workers, maxtasksperchild=1)
+    try:
+        shards = pool.map(_train_shard, range(n_workers), chunksize=1)
+    finally:
+        pool.close()
+        pool.join()
+        _TRAIN_JOB = None
+    _mix_updates(parser.guide, [shard[0] for shard in shards])
+    _mix_updates(parser.tagger.guide, [shard[1] for shard in shards])
+    cdef dict stats = parser._stats
+    for _, _, n_corr, total, tag_n_corr, tag_total, shard_stats in shards:
+        parser.guide.n_corr += n_corr
+        parser.guide.total += total
+        parser.tagger.guide.n_corr += tag_n_corr
+        parser.tagger.guide.total += tag_total
+        for key, value in shard_stats.items():
+            stats[key] += value
+    parser._stats = stats
+
+
+cdef int _train_one(Parser parser, Input py_sent, bint train_tagger) except -1:
+    parser.train_sent(py_sent)
+    cdef double start
+    if train_tagger:
+        start = _now()
+        parser.tagger.train_sent(py_sent)
+        parser._stats.tagger += _now() - start
+
+
+def _iter_metrics(Parser parser, int n, double seconds):
+    '''Get the metrics passed to train's on_iter callback, for iteration n.
+    The phase times are in seconds, and in parallel training they're summed
+    over the workers. advance_beam includes fill_costs, and tagger includes
+    training the tagger and tagging the parser's input.'''
+    cdef TrainStats stats = parser._stats
+    return {
+        'iter': n,
+        'seconds': seconds,
+        'sents': stats.n_sents,
+        'tokens': stats.n_tokens,
+        'sents_per_sec': stats.n_sents / seconds if seconds else 0.0,
+        'tokens_per_sec': stats.n_tokens / seconds if seconds else 0.0,
+        'parser_acc': float(parser.guide.n_corr) / (parser.guide.total or 1),
+        'tagger_acc': float(parser.tagger.guide.n_corr) / (parser.tagger.guide.total or 1),
+        'phases': {
+            'advance_beam': stats.advance_beam,
+            'fill_costs': stats.fill_costs,
+            'count_feats': stats.count_feats,
+            'update': stats.update,
+            'tagger': stats.tagger
+        },
+        # The share of sentences where the max-violation search found a
+        # violation, and of those, the share where it was before the last step.
+        'violation_rate': float(stats.n_violations) / (stats.n_sents or 1),
+        'early_update_rate': float(stats.n_early) / (stats.n_violations or 1),
+        'updated_feats': stats.n_feats,
+        # The share of states whose scores came from the memo. See find_scores
+        'memo_hit_rate': float(stats.memo_hits) / (stats.memo_lookups or 1),
+        'model_feats': parser.guide.weights.c_map.filled,
+        'tagger_feats': parser.tagger.guide.weights.c_map.filled,
+        'max_rss_kb': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    }
+
+
+cdef inline double _now() nogil:
+    cdef timespec ts
+    clock_gettime(CLOCK_MONOTONIC, &ts)
+    return ts.tv_sec + ts.tv_nsec * 1e-9
+
+
+def _mix_updates(LinearModel guide, list shard_updates):
+    '''Make each shard's updates to guide, scaled by 1/len(shard_updates). If
+    each shard's updates were made to a copy of guide, guide ends up with
+    the mean of the copies' weights. That relies on the update being added
+    to the weights, with nothing adaptive about it.'''
+    cdef double scale = 1.0 / len(shard_updates)
+    cdef list updates
+    cdef size_t i
+    for i in range(max([len(updates) for updates in shard_updates])):
+        for updates in shard_updates:
+            if i < len(updates):
+                guide.update(dict((clas, dict((key, upd * scale) for key, upd
+                                              in feat_counts.items()))
+                                  for clas, feat_counts in updates[i].items()))
+
+
+def _read_corpus(loc):
+    if is_compiled(loc):
+        return list(Corpus(loc))
+    else:
+        return list(Input.iter_conll(loc))
+
+
+def _train(model_dir, labels, get_iter, n_iter=15, beam_width=8, train_tagger=True,
+           feat_set=u'bitags+clusters', feat_thresh=0, seed=0, use_break=False,
+           n_workers=1, on_iter=None, transition_system=u'arc_eager'):
+    """Train a model in model_dir. get_iter(n) gives the sentences for iteration n."""
+    left_labels, right_labels, dfl_labels = labels
+    get_system(transition_system)
     if os.path.exists(model_dir):
         shutil.rmtree(model_dir)
     os.mkdir(model_dir)
-    cdef list sents = [Input.from_conll(s) for s in
-                       train_str.strip().split('\n\n') if s.strip()]
-    left_labels, right_labels, dfl_labels = get_labels(sents)
     Config.write(model_dir, 'config', beam_width=beam_width, features=feat_set,
                  feat_thresh=feat_thresh, seed=seed,
                  left_labels=left_labels, right_labels=right_labels,
                  train_tagger=train_tagger,
-                 dfl_labels=dfl_labels, use_break=use_break)
+                 dfl_labels=dfl_labels, use_break=use_break,
+                 transition_system=transition_system)
     Config.write(model_dir, 'tagger', beam_width=4, features='basic',
-                 feat_thresh=5, tags={})
-    parser = Parser(model_dir)
-    indices = list(range(len(sents)))
+                 feat_thresh=5, tags={}, tagdict_freq=TAGDICT_FREQ,
+                 tagdict_ambiguity=TAGDICT_AMBIGUITY)
     cdef Input py_sent
+    if train_tagger:
+        # The first iteration isn't shuffled, so this doesn't change the order
+        tag_counts = {}
+        for py_sent in get_iter(0):
+            count_tags(tag_counts, py_sent)
+        save_tagdict(model_dir, make_tagdict(tag_counts, TAGDICT_FREQ,
+                                             TAGDICT_AMBIGUITY))
+    cdef Parser parser = Parser(model_dir)
     for n in range(n_iter):
-        for i in indices:
-            py_sent = sents[i]
-            parser.train_sent(py_sent)
-            if train_tagger:
-                parser.tagger.train_sent(py_sent)
+        memset(&parser._stats, 0, sizeof(TrainStats))
+        start = time.time()
+        if n_workers > 1:
+            _train_mixed(parser, list(get_iter(n)), n_workers, train_tagger)
+        else:
+            for py_sent in get_iter(n):
+                _train_one(parser, py_sent, train_tagger)
         acc = float(parser.guide.n_corr) / parser.guide.total
+        if on_iter is not None:
+            on_iter(_iter_metrics(parser, n, time.time() - start))
         print(parser.guide.end_train_iter(n, feat_thresh) + '\t' +
               parser.tagger.guide.end_train_iter(n, feat_thresh))
-        random.shuffle(indices)
     parser.guide.end_training()
     parser.tagger.guide.end_training()
     parser.guide.dump(pjoin(model_dir, 'model'), freq_thresh=0)
@@ -126,6 +384,22 @@ def train(train_str, model_dir, n_iter=15, beam_width=8,
     return acc
 
 
+def _shuffle_window(items, size, rng):
+    """Shuffle items with a buffer of at most size, yielding a random item from
+    the buffer as each new one comes in."""
+    buffer_ = []
+    for item in items:
+        if len(buffer_) < size:
+            buffer_.append(item)
+            continue
+        i = rng.randrange(size)
+        yield buffer_[i]
+        buffer_[i] = item
+    rng.shuffle(buffer_)
+    for item in buffer_:
+        yield item
+
+
 def get_labels(sents):
     '''Get alphabetically-sorted lists of left, right and disfluency labels that
     occur in a sample of sentences. Used to determine the set of legal transitions
@@ -153,7 +427,7 @@ def get_labels(sents):
     return list(sorted(left_labels)), list(sorted(right_labels)), list(sorted(dfl_labels))
 
 
-def get_templates(feats_str):
+def get_templates(feats_str, transition_system=u'arc_eager'):
     '''Interpret feats_str, returning a list of template tuples. Each template
     is a tuple of numeric indices, referring to positions in the context
     array. See _parse_features.pyx for examples. The templates are applied by
@@ -161,11 +435,10 @@ def get_templates(feats_str):
     the resulting array, to produce a single feature code.
     '''
     match_feats = []
-    # This value comes out of compile_time_options.pxi
-    IF TRANSITION_SYSTEM == 'arc_eager':
-        templates = _parse_features.arc_eager
-    ELSE:
+    if get_system(transition_system) == ARC_HYBRID:
         templates = _parse_features.arc_hybrid
+    else:
+        templates = _parse_features.arc_eager
     if 'disfl' in feats_str:
         templates += _parse_features.disfl
         templates += _parse_features.new_disfl
@@ -182,6 +455,49 @@ def get_templates(feats_str):
     return templates
 
 
+cdef struct _BeamArgs:
+    Sentence* sent
+    Arena* arena
+
+
+cdef struct _MoveArgs:
+    System system
+    Transition* moves
+
+
+cdef struct _StateCache:
+    Sentence* sent
+    State** states
+    size_t length
+    size_t i
+
+
+cdef struct ParseCounts:
+    size_t n_sents
+    size_t n_tokens
+    size_t n_steps
+    size_t n_sampled
+    size_t memo_lookups
+    size_t memo_hits
+    double tag_seconds
+    double search_seconds
+
+
+cdef struct TrainStats:
+    size_t n_sents
+    size_t n_tokens
+    size_t n_violations
+    size_t n_early
+    size_t n_feats
+    size_t memo_lookups
+    size_t memo_hits
+    double advance_beam
+    double fill_costs
+    double count_feats
+    double update
+    double tagger
+
+
 cdef class Parser:
     cdef object cfg
     cdef Pool _pool
@@ -189,24 +505,30 @@ cdef class Parser:
     cdef LinearModel guide
     cdef Tagger tagger
     cdef Transition* moves
-    cdef atom_t* _context
     cdef size_t nr_moves
+    cdef System system
+    cdef list _updates
+    cdef TrainStats _stats
+    cdef ParseCounts _counts
+    cdef size_t _sample_every
 
     def __init__(self, model_dir):
         assert os.path.exists(model_dir) and os.path.isdir(model_dir)
         self.cfg = Config.read(model_dir, 'config')
-        self.extractor = Extractor(get_templates(self.cfg.features))
+        # Models from before the system was configurable are arc-eager
+        system_name = getattr(self.cfg, 'transition_system', u'arc_eager')
+        self.system = get_system(system_name)
+        self.extractor = Extractor(get_templates(self.cfg.features, system_name))
         self._pool = Pool()
-        self._context = <atom_t*>self._pool.alloc(_parse_features.context_size(),
-                                                  sizeof(atom_t))
 
         if os.path.exists(pjoin(model_dir, 'labels')):
             index.hashes.load_label_idx(pjoin(model_dir, 'labels'))
-        self.nr_moves = get_nr_moves(self.cfg.left_labels, self.cfg.right_labels,
-                                     self.cfg.dfl_labels, self.cfg.use_break)
+        self.nr_moves = get_nr_moves(self.system, self.cfg.left_labels,
+                                     self.cfg.right_labels, self.cfg.dfl_labels,
+                                     self.cfg.use_break)
         self.moves = <Transition*>self._pool.alloc(self.nr_moves, sizeof(Transition))
-        fill_moves(self.cfg.left_labels, self.cfg.right_labels, self.cfg.dfl_labels,
-                   self.cfg.use_break, self.moves)
+        fill_moves(self.system, self.cfg.left_labels, self.cfg.right_labels,
+                   self.cfg.dfl_labels, self.cfg.use_break, self.moves)
         
         self.guide = LinearModel(self.nr_moves, self.extractor.n_templ)
         if os.path.exists(pjoin(model_dir, 'model')):
@@ -221,18 +543,128 @@ cdef class Parser:
         Args:
             py_sent (Input): The sentence to be parsed.
         '''
+        cdef Pool mem = Pool()
+        cdef _BeamArgs args
+        args.sent = py_sent.c_sent
+        args.arena = new_arena(args.sent.n, mem)
+        cdef Workspace* ws = self._init_workspace(mem)
+        cdef Transition* moves = self._copy_moves(mem)
+        self._parse(py_sent, _init_callback, &args, ws, moves)
+        self._counts.memo_lookups += ws.n_lookups
+        self._counts.memo_hits += ws.n_hits
+
+    def parse_batch(self, sentences):
+        '''Parse a sequence of sentences, setting heads, labels and tags in-place.
+        The parses are the same as calling parse on each sentence, but the
+        beam's state memory is allocated once for the batch and reused, and the
+        sentences are visited in order of length.
+
+        Args:
+            sentences (list[Input]): The sentences to be parsed.
+        '''
+        cdef list by_length = sorted(sentences, key=lambda sent: sent.length)
+        if not by_length:
+            return 0
+        cdef Pool mem = Pool()
+        cdef _StateCache cache
+        cache.length = 2 * self.cfg.beam_width
+        cache.states = <State**>mem.alloc(cache.length, sizeof(State*))
+        cdef Arena* arena = new_arena(by_length[-1].length, mem)
+        cdef size_t i
+        for i in range(cache.length):
+            cache.states[i] = new_state(arena, mem)
+        # The weights don't change during the batch, so the scores memo is
+        # shared by its sentences.
+        cdef Workspace* ws = self._init_workspace(mem)
+        cdef Transition* moves = self._copy_moves(mem)
+        cdef Input py_sent
+        for py_sent in by_length:
+            cache.sent = py_sent.c_sent
+            cache.i = 0
+            self._parse(py_sent, _reuse_callback, &cache, ws, moves)
+        self._counts.memo_lookups += ws.n_lookups
+        self._counts.memo_hits += ws.n_hits
+        return len(by_length)
+
+    def parse_parallel(self, sentences, n_workers, chunk_size=64):
+        '''Parse a sequence of sentences over a pool of worker processes, setting
+        heads, labels and tags in-place. The workers are forked from this process,
+        so they share the loaded model copy-on-write instead of reloading it.
+        Chunks of sentences are parsed with parse_batch, and the parses are
+        copied back in input order.
+
+        Args:
+            sentences (list[Input]): The sentences to be parsed.
+            n_workers (int): The number of worker processes. With 1 or fewer,
+                parse in this process.
+            chunk_size (int): The number of sentences sent to a worker at a time.
+        '''
+        global _WORKER_JOB
+        if n_workers <= 1:
+            return self.parse_batch(sentences)
+        sentences = list(sentences)
+        chunks = [(start, min(start + chunk_size, len(sentences)))
+                  for start in range(0, len(sentences), chunk_size)]
+        # Set before the pool forks, so the workers inherit the parser and the
+        # sentences without pickling them.
+        _WORKER_JOB = (self, sentences)
+        pool = multiprocessing.Pool(n_workers)
+        try:
+            for (start, end), parses in zip(chunks, pool.imap(_parse_chunk, chunks)):
+                for i, parse in enumerate(parses):
+                    _set_parse(sentences[start + i], parse)
+        finally:
+            pool.close()
+            pool.join()
+            _WORKER_JOB = None
+        return len(sentences)
+
+    def get_counters(self):
+        '''Get counts of the work done by parse, parse_batch and parse_parallel
+        since the parser was loaded or reset_counters was called: sentences,
+        tokens, beam steps, states scored (memo_lookups), and how many of those
+        reused another state's scores (memo_hits). Work done in
+        parse_parallel's workers isn't counted. If set_sample_rate is on, the
+        counters also have the time spent tagging and searching, summed over
+        the sampled sentences. These are cheap enough to leave on in
+        production.'''
+        return self._counts
+
+    def reset_counters(self):
+        memset(&self._counts, 0, sizeof(ParseCounts))
+
+    def set_sample_rate(self, size_t every):
+        '''Time every Nth sentence parsed, adding to the tag_seconds and
+        search_seconds counters. 0, the default, times none. This is a light
+        alternative to a profiling build (see setup.py) for a running parser.'''
+        self._sample_every = every
+
+    cdef int _parse(self, Input py_sent, init_func_t init_func, void* init_args,
+                    Workspace* ws, Transition* moves) except -1:
         cdef Sentence* sent = py_sent.c_sent
-        cdef Token* gold_parse = sent.tokens
+        self._counts.n_sents += 1
+        self._counts.n_tokens += sent.n
+        cdef bint sample = (self._sample_every != 0 and
+                            self._counts.n_sents % self._sample_every == 0)
+        cdef double start = _now() if sample else 0
         if self.cfg.train_tagger:
             self.tagger.tag(py_sent)
+        if sample:
+            self._counts.tag_seconds += _now() - start
+            start = _now()
+        cdef Address words_mem = Address(sent.n * N_WORD_ATOMS, sizeof(atom_t))
+        cdef atom_t* words = <atom_t*>words_mem.ptr
+        fill_word_atoms(words, sent)
         cdef Beam beam = Beam(self.nr_moves, self.cfg.beam_width)
-        beam.initialize(_init_callback, sent.n, sent)
-        self.guide.cache.flush()
-        cdef int i
+        beam.initialize(init_func, sent.n, init_args)
         while not beam.is_done:
-            self._advance_beam(beam, NULL, False)
+            self._advance_beam(beam, NULL, False, words, ws, moves)
+            self._counts.n_steps += 1
         _fill_parse(sent.tokens, <State*>beam.at(0))
         sent.score = beam.score
+        if sample:
+            self._counts.search_seconds += _now() - start
+            self._counts.n_sampled += 1
 
     cpdef int train_sent(self, Input py_sent) except -1:
         '''Receive a training example, and update weights if the prediction
@@ -255,105 +687,278 @@ cdef class Parser:
         cdef int i
         for i in range(sent.n):
             gold_tags[i] = gold_parse[i].tag
+        cdef double start = _now()
         if self.cfg.train_tagger:
             self.tagger.tag(py_sent)
+        self._stats.tagger += _now() - start
+        cdef Pool mem = Pool()
+        cdef atom_t* words = <atom_t*>mem.alloc(sent.n * N_WORD_ATOMS, sizeof(atom_t))
+        fill_word_atoms(words, sent)
+        cdef _BeamArgs args
+        args.sent = sent
+        args.arena = new_arena(sent.n, mem)
         cdef Beam p_beam = Beam(self.nr_moves, self.cfg.beam_width)
         cdef Beam g_beam = Beam(self.nr_moves, self.cfg.beam_width)
-        p_beam.initialize(_init_callback, sent.n, sent)
-        g_beam.initialize(_init_callback, sent.n, sent)
+        p_beam.initialize(_init_callback, sent.n, &args)
+        g_beam.initialize(_init_callback, sent.n, &args)
 
         cdef MaxViolation violn = MaxViolation()
 
-        self.guide.cache.flush()
-        cdef Transition* m
-        cdef State* state
+        cdef GoldParse* gold = init_gold(gold_parse, sent.n, mem)
+        cdef Workspace* ws = self._init_workspace(mem)
+        cdef Transition* moves = self._copy_moves(mem)
+        cdef size_t n_steps = 0
+        start = _now()
         while not p_beam.is_done and not g_beam.is_done:
-            self._advance_beam(p_beam, gold_parse, False)
-            self._advance_beam(g_beam, gold_parse, True)
+            self._advance_beam(p_beam, gold, False, words, ws, moves)
+            self._advance_beam(g_beam, gold, True, words, ws, moves)
             violn.check(p_beam, g_beam)
+            n_steps += 1
+        self._stats.advance_beam += _now() - start
        
         is_true = p_beam._states[0].loss == 0
         counts = {}
         if not is_true:
-            self._count_feats(counts, sent, violn.g_hist, 1)
-            self._count_feats(counts, sent, violn.p_hist, -1)
+            start = _now()
+            self._count_feats(counts, sent, violn.g_hist, 1, words, ws)
+            self._count_feats(counts, sent, violn.p_hist, -1, words, ws)
+            self._stats.count_feats += _now() - start
+            start = _now()
             self.guide.update(counts)
+            self._stats.update += _now() - start
+            for feat_counts in counts.values():
+                self._stats.n_feats += len(feat_counts)
         else:
             self.guide.update({})
+        if violn.cost != 0:
+            self._stats.n_violations += 1
+            self._stats.n_early += len(violn.p_hist) < n_steps
+        self._stats.n_sents += 1
+        self._stats.n_tokens += sent.n
+        self._stats.memo_lookups += ws.n_lookups
+        self._stats.memo_hits += ws.n_hits
+        if self._updates is not None:
+            # Kept for parameter mixing. See _train_mixed
+            self._updates.append(counts)
         for i in range(sent.n):
             sent.tokens[i].tag = gold_tags[i]
         self.guide.n_corr += is_true
         self.guide.total += 1
         return is_true
 
-    cdef int _advance_beam(self, Beam beam, Token* gold_parse, bint follow_gold) except -1:
+    cdef Workspace* _init_workspace(self, Pool mem) except NULL:
+        # The memo holds a few steps' worth of states, so that the gold and
+        # predicted beams share their scores during training, and states that
+        # converge on the same context later on can reuse them.
+        return init_workspace(mem, self.extractor, self.guide,
+                              _parse_features.context_size(), self.cfg.beam_width,
+                              memo_size=16 * self.cfg.beam_width)
+
+    cdef Transition* _copy_moves(self, Pool mem) except NULL:
+        # The scores, costs and validity are written into the moves, so each
+        # call gets its own copy.
+        cdef Transition* moves = <Transition*>mem.alloc(self.nr_moves, sizeof(Transition))
+        memcpy(moves, self.moves, self.nr_moves * sizeof(Transition))
+        return moves
+
+    cdef int _advance_beam(self, Beam beam, GoldParse* gold, bint follow_gold,
+                           atom_t* words, Workspace* ws, Transition* moves) except -1:
         cdef int i, j
-        for i in range(beam.size):
-            state = <State*>beam.at(i)
-            if is_final(state):
-                continue
-            if gold_parse != NULL:
-                fill_costs(state, self.moves, self.nr_moves, gold_parse)
-            if not follow_gold:
-                fill_valid(state, self.moves, self.nr_moves)
-            self._predict(state, self.moves)
-            for j in range(self.nr_moves):
-                m = &self.moves[j]
-                beam.set_cell(i, j, m.score, m.is_valid, m.cost)
-        beam.advance(_transition_callback, self.moves)
+        cdef int row = 0
+        cdef State* state
+        cdef weight_t* scores
+        cdef double start
+        with nogil:
+            # Fill one row of context per unfinished state, then extract and
+            # score the rows together. A state whose context has been scored
+            # already doesn't keep its row.
+            for i in range(beam.size):
+                state = <State*>beam.at(i)
+                if is_final(state):
+                    continue
+                fill_slots(state)
+                fill_context(&ws.context[row * ws.context_size], &state.slots,
+                             state.sent.tokens, words)
+                if not find_scores(ws, i, row):
+                    row += 1
+            extract_batch(ws, row)
+            score_batch(ws, row)
+            for i in range(beam.size):
+                state = <State*>beam.at(i)
+                if is_final(state):
+                    continue
+                if gold != NULL:
+                    start = _now()
+                    fill_costs(self.system, state, moves, self.nr_moves, gold)
+                    self._stats.fill_costs += _now() - start
+                if not follow_gold:
+                    fill_valid(self.system, state, moves, self.nr_moves)
+                scores = ws.item_scores[i]
+                for j in range(self.nr_moves):
+                    beam.set_cell(i, j, scores[j], moves[j].is_valid, moves[j].cost)
+            save_scores(ws, row)
+        cdef _MoveArgs args
+        args.system = self.system
+        args.moves = moves
+        beam.advance(_transition_callback, &args)
         beam.check_done(_is_done_callback, NULL)
 
-    cdef int _predict(self, State* s, Transition* classes) except -1:
-        if is_final(s):
-            return 0
-        fill_slots(s)
-        fill_context(self._context, &s.slots, s.parse)
-        cdef int n_feats = 0
-        cdef Feature* feats = self.extractor.get_feats(self._context, &n_feats)
-        cdef const weight_t* scores = self.guide.get_scores(feats, n_feats)
-        cdef int i
-        for i in range(self.nr_moves):
-            classes[i].score = scores[i]
-
-    cdef dict _count_feats(self, dict counts, Sentence* sent, list hist, int inc):
-        cdef atom_t* context = self._context
+    cdef dict _count_feats(self, dict counts, Sentence* sent, list hist, int inc,
+                           atom_t* words, Workspace* ws):
         cdef Pool mem = Pool()
         cdef State* state = init_state(sent, mem)
         cdef class_t clas
         cdef int n_feats = 0
-        cdef Feature* feats
         for clas in hist:
             fill_slots(state)
-            fill_context(self._context, &state.slots, state.parse)
-            feats = self.extractor.get_feats(context, &n_feats)
-            count_feats(counts.setdefault(clas, {}), feats, n_feats, inc)
-            transition(&self.moves[clas], state)
+            fill_context(ws.context, &state.slots, state.sent.tokens, words)
+            n_feats = extract_feats(ws)
+            count_feats(counts.setdefault(clas, {}), ws.feats, n_feats, inc)
+            transition(self.system, &self.moves[clas], state)
+
+
+_WORKER_JOB = None
+
+
+def _parse_chunk(bounds):
+    parser, sentences = _WORKER_JOB
+    start, end = bounds
+    chunk = sentences[start:end]
+    parser.parse_batch(chunk)
+    return [_get_parse(sent) for sent in chunk]
+
+
+_TRAIN_JOB = None
+
+
+def _train_shard(shard):
+    cdef Parser parser
+    cdef Input py_sent
+    parser, sents, n_shards, train_tagger = _TRAIN_JOB
+    parser._updates = []
+    parser.tagger._updates = []
+    # Return this shard's counts, rather than totals including what the fork
+    # inherited
+    parser.guide.n_corr = 0
+    parser.guide.total = 0
+    parser.tagger.guide.n_corr = 0
+    parser.tagger.guide.total = 0
+    memset(&parser._stats, 0, sizeof(TrainStats))
+    for py_sent in sents[shard::n_shards]:
+        _train_one(parser, py_sent, train_tagger)
+    return (parser._updates, parser.tagger._updates,
+            parser.guide.n_corr, parser.guide.total,
+            parser.tagger.guide.n_corr, parser.tagger.guide.total,
+            parser._stats)
+
+
+_TRIAL_JOB = None
+
+
+def _run_trial(job):
+    sents, dev_sents, out_dir = _TRIAL_JOB
+    name, config = job
+    model_dir = pjoin(out_dir, name)
+    # train shuffles with the random module, and every worker inherits the
+    # same state from the parent.
+    random.seed(config.get('seed', 0))
+    result = {'name': name, 'config': config}
+    start = time.time()
+    train_sents(sents, model_dir, **config)
+    result['train_time'] = time.time() - start
+    if dev_sents:
+        result.update(_evaluate(Parser(model_dir), dev_sents))
+    return result
+
+
+def _evaluate(Parser parser, list sents):
+    '''Parse the sentences in place, and score them against their original
+    heads and labels, leaving out punctuation and disfluencies.'''
+    gold = [(sent.heads, sent.labels, sent.edits) for sent in sents]
+    start = time.time()
+    parser.parse_batch(sents)
+    parse_time = time.time() - start
+    n = 0
+    u_corr = 0
+    l_corr = 0
+    for sent, (heads, labels, edits) in zip(sents, gold):
+        guess_heads = sent.heads
+        guess_labels = sent.labels
+        for i in range(1, sent.length - 1):
+            if edits[i] or labels[i] in ('P', 'erased') or labels[i].startswith('filler'):
+                continue
+            n += 1
+            if guess_heads[i] == heads[i]:
+                u_corr += 1
+                l_corr += guess_labels[i] == labels[i]
+    return {'uas': 100.0 * u_corr / max(n, 1), 'las': 100.0 * l_corr / max(n, 1),
+            'parse_time': parse_time}
+
+
+cdef tuple _get_parse(Input py_sent):
+    cdef Sentence* sent = py_sent.c_sent
+    cdef Token* t
+    tokens = []
+    for i in range(1, sent.n - 1):
+        t = &sent.tokens[i]
+        tokens.append((t.tag, t.head, t.label, t.left_edge, t.l_valency,
+                       t.r_valency, t.sent_id, t.is_edit))
+    return (sent.score, tokens)
+
+
+cdef int _set_parse(Input py_sent, tuple parse) except -1:
+    cdef Sentence* sent = py_sent.c_sent
+    score, tokens = parse
+    assert len(tokens) == sent.n - 2
+    sent.score = score
+    for i, (tag, head, label, left_edge, l_valency, r_valency, sent_id,
+            is_edit) in enumerate(tokens, 1):
+        sent.tokens[i].tag = tag
+        sent.tokens[i].head = head
+        sent.tokens[i].label = label
+        sent.tokens[i].left_edge = left_edge
+        sent.tokens[i].l_valency = l_valency
+        sent.tokens[i].r_valency = r_valency
+        sent.tokens[i].sent_id = sent_id
+        sent.tokens[i].is_edit = is_edit
 
 
 cdef int _fill_parse(Token* parse, State* s) except -1:
     cdef int i, head 
-    for i in range(1, s.n-1):
-        head = i
-        while s.parse[head].head != head and \
-                s.parse[head].head < (s.n-1) and \
-                s.parse[head].head != 0:
-            head = s.parse[head].head
-        s.parse[i].sent_id = head
     # No need to copy heads for root and start symbols
     for i in range(1, s.n - 1):
-        parse[i] = s.parse[i]
+        parse[i] = get_token(s, i)[0]
+    for i in range(1, s.n-1):
+        head = i
+        while parse[head].head != head and \
+                parse[head].head < (s.n-1) and \
+                parse[head].head != 0:
+            head = parse[head].head
+        parse[i].sent_id = head
 
 
 cdef void* _init_callback(Pool mem, int n, void* extra_args) except NULL:
-    return init_state(<Sentence*>extra_args, mem)
+    args = <_BeamArgs*>extra_args
+    cdef State* s = new_state(args.arena, mem)
+    reset_state(s, args.sent)
+    return s
+
+
+cdef void* _reuse_callback(Pool mem, int n, void* extra_args) except NULL:
+    cache = <_StateCache*>extra_args
+    assert cache.i < cache.length
+    cdef State* s = cache.states[cache.i]
+    cache.i += 1
+    reset_state(s, cache.sent)
+    return s
 
 
 cdef int _transition_callback(void* dest, void* src, class_t clas, void* extra_args) except -1:
     state = <State*>dest
     parent = <State*>src
-    moves = <Transition*>extra_args
+    args = <_MoveArgs*>extra_args
     copy_state(state, parent)
-    transition(&moves[clas], state)
+    transition(args.system, &args.moves[clas], state)
 
 
 cdef int _is_done_callback(void* state, void* extra_args) except -1:
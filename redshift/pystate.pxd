@@ -1,14 +1,9 @@
 from cymem.cymem cimport Pool
-from ._state cimport State
+from ._state cimport State, GoldParse
 from .sentence cimport Input
 from .sentence cimport Token
-
-
-include "compile_time_options.pxi"
-IF TRANSITION_SYSTEM == 'arc_eager':
-    from .arc_eager cimport *
-ELSE:
-    from .arc_hybrid cimport *
+from ._state cimport Transition
+from .transition_system cimport System
 
 cdef class PyState:
     cdef Pool mem
@@ -20,7 +15,9 @@ cdef class PyState:
     cdef list encoded_left
     cdef list encoded_right
     cdef list encoded_dfl
+    cdef System system
     cdef size_t nr_moves
     cdef Transition* moves
     cdef dict moves_by_name
     cdef Token* gold
+    cdef GoldParse* gold_parse
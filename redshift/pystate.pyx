@@ -1,17 +1,14 @@
-from ._state cimport init_state
+from ._state cimport init_state, init_gold
 
 import index.hashes
 
-include "compile_time_options.pxi"
-IF TRANSITION_SYSTEM == 'arc_eager':
-    from .arc_eager cimport *
-ELSE:
-    from .arc_hybrid cimport *
+from .transition_system cimport *
 
 
 cdef class PyState:
     def __cinit__(self, unicode string, list transitions=None, list gold=None,
-                  left_labels=None, right_labels=None, dfl_labels=None):
+                  left_labels=None, right_labels=None, dfl_labels=None,
+                  transition_system=u'arc_eager'):
         if left_labels is None:
             left_labels = ['SUBJ', 'ROOT', 'OTHER']
         if right_labels is None:
@@ -19,6 +16,7 @@ cdef class PyState:
         if dfl_labels is None:
             dfl_labels = ['FILL', 'ERASE']
         self.mem = Pool()
+        self.system = get_system(transition_system)
         self.sent = Input.from_untagged(string.encode('utf8'))
         self.state = init_state(self.sent.c_sent, self.mem)
         self.left_labels = left_labels
@@ -27,13 +25,14 @@ cdef class PyState:
         self.encoded_right = [index.hashes.encode_label(label) for label in self.right_labels]
         self.dfl_labels = dfl_labels
         self.encoded_dfl = [index.hashes.encode_label(label) for label in self.dfl_labels]
-        self.nr_moves = get_nr_moves(self.encoded_left, self.encoded_right,
-                                     self.encoded_dfl, False)
+        self.nr_moves = get_nr_moves(self.system, self.encoded_left,
+                                     self.encoded_right, self.encoded_dfl, False)
         self.moves = <Transition*>self.mem.alloc(self.nr_moves, sizeof(Transition))
-        fill_moves(self.encoded_left, self.encoded_right, self.encoded_dfl, False, self.moves)
+        fill_moves(self.system, self.encoded_left, self.encoded_right,
+                   self.encoded_dfl, False, self.moves)
         self.moves_by_name = {}
         for i in range(self.nr_moves):
-            self.moves_by_name[move_name(&self.moves[i])] = i
+            self.moves_by_name[move_name(self.system, &self.moves[i])] = i
         if transitions is not None:
             for transition in transitions:
                 self.transition(transition)
@@ -44,17 +43,20 @@ cdef class PyState:
                 self.gold[child].label = index.hashes.encode_label(label)
                 if head == child:
                     self.gold[child].is_edit = True
+        self.gold_parse = init_gold(self.gold, self.sent.length, self.mem)
                 
     def transition(self, unicode move_name):
         assert self.is_valid(move_name)
-        transition(&self.moves[self.moves_by_name[move_name]], self.state)
+        transition(self.system, &self.moves[self.moves_by_name[move_name]],
+                   self.state)
 
     def is_valid(self, unicode move_name):
-        fill_valid(self.state, self.moves, self.nr_moves)
+        fill_valid(self.system, self.state, self.moves, self.nr_moves)
         return self.moves[self.moves_by_name[move_name]].is_valid
  
     def is_gold(self, unicode move_name): 
-        fill_costs(self.state, self.moves, self.nr_moves, self.gold)
+        fill_costs(self.system, self.state, self.moves, self.nr_moves,
+                   self.gold_parse)
         return self.moves[self.moves_by_name[move_name]].cost == 0
 
     property top:
@@ -28,8 +28,11 @@ cdef struct Sentence:
     double score
     
 
-cdef Sentence* init_sent(list words_lattice, list parse, Pool pool) except NULL
+cdef Sentence* init_sent(list words_lattice, list parse, Pool pool, dict oovs) except NULL
 
 cdef class Input:
     cdef Pool _pool
     cdef Sentence* c_sent
+    cdef dict _oovs
+
+    cdef bytes _get_str(self, Lexeme* word)
@@ -6,15 +6,20 @@ import index.lexicon
 from index.lexicon cimport Lexeme
 from index.lexicon cimport BLANK_WORD
 
-from index.hashes import encode_pos
-from index.hashes import encode_label
-from index.hashes import decode_pos
-from index.hashes import decode_label
+from index.hashes cimport Index, get_pos_idx, get_label_idx
+from index.hashes cimport encode_pos, encode_label, decode_pos, decode_label
 
 from cymem.cymem cimport Pool
+from preshed.maps cimport PreshMap
+from murmurhash.mrmr cimport hash64
+from libc.stdint cimport uint64_t
+from libc.string cimport memchr
 
 
-cdef Sentence* init_sent(list words_lattice, list parse, Pool pool) except NULL:
+DEF CONLL_CHUNK = 1048576
+
+
+cdef Sentence* init_sent(list words_lattice, list parse, Pool pool, dict oovs) except NULL:
     cdef Sentence* s = <Sentence*>pool.alloc(1, sizeof(Sentence))
     s.n = len(words_lattice)
     assert s.n >= 3, words_lattice
@@ -22,7 +27,7 @@ cdef Sentence* init_sent(list words_lattice, list parse, Pool pool) except NULL:
     s.tokens = <Token*>pool.alloc(s.n, sizeof(Token))
     cdef Token t
     for i in range(s.n):
-        init_lattice_step(words_lattice[i], &s.lattice[i], pool)
+        init_lattice_step(words_lattice[i], &s.lattice[i], pool, oovs)
     cdef bint is_edit
     for i, (word_idx, tag, head, label, sent_id, is_edit) in enumerate(parse):
         s.tokens[i].word = s.lattice[i].nodes[word_idx]
@@ -54,15 +59,13 @@ cdef Sentence* init_sent(list words_lattice, list parse, Pool pool) except NULL:
     return s
 
 
-cdef int init_lattice_step(list lattice_step, Step* step, Pool pool) except -1:
+cdef int init_lattice_step(list lattice_step, Step* step, Pool pool, dict oovs) except -1:
     step.n = len(lattice_step)
     step.nodes = <Lexeme**>pool.alloc(step.n, sizeof(Lexeme*))
     step.probs = <double*>pool.alloc(step.n, sizeof(double))
-    cdef size_t lex_addr
     for i, (p, word) in enumerate(lattice_step):
         step.probs[i] = p
-        lex_addr = index.lexicon.lookup(word)
-        step.nodes[i] = <Lexeme*>lex_addr
+        step.nodes[i] = index.lexicon.lookup_in(word, pool, oovs)
 
 
 cdef class Input:
@@ -73,7 +76,8 @@ cdef class Input:
         lattice.append([(1.0, '<end>')])
         parse.append((0, 'EOL', None, None, False, False))
         self._pool = Pool()
-        self.c_sent = init_sent(lattice, parse, self._pool)
+        self._oovs = {}
+        self.c_sent = init_sent(lattice, parse, self._pool, self._oovs)
 
     @classmethod
     def from_tokens(cls, tokens):
@@ -142,12 +146,31 @@ cdef class Input:
                           is_edit or is_fill or is_ns))
         return cls.from_tokens(tokens)
 
+    @classmethod
+    def iter_conll(cls, loc):
+        """
+        Read a CoNLL file, yielding an Input per sentence. Gives the same
+        sentences as from_conll, but reads the file in chunks, and fills each
+        Sentence straight from the bytes, without building Python tuples for
+        its tokens.
+        """
+        with open(loc, 'rb') as file_:
+            for sent in _iter_conll(iter(lambda: file_.read(CONLL_CHUNK), b'')):
+                yield sent
+
+    @classmethod
+    def iter_conll_str(cls, conll_str):
+        """Like iter_conll, but read the sentences from a string."""
+        if isinstance(conll_str, unicode):
+            conll_str = conll_str.encode('utf8')
+        return _iter_conll([conll_str])
+
     def segment(self):
         cdef size_t i
-        cdef size_t root = encode_label('ROOT')
-        cdef size_t cc = encode_label('cc')
-        cdef size_t conj = encode_label('conj')
-        cdef size_t nsubj = encode_label('nsubj')
+        cdef size_t root = encode_label(b'ROOT')
+        cdef size_t cc = encode_label(b'cc')
+        cdef size_t conj = encode_label(b'conj')
+        cdef size_t nsubj = encode_label(b'nsubj')
         cdef Sentence* sent = self.c_sent
         cdef Token* token
         has_subj = set()
@@ -190,7 +213,7 @@ cdef class Input:
         def __get__(self):
             Token = namedtuple('Token', 'id word tag head label sent_id is_edit')
             for i in range(1, self.c_sent.n - 1):
-                word = index.lexicon.get_str(<size_t>self.c_sent.tokens[i].word)
+                word = self._get_str(self.c_sent.tokens[i].word)
                 tag = decode_pos(self.c_sent.tokens[i].tag)
                 head = self.c_sent.tokens[i].head
                 label = decode_label(self.c_sent.tokens[i].label)
@@ -204,7 +227,7 @@ cdef class Input:
 
     property words:
         def __get__(self):
-            return [index.lexicon.get_str(<size_t>self.c_sent.tokens[i].word)
+            return [self._get_str(self.c_sent.tokens[i].word)
                     for i in range(self.c_sent.n)]
 
     property tags:
@@ -229,12 +252,18 @@ cdef class Input:
         lines = []
         for i in range(1, self.length - 1):
             lines.append(conll_line_from_token(i, &self.c_sent.tokens[i],
-                         self.c_sent.lattice))
+                         self._get_str(self.c_sent.tokens[i].word)))
         return '\n'.join(lines)
 
+    cdef bytes _get_str(self, Lexeme* word):
+        cdef bytes string = index.lexicon.get_str(<size_t>word)
+        if not string:
+            # Not in the lexicon, so the Lexeme is one of ours
+            return self._oovs.get(<size_t>word, string)
+        return string
+
 
-cdef object conll_line_from_token(size_t i, Token* a, Step* lattice):
-    cdef bytes word = index.lexicon.get_str(<size_t>a.word)
+cdef object conll_line_from_token(size_t i, Token* a, bytes word):
     if not word:
         word = b'-OOV-'
     label = decode_label(a.label)
@@ -244,3 +273,260 @@ cdef object conll_line_from_token(size_t i, Token* a, Step* lattice):
     assert tag
     return <bytes>'\t'.join((str(i), word, '_', tag, tag, feats,
                              str(a.head), label, '_', '_'))
+
+
+cdef struct Span:
+    const char* chars
+    int length
+
+
+cdef class _ConllCodes:
+    """Encode the tags and labels in a CoNLL file. Strings already in the
+    index are encoded from the file's buffer, without making bytes objects.
+    Filler labels are cached, as their strings are built."""
+    cdef Index pos_idx
+    cdef Index label_idx
+    cdef PreshMap fillers
+    cdef size_t erased
+    cdef size_t eol
+
+    def __init__(self):
+        self.pos_idx = get_pos_idx()
+        self.label_idx = get_label_idx()
+        self.fillers = PreshMap()
+        self.erased = encode_label(b'erased')
+        self.eol = 0
+
+    cdef size_t tag(self, Span tag) except 0:
+        cdef size_t code = self.pos_idx.encode(tag.chars, tag.length)
+        if code == 0:
+            code = encode_pos(tag.chars[:tag.length])
+        return code
+
+    cdef size_t label(self, Span label) except 0:
+        # Stored labels are normalised, see encode_label
+        cdef size_t code = self.label_idx.encode(label.chars, label.length)
+        if code == 0:
+            code = encode_label(label.chars[:label.length])
+        return code
+
+    cdef size_t filler(self, Span fill_tag) except 0:
+        cdef uint64_t key = hash64(<char*>fill_tag.chars, fill_tag.length, 0)
+        cdef size_t code = <size_t>self.fillers.get(key)
+        if code == 0:
+            code = encode_label(b'filler' + fill_tag.chars[:fill_tag.length])
+            self.fillers.set(key, <void*>code)
+        return code
+
+
+def _iter_conll(chunks):
+    cdef _ConllCodes codes = _ConllCodes()
+    cdef bytes data = b''
+    cdef size_t i, start, end, next_i
+    for chunk in chunks:
+        data = data + chunk
+        i = 0
+        while True:
+            next_i = _find_sentence(data, len(data), i, False, &start, &end)
+            if next_i == 0:
+                break
+            yield _conll_input(<char*>data + start, <char*>data + end, codes)
+            i = next_i
+        data = data[i:]
+    i = 0
+    while True:
+        next_i = _find_sentence(data, len(data), i, True, &start, &end)
+        if next_i == 0:
+            break
+        yield _conll_input(<char*>data + start, <char*>data + end, codes)
+        i = next_i
+
+
+cdef inline bint _is_space(char c) nogil:
+    return c == b' ' or c == b'\t' or c == b'\r' or c == b'\n' or c == b'\v' or c == b'\f'
+
+
+cdef inline bint _is_fill_tag(char c) nogil:
+    return c == b'D' or c == b'E' or c == b'F' or c == b'A'
+
+
+cdef bint _is_blank(const char* line, const char* end) nogil:
+    while line < end:
+        if not _is_space(line[0]):
+            return False
+        line += 1
+    return True
+
+
+cdef inline const char* _line_end(const char* line, const char* end) nogil:
+    cdef const char* eol = <const char*>memchr(line, b'\n', end - line)
+    return eol if eol != NULL else end
+
+
+cdef size_t _find_sentence(const char* chars, size_t length, size_t i, bint at_eof,
+                           size_t* start, size_t* end) nogil:
+    """Find the next sentence from chars[i]. Sentences are separated by blank
+    lines. Set start and end to its offsets, and return the offset after it,
+    or 0 if there's no complete sentence, which there can't be before the end
+    of the data unless at_eof is set."""
+    cdef const char* data_end = chars + length
+    cdef const char* line = chars + i
+    cdef const char* eol
+    # Skip blank lines
+    while line < data_end:
+        eol = _line_end(line, data_end)
+        if not _is_blank(line, eol):
+            break
+        if eol == data_end:
+            return 0
+        line = eol + 1
+    if line >= data_end:
+        return 0
+    start[0] = line - chars
+    while line < data_end:
+        eol = _line_end(line, data_end)
+        if _is_blank(line, eol):
+            end[0] = line - chars
+            return eol - chars
+        if eol == data_end:
+            break
+        line = eol + 1
+    if not at_eof:
+        return 0
+    end[0] = length
+    return length
+
+
+cdef int _split(Span* spans, int max_spans, const char* chars, const char* end,
+                char sep) nogil:
+    """Split chars into spans at sep, or at whitespace if sep is 0, like
+    str.split. Set at most max_spans spans, and return how many there are."""
+    cdef int n = 0
+    cdef const char* c = chars
+    if sep == 0:
+        while c < end:
+            while c < end and _is_space(c[0]):
+                c += 1
+            if c == end:
+                break
+            if n < max_spans:
+                spans[n].chars = c
+            while c < end and not _is_space(c[0]):
+                c += 1
+            if n < max_spans:
+                spans[n].length = c - spans[n].chars
+            n += 1
+    else:
+        while True:
+            if n < max_spans:
+                spans[n].chars = c
+            while c < end and c[0] != sep:
+                c += 1
+            if n < max_spans:
+                spans[n].length = c - spans[n].chars
+            n += 1
+            if c == end:
+                break
+            c += 1
+    return n
+
+
+cdef size_t _read_int(Span span, const char* line, const char* end) except? 0:
+    cdef size_t value = 0
+    cdef int i
+    for i in range(span.length):
+        if not c'0' <= span.chars[i] <= c'9':
+            raise ValueError("Bad number in CoNLL line: %s" % line[:end - line])
+        value = value * 10 + (span.chars[i] - c'0')
+    if span.length == 0:
+        raise ValueError("Bad number in CoNLL line: %s" % line[:end - line])
+    return value
+
+
+cdef Input _conll_input(const char* chars, const char* end, _ConllCodes codes):
+    """Build an Input from the lines of one CoNLL sentence, as from_conll
+    would."""
+    cdef Input py_sent = Input.__new__(Input)
+    py_sent._pool = Pool()
+    py_sent._oovs = {}
+    cdef Pool pool = py_sent._pool
+    cdef const char* line = chars
+    cdef const char* eol
+    cdef size_t n = 2
+    while line < end:
+        eol = _line_end(line, end)
+        if not _is_blank(line, eol):
+            n += 1
+        line = eol + 1
+    cdef Sentence* s = <Sentence*>pool.alloc(1, sizeof(Sentence))
+    s.n = n
+    s.lattice = <Step*>pool.alloc(n, sizeof(Step))
+    s.tokens = <Token*>pool.alloc(n, sizeof(Token))
+    cdef Lexeme** nodes = <Lexeme**>pool.alloc(n, sizeof(Lexeme*))
+    cdef double* probs = <double*>pool.alloc(n, sizeof(double))
+    cdef size_t i
+    for i in range(n):
+        s.lattice[i].n = 1
+        s.lattice[i].nodes = &nodes[i]
+        s.lattice[i].probs = &probs[i]
+        probs[i] = 1.0
+        s.tokens[i].left_edge = i
+    nodes[0] = index.lexicon.lookup_chars(b'<start>', 7, pool, py_sent._oovs)
+    nodes[n - 1] = index.lexicon.lookup_chars(b'<end>', 5, pool, py_sent._oovs)
+    s.tokens[0].word = nodes[0]
+    s.tokens[n - 1].word = nodes[n - 1]
+
+    cdef Span[8] fields
+    cdef Span[4] feats
+    cdef Span[2] sent_id
+    cdef int nr_feats
+    cdef bint is_edit, is_fill
+    cdef Token* token
+    line = chars
+    i = 1
+    while i < n - 1:
+        eol = _line_end(line, end)
+        if _is_blank(line, eol):
+            line = eol + 1
+            continue
+        if _split(fields, 8, line, eol, 0) < 8:
+            raise ValueError("Expected 8 or more fields in CoNLL line: %s" % line[:eol - line])
+        token = &s.tokens[i]
+        nodes[i] = index.lexicon.lookup_chars(fields[1].chars, fields[1].length,
+                                              pool, py_sent._oovs)
+        token.word = nodes[i]
+        token.tag = codes.tag(fields[3])
+        token.head = _read_int(fields[6], line, eol)
+        if token.head == 0:
+            token.head = n - 1
+        elif token.head >= n:
+            raise ValueError("Head out of range in CoNLL line: %s" % line[:eol - line])
+        nr_feats = _split(feats, 4, fields[5].chars, fields[5].chars + fields[5].length, b'|')
+        is_edit = nr_feats >= 3 and feats[2].length == 1 and feats[2].chars[0] == c'1'
+        is_fill = nr_feats >= 2 and feats[1].length == 1 and _is_fill_tag(feats[1].chars[0])
+        if _split(sent_id, 2, feats[0].chars, feats[0].chars + feats[0].length, b'.') >= 2:
+            token.sent_id = _read_int(sent_id[1], line, eol)
+        if is_edit:
+            token.label = codes.erased
+        elif is_fill:
+            token.label = codes.filler(feats[1])
+        else:
+            token.label = codes.label(fields[7])
+        token.is_edit = is_edit or is_fill
+        line = eol + 1
+        i += 1
+    # Encode EOL after the first sentence's tags, as from_conll does, so that
+    # the tags get the same codes.
+    if codes.eol == 0:
+        codes.eol = encode_pos(b'EOL')
+    s.tokens[n - 1].tag = codes.eol
+    # Set left edges
+    cdef size_t gov
+    for i in range(1, n - 1):
+        gov = s.tokens[i].head
+        while i < s.tokens[gov].left_edge:
+            s.tokens[gov].left_edge = i
+            gov = s.tokens[gov].head
+    nodes[0] = &BLANK_WORD
+    py_sent.c_sent = s
+    return py_sent
@@ -2,11 +2,15 @@ from thinc.features cimport Extractor
 from thinc.learner cimport LinearModel
 from redshift.sentence cimport Input, Sentence, Token
 from cymem.cymem cimport Pool
+from preshed.maps cimport PreshMap
 
 from ._tagger_beam cimport Beam, MaxViolation
-from thinc.typedefs cimport atom_t, feat_t, weight_t
+from thinc.typedefs cimport atom_t, feat_t, weight_t, class_t
+from index.lexicon cimport Lexeme
 from thinc.features cimport Feature
 
+from ._workspace cimport Workspace
+
 
 
 cdef class Tagger:
@@ -16,19 +20,28 @@ cdef class Tagger:
     cdef LinearModel guide
     cdef object model_dir
     cdef size_t beam_width
-
-    cdef atom_t* _context
-    cdef weight_t** _beam_scores
+    cdef PreshMap tagdict
+    cdef PreshMap word_tags
+    cdef PreshMap suffix_tags
+    cdef list _updates
 
     cpdef int tag(self, Input py_sent) except -1
     cdef int train_sent(self, Input py_sent) except -1
 
-    cdef int _predict(self, size_t i, TagState* s, Sentence* sent, weight_t* scores) except -1
-    cdef dict _count_feats(self, Sentence* sent, TagState* p, TagState* g, int i)
+    cdef Workspace* _init_workspace(self, Pool mem) except NULL
+    cdef weight_t** _init_beam_scores(self, Pool mem) except NULL
+    cdef TagState* _init_lattice(self, Pool mem, Beam beam, size_t n) except NULL
+    cdef TagSet* _get_tag_set(self, Lexeme* word) nogil
+    cdef int _predict_beam(self, size_t i, void** parents, size_t n, Sentence* sent,
+                           weight_t** beam_scores, Workspace* ws) except -1 nogil
+    cdef int _predict(self, size_t i, TagState* s, Sentence* sent, weight_t* scores,
+                      Workspace* ws) except -1 nogil
+    cdef dict _count_feats(self, Sentence* sent, TagState* p, TagState* g, int i,
+                           Workspace* ws)
 
 
 cdef TagState* extend_state(TagState* s, size_t clas, weight_t score, size_t cost,
-                            Pool pool)
+                            TagState* ext) nogil
 
 cdef inline size_t get_p(TagState* s) nogil
 
@@ -41,3 +54,9 @@ cdef struct TagState:
     TagState* prev
     size_t clas
     size_t length
+
+
+# The tags a word can have, in the constrained mode. See Tagger._get_tag_set
+cdef struct TagSet:
+    class_t n
+    class_t* tags
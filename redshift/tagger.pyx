@@ -1,6 +1,5 @@
-# cython: profile=True
-
-from libc.string cimport memset
+from libc.string cimport memset, memcpy
+from murmurhash.mrmr cimport hash64
 
 import index.hashes
 cimport index.hashes
@@ -14,6 +13,7 @@ from preshed.maps cimport PreshMap
 from ._tagger_features cimport fill_context
 from ._tagger_features import *
 from thinc.features cimport count_feats
+from ._workspace cimport Workspace, init_workspace, extract_feats, score_feats
 
 cimport cython
 import os
@@ -22,8 +22,28 @@ import random
 import shutil
 
 
+# The default thresholds for the tag dictionary. See train. The dictionary is
+# off by default, until its effect on accuracy has been measured on held-out
+# text. 20 is a reasonable frequency threshold to try.
+TAGDICT_FREQ = 0
+TAGDICT_AMBIGUITY = 0.97
+
+
 def train(train_str, model_dir, beam_width=4, features='basic', nr_iter=10,
-          feat_thresh=10):
+          feat_thresh=10, tagdict_freq=TAGDICT_FREQ,
+          tagdict_ambiguity=TAGDICT_AMBIGUITY, lattice_freq=0):
+    '''Train a tagger on train_str, which has a sentence of word/TAG tokens per
+    line, and save it in model_dir.
+
+    With tagdict_freq above 0, words seen at least tagdict_freq times, with
+    their most common tag at least tagdict_ambiguity of the time, go in a tag
+    dictionary. Tagger.tag gives them that tag without scoring them. By
+    default there's no dictionary.
+
+    With lattice_freq above 0, the tagger is constrained: a word seen at least
+    lattice_freq times can only get the tags it was seen with. Other words get
+    the tags seen with their suffix, if it was seen lattice_freq times, or else
+    any tag. See make_tag_lattice.'''
     cdef Input sent
     cdef size_t i
     if path.exists(model_dir):
@@ -32,11 +52,17 @@ def train(train_str, model_dir, beam_width=4, features='basic', nr_iter=10,
     sents = [Input.from_pos(s) for s in train_str.strip().split('\n') if s.strip()]
     # Dict instead of set so json serialisable
     tags = {}
+    tag_counts = {}
     for sent in sents:
         for i in range(sent.c_sent.n):
             tags[sent.c_sent.tokens[i].tag] = 1
+        count_tags(tag_counts, sent)
     Config.write(model_dir, 'tagger', beam_width=beam_width, features=features,
-                 feat_thresh=feat_thresh, tags=tags)
+                 feat_thresh=feat_thresh, tags=tags, tagdict_freq=tagdict_freq,
+                 tagdict_ambiguity=tagdict_ambiguity)
+    save_tagdict(model_dir, make_tagdict(tag_counts, tagdict_freq, tagdict_ambiguity))
+    if lattice_freq:
+        save_tag_lattice(model_dir, *make_tag_lattice(tag_counts, lattice_freq))
     tagger = Tagger(model_dir)
     indices = list(range(len(sents)))
     for n in range(nr_iter):
@@ -51,13 +77,73 @@ def train(train_str, model_dir, beam_width=4, features='basic', nr_iter=10,
     return tagger
 
 
+def count_tags(dict counts, Input py_sent):
+    '''Count how often each word of py_sent has each tag, into counts, a dict
+    of word to a dict of tag code to count.'''
+    cdef Sentence* sent = py_sent.c_sent
+    cdef size_t i, tag
+    # The last token is the end marker, which Tagger.tag doesn't tag
+    for i in range(sent.n - 1):
+        tag = sent.tokens[i].tag
+        if tag != 0:
+            word_counts = counts.setdefault(py_sent._get_str(sent.tokens[i].word), {})
+            word_counts[tag] = word_counts.get(tag, 0) + 1
+
+
+def make_tagdict(dict counts, freq_thresh, ambiguity_thresh):
+    '''Get the words in counts (see count_tags) seen at least freq_thresh
+    times, with their most common tag at least ambiguity_thresh of the time,
+    as a dict of word to tag code.'''
+    tagdict = {}
+    if not freq_thresh:
+        return tagdict
+    for word, tag_freqs in counts.items():
+        total = sum(tag_freqs.values())
+        tag, freq = max(tag_freqs.items(), key=lambda item: item[1])
+        if total >= freq_thresh and float(freq) / total >= ambiguity_thresh:
+            tagdict[word] = tag
+    return tagdict
+
+
+def save_tagdict(model_dir, dict tagdict):
+    with open(path.join(model_dir, 'tagdict'), 'w') as file_:
+        for word, tag in sorted(tagdict.items()):
+            file_.write('%s\t%s\n' % (word, index.hashes.decode_pos(tag)))
+
+
+def make_tag_lattice(dict counts, freq_thresh):
+    '''Get the tags each word in counts (see count_tags) can have, for the
+    words seen at least freq_thresh times, and the same for their suffixes.
+    Returns two dicts, of word to tag codes and of suffix to tag codes.
+    Suffixes are the last three characters, as in Lexeme.suffix.'''
+    word_tags = {}
+    suffix_counts = {}
+    for word, tag_freqs in counts.items():
+        if sum(tag_freqs.values()) >= freq_thresh:
+            word_tags[word] = sorted(tag_freqs)
+        suffix_freqs = suffix_counts.setdefault(word[-3:], {})
+        for tag, freq in tag_freqs.items():
+            suffix_freqs[tag] = suffix_freqs.get(tag, 0) + freq
+    suffix_tags = dict((suffix, sorted(tag_freqs))
+                       for suffix, tag_freqs in suffix_counts.items()
+                       if sum(tag_freqs.values()) >= freq_thresh)
+    return word_tags, suffix_tags
+
+
+def save_tag_lattice(model_dir, dict word_tags, dict suffix_tags):
+    with open(path.join(model_dir, 'taglattice'), 'w') as file_:
+        for kind, tag_sets in (('word', word_tags), ('suffix', suffix_tags)):
+            for string, tags in sorted(tag_sets.items()):
+                file_.write('%s\t%s\t%s\n' % (kind, string, ' '.join(
+                    index.hashes.decode_pos(tag) for tag in tags)))
+
+
 cdef class Tagger:
     def __init__(self, model_dir):
         self.cfg = Config.read(model_dir, 'tagger')
         self._pool = Pool()
         templates = basic + clusters + case + orth
         self.extractor = Extractor(templates)
-        self._context = <atom_t*>self._pool.alloc(context_size(), sizeof(atom_t))
 
         self.beam_width = self.cfg.beam_width
 
@@ -67,23 +153,50 @@ cdef class Tagger:
         self.guide = LinearModel(nr_tag, self.extractor.n_templ)
         if path.exists(path.join(model_dir, 'tagger')):
             self.guide.load(path.join(model_dir, 'tagger'))
-        self._beam_scores = <weight_t**>self._pool.alloc(self.beam_width, sizeof(weight_t*))
-        for i in range(self.beam_width):
-            self._beam_scores[i] = <weight_t*>self._pool.alloc(nr_tag, sizeof(weight_t))
+        # Keyed by the words' hashes, as in Lexeme.orig
+        self.tagdict = PreshMap()
+        cdef bytes word
+        if path.exists(path.join(model_dir, 'tagdict')):
+            for line in open(path.join(model_dir, 'tagdict')):
+                word, tag = line.split()
+                self.tagdict.set(hash64(<char*>word, len(word), 0),
+                                 <void*><size_t>index.hashes.encode_pos(tag))
+        self.word_tags = PreshMap()
+        self.suffix_tags = PreshMap()
+        cdef TagSet* tag_set
+        cdef PreshMap tag_sets
+        if path.exists(path.join(model_dir, 'taglattice')):
+            for line in open(path.join(model_dir, 'taglattice')):
+                kind, word, tags = line.rstrip('\n').split('\t')
+                tags = tags.split()
+                tag_set = <TagSet*>self._pool.alloc(1, sizeof(TagSet))
+                tag_set.n = len(tags)
+                tag_set.tags = <class_t*>self._pool.alloc(len(tags), sizeof(class_t))
+                for i, tag in enumerate(tags):
+                    tag_set.tags[i] = index.hashes.encode_pos(tag)
+                tag_sets = self.word_tags if kind == 'word' else self.suffix_tags
+                tag_sets.set(hash64(<char*>word, len(word), 0), tag_set)
 
     cpdef int tag(self, Input py_sent) except -1:
         cdef Sentence* sent = py_sent.c_sent
-        cdef Beam beam = Beam(self.guide.nr_class, self.beam_width, sizeof(TagState))
+        cdef Pool mem = Pool()
+        cdef Workspace* ws = self._init_workspace(mem)
+        cdef weight_t** beam_scores = self._init_beam_scores(mem)
+        cdef Beam beam = Beam(self.guide.nr_class, self.beam_width)
+        cdef TagState* lattice = self._init_lattice(mem, beam, sent.n)
         cdef size_t p_idx
         cdef TagState* s
-        cdef size_t i, j
+        cdef size_t i, j, tag
         for i in range(sent.n - 1):
+            tag = <size_t>self.tagdict.get(sent.tokens[i].word.orig)
+            if tag != 0:
+                beam_force(beam, tag, &lattice[(i + 1) * self.beam_width])
+                continue
             # Extend beam
-            for j in range(beam.size):
-                # At this point, beam.clas is the _last_ prediction, not the
-                # prediction for this instance
-                self._predict(i, <TagState*>beam.parents[j], sent, self._beam_scores[j])
-            beam_extend(beam, self._beam_scores, 0)
+            with nogil:
+                self._predict_beam(i, beam.parents, beam.size, sent, beam_scores, ws)
+            beam_extend(beam, beam_scores, 0, &lattice[(i + 1) * self.beam_width],
+                        self._get_tag_set(sent.tokens[i].word))
         s = <TagState*>beam.states[0]
         cdef int t = sent.n - 1
         while t >= 1 and s.prev != NULL:
@@ -95,50 +208,102 @@ cdef class Tagger:
         cdef size_t  i, j 
         cdef Sentence* sent = py_sent.c_sent
         cdef size_t nr_class = self.guide.nr_class
-        cdef weight_t* scores = self.guide.scores
         cdef Pool tmp_mem = Pool()
-        cdef Beam beam = Beam(self.guide.nr_class, self.beam_width, sizeof(TagState))
-        cdef TagState* gold = <TagState*>tmp_mem.alloc(1, sizeof(TagState))
+        cdef Workspace* ws = self._init_workspace(tmp_mem)
+        cdef weight_t* scores = ws.scores
+        cdef weight_t** beam_scores = self._init_beam_scores(tmp_mem)
+        cdef Beam beam = Beam(self.guide.nr_class, self.beam_width)
+        cdef TagState* lattice = self._init_lattice(tmp_mem, beam, sent.n)
+        # Gold state i is the gold history after i tags
+        cdef TagState* golds = <TagState*>tmp_mem.alloc(sent.n, sizeof(TagState))
+        cdef TagState* gold = &golds[0]
         cdef MaxViolation violn = MaxViolation()
         cdef TagState* s
         for i in range(sent.n-1):
             # Extend gold
-            self._predict(i, gold, sent, scores)
+            self._predict(i, gold, sent, scores, ws)
             gold = extend_state(gold, sent.tokens[i].tag, scores[sent.tokens[i].tag],
-                                0, tmp_mem)
+                                0, &golds[i + 1])
             # Extend beam
-            for j in range(beam.size):
-                # At this point, beam.clas is the _last_ prediction, not the
-                # prediction for this instance
-                self._predict(i, <TagState*>beam.parents[j], sent, self._beam_scores[j])
-            beam_extend(beam, self._beam_scores, sent.tokens[i].tag)
+            self._predict_beam(i, beam.parents, beam.size, sent, beam_scores, ws)
+            beam_extend(beam, beam_scores, sent.tokens[i].tag,
+                        &lattice[(i + 1) * self.beam_width],
+                        self._get_tag_set(sent.tokens[i].word))
             s = <TagState*>beam.states[0]
             violn.check(s.cost, s.score, gold.score, s, gold, i)
             self.guide.n_corr += (gold.clas == s.clas)
             self.guide.total += 1
         if violn.delta != -1:
             counts = self._count_feats(sent, <TagState*>violn.pred,
-                                       <TagState*>violn.gold, violn.n)
+                                       <TagState*>violn.gold, violn.n, ws)
             self.guide.update(counts)
+            if self._updates is not None:
+                self._updates.append(counts)
 
-    cdef int _predict(self, size_t i, TagState* s, Sentence* sent, weight_t* scores) except -1:
-        fill_context(self._context, sent, s.clas, get_p(s), i)
-        cdef int n_feats = 0
-        cdef Feature* feats = self.extractor.get_feats(self._context, &n_feats)
-        memset(scores, 0, self.guide.nr_class * sizeof(weight_t))
-        self.guide.set_scores(scores, feats, n_feats)
+    cdef Workspace* _init_workspace(self, Pool mem) except NULL:
+        return init_workspace(mem, self.extractor, self.guide, context_size(), 1)
+
+    cdef weight_t** _init_beam_scores(self, Pool mem) except NULL:
+        cdef weight_t** beam_scores = <weight_t**>mem.alloc(self.beam_width, sizeof(weight_t*))
+        cdef size_t i
+        for i in range(self.beam_width):
+            beam_scores[i] = <weight_t*>mem.alloc(self.guide.nr_class, sizeof(weight_t))
+        return beam_scores
+
+    cdef TagState* _init_lattice(self, Pool mem, Beam beam, size_t n) except NULL:
+        # Row i holds the beam after i tags. The backpointers index into
+        # earlier rows, so a sentence's states are one allocation.
+        cdef TagState* lattice = <TagState*>mem.alloc(n * self.beam_width,
+                                                      sizeof(TagState))
+        cdef size_t i
+        for i in range(self.beam_width):
+            beam.parents[i] = &lattice[i]
+        return lattice
+
+    cdef TagSet* _get_tag_set(self, Lexeme* word) nogil:
+        # NULL if the word can have any tag
+        cdef TagSet* tag_set = <TagSet*>self.word_tags.get(word.orig)
+        if tag_set == NULL:
+            tag_set = <TagSet*>self.suffix_tags.get(word.suffix)
+        return tag_set
+
+    cdef int _predict_beam(self, size_t i, void** parents, size_t n, Sentence* sent,
+                           weight_t** beam_scores, Workspace* ws) except -1 nogil:
+        # The features only see the last two tags, so states that agree on them
+        # get the same scores, and are only scored once. This is common when
+        # few tags are possible, as in the constrained mode.
+        cdef size_t j, k
+        cdef TagState* s
+        for j in range(n):
+            # At this point, s.clas is the _last_ prediction, not the
+            # prediction for this instance
+            s = <TagState*>parents[j]
+            k = 0
+            while k < j and not (s.clas == (<TagState*>parents[k]).clas
+                                 and get_p(s) == get_p(<TagState*>parents[k])):
+                k += 1
+            if k < j:
+                memcpy(beam_scores[j], beam_scores[k], self.guide.nr_class * sizeof(weight_t))
+            else:
+                self._predict(i, s, sent, beam_scores[j], ws)
+
+    cdef int _predict(self, size_t i, TagState* s, Sentence* sent, weight_t* scores,
+                      Workspace* ws) except -1 nogil:
+        fill_context(ws.context, sent, s.clas, get_p(s), i)
+        cdef int n_feats = extract_feats(ws)
+        score_feats(scores, ws, n_feats)
 
-    cdef dict _count_feats(self, Sentence* sent, TagState* p, TagState* g, int i):
+    cdef dict _count_feats(self, Sentence* sent, TagState* p, TagState* g, int i,
+                           Workspace* ws):
         if i == -1:
             return {}
-        cdef atom_t* context = self._context
+        cdef atom_t* context = ws.context
         cdef dict counts = {}
         for clas in range(self.guide.nr_class):
             counts[clas] = {} 
         cdef size_t gclas, gprev, gprevprev
         cdef size_t pclas, pprev, prevprev
         cdef int n_feats = 0
-        cdef Feature* feats
         while g != NULL and p != NULL and i >= 0:
             gclas = g.clas
             gprev = get_p(g)
@@ -152,12 +317,12 @@ cdef class Tagger:
                 i -= 1
                 continue
             fill_context(context, sent, gprev, gprevprev, i)
-            feats = self.extractor.get_feats(context, &n_feats)
-            count_feats(counts[g.clas], feats, n_feats, 1)
+            n_feats = extract_feats(ws)
+            count_feats(counts[g.clas], ws.feats, n_feats, 1)
 
             fill_context(context, sent, pprev, pprevprev, i)
-            feats = self.extractor.get_feats(context, &n_feats)
-            count_feats(counts[p.clas], feats, n_feats, -1)
+            n_feats = extract_feats(ws)
+            count_feats(counts[p.clas], ws.feats, n_feats, -1)
             
             g = g.prev
             p = p.prev
@@ -165,25 +330,39 @@ cdef class Tagger:
         return counts
 
 
-cdef int beam_extend(Beam beam, weight_t** ext_scores, size_t gold) except -1:
-    beam.fill(ext_scores)
+cdef int beam_extend(Beam beam, weight_t** ext_scores, size_t gold,
+                     TagState* row, TagSet* tag_set) except -1:
+    if tag_set == NULL:
+        beam.fill(ext_scores)
+    else:
+        beam.fill_classes(ext_scores, tag_set.tags, tag_set.n)
     cdef int i
     cdef size_t clas
     cdef TagState* prev
     beam.size = 0
-    while beam.size < beam.width:
+    # With a tag set, there may be fewer candidates than the beam's width
+    while beam.size < beam.width and beam.n_top != 0:
         i, clas = beam.pop()
         prev = <TagState*>beam.parents[i]
         beam.states[beam.size] = extend_state(prev, clas, ext_scores[i][clas],
-                                              clas != gold, beam.mem)
+                                              clas != gold, &row[beam.size])
         beam.size += 1
     for i in range(beam.size):
         beam.parents[i] = beam.states[i]
 
 
+cdef int beam_force(Beam beam, size_t clas, TagState* row) except -1:
+    # Every state gets the same tag, for a word in the tag dictionary. Its
+    # score isn't computed, so the states keep their order.
+    cdef size_t i
+    for i in range(beam.size):
+        beam.states[i] = extend_state(<TagState*>beam.parents[i], clas, 0, 0, &row[i])
+    for i in range(beam.size):
+        beam.parents[i] = beam.states[i]
+
+
 cdef TagState* extend_state(TagState* s, size_t clas, weight_t score, size_t cost,
-                             Pool pool):
-    ext = <TagState*>pool.alloc(1, sizeof(TagState))
+                            TagState* ext) nogil:
     ext.prev = s
     ext.clas = clas
     ext.score = s.score + score
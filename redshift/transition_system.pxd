@@ -0,0 +1,65 @@
+"""
+Choose between the transition systems at run-time.
+
+Both systems are compiled, and a model names its system in its config. The
+functions here take the system as their first argument, and call that system's
+version of the function. The branch goes the same way for every call a parser
+makes, so it's predicted, and costs next to nothing beside the call itself.
+"""
+from ._state cimport State, GoldParse, Transition
+from . cimport arc_eager
+from . cimport arc_hybrid
+
+
+cdef enum System:
+    ARC_EAGER
+    ARC_HYBRID
+
+
+cdef inline System get_system(name) except *:
+    if name == u'arc_eager':
+        return ARC_EAGER
+    elif name == u'arc_hybrid':
+        return ARC_HYBRID
+    else:
+        raise ValueError("Unknown transition system: %s" % name)
+
+
+cdef inline unicode move_name(System system, Transition* t):
+    if system == ARC_HYBRID:
+        return arc_hybrid.move_name(t)
+    return arc_eager.move_name(t)
+
+
+cdef inline size_t get_nr_moves(System system, list left_labels, list right_labels,
+                                list dfl_labels, bint use_break) except *:
+    if system == ARC_HYBRID:
+        return arc_hybrid.get_nr_moves(left_labels, right_labels, dfl_labels, use_break)
+    return arc_eager.get_nr_moves(left_labels, right_labels, dfl_labels, use_break)
+
+
+cdef inline int fill_moves(System system, list left_labels, list right_labels,
+                           list dfl_labels, bint use_break, Transition* moves) except -1:
+    if system == ARC_HYBRID:
+        return arc_hybrid.fill_moves(left_labels, right_labels, dfl_labels, use_break, moves)
+    return arc_eager.fill_moves(left_labels, right_labels, dfl_labels, use_break, moves)
+
+
+cdef inline int fill_valid(System system, State* s, Transition* classes,
+                           size_t n) except -1 nogil:
+    if system == ARC_HYBRID:
+        return arc_hybrid.fill_valid(s, classes, n)
+    return arc_eager.fill_valid(s, classes, n)
+
+
+cdef inline int fill_costs(System system, State* s, Transition* classes, size_t n,
+                           GoldParse* gold) except -1 nogil:
+    if system == ARC_HYBRID:
+        return arc_hybrid.fill_costs(s, classes, n, gold)
+    return arc_eager.fill_costs(s, classes, n, gold)
+
+
+cdef inline int transition(System system, Transition* t, State* s) except -1 nogil:
+    if system == ARC_HYBRID:
+        return arc_hybrid.transition(t, s)
+    return arc_eager.transition(t, s)
@@ -0,0 +1,46 @@
+#!/usr/bin/env python
+"""
+Run the parser benchmarks, and compare them against a saved baseline. Exits
+with status 1 if any result is worse than the baseline by more than the
+tolerance.
+"""
+import sys
+import plac
+
+import redshift.bench
+
+
+@plac.annotations(
+    out_loc=("Save the results to this file, as JSON", "option", "o", str),
+    baseline_loc=("Compare against results saved by a previous run", "option",
+                  "b", str),
+    tolerance=("Fraction by which a result can be worse than the baseline",
+               "option", "t", float),
+    conll_loc=("CoNLL file to train on and synthesize inputs from. "
+               "Defaults to tests/train.10.conll", "option", "c", str),
+    n_tokens=("Number of tokens per length bucket", "option", "n", int),
+    repeat=("Number of runs per timing, taking the best", "option", "r", int),
+    seed=("Random seed for the synthesized inputs", "option", "s", int)
+)
+def main(out_loc=None, baseline_loc=None, tolerance=0.1, conll_loc=None,
+         n_tokens=3000, repeat=3, seed=0):
+    report = redshift.bench.run(conll_loc, n_tokens=n_tokens, repeat=repeat,
+                                seed=seed)
+    for name, value in sorted(report['results'].items()):
+        print '%s\t%.4g' % (name, value)
+    if out_loc is not None:
+        redshift.bench.save(report, out_loc)
+    if baseline_loc is not None:
+        baseline = redshift.bench.load(baseline_loc)
+        if baseline['settings'] != report['settings']:
+            print "Warning: baseline was run with settings %s" % baseline['settings']
+        regressions = redshift.bench.compare(report, baseline, tolerance)
+        for name, old, new, change in regressions:
+            print 'REGRESSION %s\t%.4g -> %.4g (%+.1f%%)' % (name, old, new, change * 100)
+        if regressions:
+            sys.exit(1)
+        print 'No regressions beyond %.0f%%' % (tolerance * 100)
+
+
+if __name__ == '__main__':
+    plac.call(main)
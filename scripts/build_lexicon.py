@@ -0,0 +1,27 @@
+#!/usr/bin/env python
+"""
+Compile the Brown clusters and case statistics into the binary lexicon that
+index.lexicon memory-maps at import. The output holds raw structs, so build it
+on the platform that will load it.
+"""
+import os.path
+
+import plac
+
+import index.lexicon
+
+
+@plac.annotations(
+    out_loc=("Output location", "positional", None, str),
+    clusters_loc=("Brown cluster file location", "option", "c", str),
+    case_loc=("Case statistics file location", "option", "u", str)
+)
+def main(out_loc=None, clusters_loc=None, case_loc=None):
+    if out_loc is None:
+        out_loc = os.path.join(os.path.dirname(index.lexicon.__file__), 'lexicon.bin')
+    n_words = index.lexicon.build(out_loc, clusters_loc, case_loc)
+    print "Wrote %d words to %s" % (n_words, out_loc)
+
+
+if __name__ == "__main__":
+    plac.call(main)
@@ -0,0 +1,22 @@
+#!/usr/bin/env python
+"""
+Compile a CoNLL file into a binary corpus, which training and evaluation can
+memory-map instead of parsing the text again. The output holds raw structs, so
+compile it on the platform that will read it.
+"""
+import plac
+
+import redshift.corpus
+
+
+@plac.annotations(
+    conll_loc=("CoNLL (input file) location", "positional"),
+    out_loc=("Compiled corpus (output) location", "positional", None, str)
+)
+def main(conll_loc, out_loc):
+    n_sents = redshift.corpus.compile_corpus(conll_loc, out_loc)
+    print "Wrote %d sentences to %s" % (n_sents, out_loc)
+
+
+if __name__ == "__main__":
+    plac.call(main)
@@ -4,6 +4,8 @@ import sys
 import plac
 from collections import defaultdict
 
+import redshift.corpus
+
 def pc(num, den):
     return (num / float(den+1e-100)) * 100
 
@@ -14,8 +16,14 @@ def fmt_acc(label, n, l_corr, u_corr, total_errs):
     return '%s\t%d\t%.3f\t%.3f\t%.3f' % (label, n, l_pc, u_pc, err_pc)
 
 
+def read_sent_strs(loc):
+    if redshift.corpus.is_compiled(str(loc)):
+        return (sent.to_conll() for sent in redshift.corpus.Corpus(str(loc)))
+    return open(str(loc)).read().strip().split('\n\n')
+
+
 def gen_toks(loc):
-    sent_strs = open(str(loc)).read().strip().split('\n\n')
+    sent_strs = read_sent_strs(loc)
     token = None
     i = 0
     for sent_str in sent_strs:
@@ -13,17 +13,21 @@ import redshift.parser
 from redshift.sentence import Input
 
 
-def parse(parser, sentences):
-    for sent in sentences:
-        parser.parse(sent)
+def parse(parser, sentences, n_workers=1):
+    if n_workers > 1:
+        parser.parse_parallel(sentences, n_workers)
+    else:
+        parser.parse_batch(sentences)
 
 
 @plac.annotations(
     profile=("Do profiling", "flag", "p", bool),
     codec=("Input codec", "option", "c", str),
-    debug=("Set debug", "flag", "d", bool)
+    debug=("Set debug", "flag", "d", bool),
+    n_workers=("Number of worker processes", "option", "w", int)
 )
-def main(parser_dir, text_loc, out_dir, codec="utf8", profile=False, debug=False):
+def main(parser_dir, text_loc, out_dir, codec="utf8", profile=False, debug=False,
+         n_workers=1):
     if debug:
         redshift.parser.set_debug(debug)
     if not os.path.exists(out_dir):
@@ -36,13 +40,13 @@ def main(parser_dir, text_loc, out_dir, codec="utf8", profile=False, debug=False
                  enumerate(input_text.split('\n'))
                  if p.strip()]
     if profile:
-        cProfile.runctx("parse(parser, sentences)",
+        cProfile.runctx("parse(parser, sentences, n_workers)",
                         globals(), locals(), "Profile.prof")
         s = pstats.Stats("Profile.prof")
         s.strip_dirs().sort_stats("time").print_stats()
     else:
         t1 = time.time()
-        parse(parser, sentences)
+        parse(parser, sentences, n_workers)
         t2 = time.time()
         print '%d sents took %0.3f ms' % (len(sentences), (t2-t1)*1000.0)
 
@@ -3,6 +3,7 @@ from __future__ import unicode_literals
 
 import plac
 import codecs
+import json
 
 import redshift.parser
 from redshift.sentence import Input
@@ -20,7 +21,17 @@ from redshift.sentence import Input
     feat_set=("Name of feat set [zhang, iso, full]", "option", "x", str),
     n_sents=("Number of sentences to train from", "option", "n", int),
     use_break=("Use the Break transition", "flag", "b", bool),
-    seed=("Random seed", "option", "s", int)
+    seed=("Random seed", "option", "s", int),
+    stream=("Read the training file in each iteration, instead of loading it",
+            "flag", "S", bool),
+    shuffle_buffer=("Number of sentences to shuffle at once when streaming",
+                    "option", "B", int),
+    n_workers=("Number of processes to train on, mixing their weights after "
+               "each iteration", "option", "w", int),
+    metrics_loc=("Write training metrics for each iteration to this file, as "
+                 "JSON lines", "option", "m", str),
+    transition_system=("Transition system [arc_eager, arc_hybrid]", "option", "t",
+                       unicode)
 )
 def main(train_loc, model_loc, n_iter=15,
          codec="utf8",
@@ -28,9 +39,31 @@ def main(train_loc, model_loc, n_iter=15,
          dont_train_tagger=False,
          n_sents=0,
          use_break=False,
-         debug=False, seed=0, beam_width=4):
+         debug=False, seed=0, beam_width=4,
+         stream=False, shuffle_buffer=10000, n_workers=1, metrics_loc=None,
+         transition_system=u'arc_eager'):
     if debug:
         redshift.parser.set_debug(True)
+    on_iter = None
+    if metrics_loc is not None:
+        metrics_file = open(metrics_loc, 'w')
+        def on_iter(metrics):
+            metrics_file.write(json.dumps(metrics) + '\n')
+            metrics_file.flush()
+    if stream:
+        redshift.parser.train_stream(train_loc, model_loc,
+            n_iter=n_iter, seed=seed,
+            beam_width=beam_width,
+            feat_set=feat_set,
+            feat_thresh=feat_thresh,
+            train_tagger=not dont_train_tagger,
+            use_break=use_break,
+            shuffle_buffer=shuffle_buffer,
+            n_workers=n_workers,
+            on_iter=on_iter,
+            transition_system=transition_system
+        )
+        return
     with codecs.open(train_loc, 'r', codec) as file_:
         train_str = file_.read()
     if n_sents != 0:
@@ -43,6 +76,9 @@ def main(train_loc, model_loc, n_iter=15,
         feat_thresh=feat_thresh,
         train_tagger=not dont_train_tagger,
         use_break=use_break,
+        n_workers=n_workers,
+        on_iter=on_iter,
+        transition_system=transition_system
     )
 
 
@@ -0,0 +1,41 @@
+#!/usr/bin/env python
+"""
+Train several models at once, one per seed and feature set, and report their
+accuracy on a development set.
+"""
+import plac
+
+import redshift.parser
+
+
+@plac.annotations(
+    train_loc=("Training (input file) location", "positional"),
+    out_dir=("Directory to write the models and report to", "positional"),
+    dev_loc=("Development (evaluation file) location", "option", "d", str),
+    seeds=("Comma-separated random seeds", "option", "s", str),
+    feat_sets=("Comma-separated feature sets", "option", "x", str),
+    n_iter=("Number of Perceptron iterations", "option", "i", int),
+    beam_width=("Beam width", "option", "k", int),
+    n_workers=("Number of worker processes", "option", "w", int)
+)
+def main(train_loc, out_dir, dev_loc=None, seeds="0,1,2,3",
+         feat_sets="bitags+clusters", n_iter=15, beam_width=8, n_workers=None):
+    trials = []
+    for feat_set in feat_sets.split(','):
+        for seed in seeds.split(','):
+            trials.append({'name': '%s-%s' % (feat_set, seed), 'seed': int(seed),
+                           'feat_set': feat_set, 'n_iter': n_iter,
+                           'beam_width': beam_width})
+    report = redshift.parser.train_trials(train_loc, out_dir, trials,
+                                          dev_loc=dev_loc, n_workers=n_workers)
+    for result in report:
+        if dev_loc:
+            print '%s\tUAS %.2f\tLAS %.2f\ttrain %.1fs\tparse %.1fs' % (
+                result['name'], result['uas'], result['las'],
+                result['train_time'], result['parse_time'])
+        else:
+            print '%s\ttrain %.1fs' % (result['name'], result['train_time'])
+
+
+if __name__ == "__main__":
+    plac.call(main)
@@ -37,12 +37,14 @@ else:
 
 libs = []
 
-c_options = {
-    'transition_system': 'arc_eager'
-}
-with open(path.join(pwd, 'redshift', 'compile_time_options.pxi'), 'w') as file_:
-    for k, v in c_options.iteritems():
-        file_.write("DEF %s = '%s'\n" % (k.upper(), v))
+# Cython's profiling hooks let cProfile see cdef functions, but they slow down
+# every call, so they're only compiled in when asked for, with --profile or
+# REDSHIFT_PROFILE=1. Use build_ext --force when switching, so that the C++
+# files are regenerated.
+profile = os.environ.get('REDSHIFT_PROFILE') == '1'
+if '--profile' in sys.argv:
+    sys.argv.remove('--profile')
+    profile = True
 
 exts = [
     Extension('redshift.parser', ["redshift/parser.pyx"], language="c++",
@@ -54,6 +56,8 @@ exts = [
 
     Extension('redshift.sentence', ["redshift/sentence.pyx"], language="c++",
               include_dirs=includes),
+    Extension('redshift.corpus', ["redshift/corpus.pyx"], language="c++",
+              include_dirs=includes),
     Extension('redshift._parse_features', ["redshift/_parse_features.pyx"],
               language="c++", include_dirs=includes),
    Extension("index.hashes", ["index/hashes.pyx"], language="c++",
@@ -68,21 +72,16 @@ exts = [
               include_dirs=includes, language="c++"),
     Extension("redshift.pystate", ["redshift/pystate.pyx"], include_dirs=includes,
               language="c++"),
+    # Models choose between these in their config. See transition_system.pxd
+    Extension('redshift.arc_eager', ["redshift/arc_eager.pyx"],
+              language="c++", include_dirs=includes),
+    Extension('redshift.arc_hybrid', ["redshift/arc_hybrid.pyx"],
+              language="c++", include_dirs=includes),
 ]
 
-# The parser chooses one of these by a value in compile_time_options.pxi
-if c_options['transition_system'] == 'arc_eager':
-    exts.append(
-        Extension('redshift.arc_eager', ["redshift/arc_eager.pyx"],
-            language="c++", include_dirs=includes),
-    )
-elif c_options['transition_system'] == 'arc_hybrid':
-    exts.append(
-        Extension('redshift.arc_hybrid', ["redshift/arc_hybrid.pyx"],
-            language="c++", include_dirs=includes),
-    )
-else:
-    raise StandardError('Unknown transition system: %s' % c_options['transition_system'])
+if profile:
+    for ext in exts:
+        ext.cython_directives = {'profile': True}
 
 
 if sys.argv[1] == 'clean':
@@ -99,7 +98,7 @@ distutils.core.setup(
     license='Trial. Contact for full commercial license',
     name='redshift-parser',
     packages=['redshift', 'index'],
-    package_data={'redshift': ['*.pxd'], 'index': ['*.pxd', 'english.case', 'bllip-clusters']},
+    package_data={'redshift': ['*.pxd'], 'index': ['*.pxd', 'english.case', 'bllip-clusters', 'lexicon.bin']},
     author='Matthew Honnibal',
     author_email='honnibal@gmail.com',
     version='1.0',
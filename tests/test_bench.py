@@ -0,0 +1,53 @@
+"""
+Test the benchmark suite
+"""
+import os.path
+
+import pytest
+
+
+def local_path(filename):
+    return os.path.join(os.path.dirname(__file__), filename)
+
+
+@pytest.fixture
+def report():
+    import redshift.bench
+    return redshift.bench.run(local_path('train.10.conll'), n_tokens=20,
+                              lengths=(4, 9), beam_widths=(1, 2), n_iter=1,
+                              repeat=1)
+
+
+def test_run(report):
+    results = report['results']
+    assert results['train_iter_seconds'] > 0
+    assert results['model_load_seconds'] > 0
+    assert results['tag_len9_tokens_per_sec'] > 0
+    assert results['parse_beam2_len4_tokens_per_sec'] > 0
+    assert results['peak_rss_kb'] > 0
+
+
+def test_save_load(report, tmpdir):
+    import redshift.bench
+    loc = str(tmpdir.join('bench.json'))
+    redshift.bench.save(report, loc)
+    assert redshift.bench.load(loc) == report
+
+
+def test_synthesize():
+    import redshift.bench
+    tokens = redshift.bench.read_tokens(local_path('train.10.conll'))
+    sents = redshift.bench.synthesize(tokens, 5, 30, seed=3)
+    assert sents == redshift.bench.synthesize(tokens, 5, 30, seed=3)
+    assert [len(sent) for sent in sents] == [30] * 5
+
+
+def test_compare():
+    import redshift.bench
+    baseline = {'results': {'parse_per_sec': 100.0, 'load_seconds': 1.0,
+                            'peak_rss_kb': 1000}}
+    report = {'results': {'parse_per_sec': 80.0, 'load_seconds': 0.5,
+                          'peak_rss_kb': 1050}}
+    regressions = redshift.bench.compare(report, baseline, tolerance=0.1)
+    assert [r[0] for r in regressions] == ['parse_per_sec']
+    assert redshift.bench.compare(report, baseline, tolerance=0.3) == []
@@ -0,0 +1,56 @@
+"""
+Test compiled corpora
+"""
+import os.path
+
+import pytest
+
+
+def local_path(filename):
+    return os.path.join(os.path.dirname(__file__), filename)
+
+
+train_str = open(local_path('train.10.conll')).read()
+
+
+@pytest.fixture
+def corpus_loc(tmpdir):
+    import redshift.corpus
+    conll_loc = tmpdir.join('train.conll')
+    conll_loc.write(train_str + '\n1\tzzqxv\t_\tNN\tNN\t0.0|-|1|-\t0\tROOT\t_\t_\n')
+    loc = str(tmpdir.join('train.corpus'))
+    assert redshift.corpus.compile_corpus(str(conll_loc), loc) == 11
+    return loc
+
+
+def test_read(corpus_loc):
+    from redshift.sentence import Input
+    import redshift.corpus
+    assert redshift.corpus.is_compiled(corpus_loc)
+    corpus = redshift.corpus.Corpus(corpus_loc)
+    expected = list(Input.iter_conll(corpus_loc.replace('train.corpus', 'train.conll')))
+    assert len(corpus) == len(expected)
+    for sent, text_sent in zip(corpus, expected):
+        assert sent.to_conll() == text_sent.to_conll()
+        assert sent.edits == text_sent.edits
+    assert corpus[10].words[1] == 'zzqxv'
+    with pytest.raises(IndexError):
+        corpus[11]
+
+
+def test_not_compiled():
+    import redshift.corpus
+    assert not redshift.corpus.is_compiled(local_path('train.10.conll'))
+    with pytest.raises(ValueError):
+        redshift.corpus.Corpus(local_path('train.10.conll'))
+
+
+def test_train(corpus_loc, tmpdir):
+    import redshift.parser
+    conll_loc = corpus_loc.replace('train.corpus', 'train.conll')
+    models = []
+    for name, loc in [('text', conll_loc), ('compiled', corpus_loc)]:
+        model_dir = str(tmpdir.join(name))
+        redshift.parser.train_stream(loc, model_dir, n_iter=1, beam_width=2)
+        models.append(open(os.path.join(model_dir, 'model')).read())
+    assert models[0] == models[1]
@@ -0,0 +1,91 @@
+import struct
+
+import pytest
+
+from index.hashes import Index
+import index.hashes
+
+
+@pytest.fixture
+def idx():
+    return Index(['ROOT', 'NN', 'VB'])
+
+
+def test_lookup(idx):
+    assert idx.lookup('ROOT') == 1
+    assert idx.lookup('VB') == 3
+    assert idx.lookup('JJ') == 4
+    assert idx.lookup('JJ') == 4
+    assert idx.get_str(2) == 'NN'
+    assert idx.get_str(4) == 'JJ'
+    assert idx.get_str(5) == 'UNK'
+    assert idx.get_str(0) == 'UNK'
+
+
+def test_save_load(idx, tmpdir):
+    loc = str(tmpdir.join('idx'))
+    idx.lookup('JJ')
+    idx.save(loc)
+    loaded = Index([])
+    loaded.load(loc)
+    for code in range(1, 5):
+        assert loaded.get_str(code) == idx.get_str(code)
+    assert loaded.lookup('JJ') == 4
+    assert loaded.lookup('DT') == 5
+
+
+def test_load_text(tmpdir):
+    loc = tmpdir.join('idx')
+    loc.write('1\tROOT\n2\tNN\n3\tVB\n')
+    loaded = Index([])
+    loaded.load(str(loc))
+    assert loaded.get_str(3) == 'VB'
+    assert loaded.lookup('NN') == 2
+    # The next code follows the last one in the file
+    assert loaded.lookup('JJ') == 4
+
+
+def test_load_bad_version(idx, tmpdir):
+    loc = tmpdir.join('idx')
+    idx.save(str(loc))
+    data = loc.read('rb')
+    loc.write(data[:8] + struct.pack('=Q', 99) + data[16:], 'wb')
+    with pytest.raises(ValueError):
+        Index([]).load(str(loc))
+    loc.write(data[:-1], 'wb')
+    with pytest.raises(ValueError):
+        Index([]).load(str(loc))
+
+
+def test_load_conflict(tmpdir):
+    first = str(tmpdir.join('first'))
+    Index(['ROOT', 'NN', 'VB']).save(first)
+    # Extends the first, so the two agree
+    second = str(tmpdir.join('second'))
+    Index(['ROOT', 'NN', 'VB', 'JJ']).save(second)
+    other = str(tmpdir.join('other'))
+    Index(['ROOT', 'VB', 'NN']).save(other)
+    loaded = Index([])
+    loaded.load(first)
+    loaded.load(second)
+    assert loaded.get_str(4) == 'JJ'
+    with pytest.raises(ValueError):
+        loaded.load(other)
+    assert loaded.lookup('NN') == 2
+    assert loaded.get_str(3) == 'VB'
+    # Codes that only came from lookup can still be loaded over
+    fresh = Index(['ROOT', 'JJ'])
+    fresh.load(first)
+    assert fresh.get_str(2) == 'NN'
+
+
+def test_encode_label():
+    root = index.hashes.encode_label('ROOT')
+    assert index.hashes.encode_label('root') == root
+    assert index.hashes.encode_label('punct') == index.hashes.encode_label('P')
+    assert index.hashes.decode_label(root) == 'ROOT'
+    # The other spellings are aliases, so they don't get codes of their own
+    n_labels = index.hashes.get_nr_labels()
+    assert index.hashes.encode_label('Root') == root
+    assert index.hashes.encode_label('root') == root
+    assert index.hashes.get_nr_labels() == n_labels
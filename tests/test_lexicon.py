@@ -1,5 +1,74 @@
+import pytest
+
 import index.lexicon
 
 def test_vocab():
     addr = index.lexicon.lookup('Hello')
     assert index.lexicon.get_str(addr) == 'Hello'
+
+
+CLUSTERS = ['0110\tthe\t500', '1101\tHello\t20', '1\tNew-York\t3',
+            '00\t1984\t11', '10\tsaw\t9', '0111\tthe\t400']
+CASE = ['the 0.01 0.4', 'hello 0.2 0.1', 'new-york 0.0 0.9']
+
+
+@pytest.fixture
+def text_locs(tmpdir):
+    clusters = tmpdir.join('clusters')
+    clusters.write('\n'.join(CLUSTERS) + '\n')
+    case = tmpdir.join('case')
+    case.write('\n'.join(CASE) + '\n')
+    return str(clusters), str(case)
+
+
+@pytest.fixture
+def bin_loc(tmpdir, text_locs):
+    loc = str(tmpdir.join('lexicon.bin'))
+    assert index.lexicon.build(loc, *text_locs) == 5
+    return loc
+
+
+def test_bin_matches_text(bin_loc, text_locs):
+    mapped = index.lexicon.Lexicon(bin_loc)
+    loaded = index.lexicon.Lexicon(*text_locs)
+    for word in ['the', 'Hello', 'New-York', '1984', 'saw']:
+        assert word in mapped
+        assert mapped[word] == loaded[word]
+    assert 'unseen' not in mapped
+
+
+def test_bin_rejects_garbage(tmpdir):
+    loc = tmpdir.join('bad.bin')
+    loc.write('not a lexicon at all, just some text')
+    with pytest.raises(ValueError):
+        index.lexicon.Lexicon(str(loc))
+
+
+def test_oov_not_interned():
+    from redshift.sentence import Input
+    size = index.lexicon.lexicon_size()
+    for i in range(100):
+        sent = Input.from_untagged('zzqx%d saw zzqx%d' % (i, i))
+        assert sent.words[1:-1] == ['zzqx%d' % i, 'saw', 'zzqx%d' % i]
+        assert '\tzzqx%d\t' % i in sent.to_conll()
+    assert index.lexicon.lexicon_size() == size
+
+
+def test_oov_interned():
+    from redshift.sentence import Input
+    index.lexicon.set_intern_oov(True)
+    try:
+        size = index.lexicon.lexicon_size()
+        sent = Input.from_untagged('qqzx saw qqzx')
+        assert sent.words[1:-1] == ['qqzx', 'saw', 'qqzx']
+        assert index.lexicon.lexicon_size() > size
+    finally:
+        index.lexicon.set_intern_oov(False)
+
+
+def test_oov_strings():
+    from redshift.sentence import Input
+    words = ['zzqy%d' % i for i in range(50)] + ['saw', 'zzqy3']
+    sent = Input.from_untagged(' '.join(words))
+    assert sent.words[1:-1] == words
+    assert [line.split('\t')[1] for line in sent.to_conll().split('\n')] == words
@@ -42,3 +42,227 @@ def test_parse(parser, sentence):
     assert tokens[2].word == 'a'
     assert tokens[3].word == 'test'
     assert tokens[4].word == '.'
+
+
+def test_parse_batch(parser):
+    from redshift.sentence import Input
+    strings = ['This is a test .', 'A test', 'This is a much longer test , with a comma .']
+    one_by_one = [Input.from_untagged(s) for s in strings]
+    for sent in one_by_one:
+        parser.parse(sent)
+    batch = [Input.from_untagged(s) for s in strings]
+    parser.parse_batch(batch)
+    for sent1, sent2 in zip(one_by_one, batch):
+        assert sent1.to_conll() == sent2.to_conll()
+
+
+def test_parse_parallel(parser):
+    from redshift.sentence import Input
+    strings = ['This is a test .', 'A test', 'This is a much longer test , with a comma .'] * 3
+    one_by_one = [Input.from_untagged(s) for s in strings]
+    for sent in one_by_one:
+        parser.parse(sent)
+    parallel = [Input.from_untagged(s) for s in strings]
+    parser.parse_parallel(parallel, 2, chunk_size=2)
+    for sent1, sent2 in zip(one_by_one, parallel):
+        assert sent1.to_conll() == sent2.to_conll()
+
+
+def test_parse_long(parser):
+    # Long enough for the state's pages to be several levels deep
+    from redshift.sentence import Input
+    long_str = ' '.join(['This is a much longer test , with a comma .'] * 110)
+    strings = ['A test', long_str]
+    one_by_one = [Input.from_untagged(s) for s in strings]
+    for sent in one_by_one:
+        parser.parse(sent)
+        assert all(head < sent.length for head in sent.heads)
+    batch = [Input.from_untagged(s) for s in strings]
+    parser.parse_batch(batch)
+    for sent1, sent2 in zip(one_by_one, batch):
+        assert sent1.to_conll() == sent2.to_conll()
+
+
+def test_parse_threads(parser):
+    import threading
+    from redshift.sentence import Input
+    strings = ['This is a test .', 'A test', 'This is a much longer test , with a comma .'] * 4
+    one_by_one = [Input.from_untagged(s) for s in strings]
+    for sent in one_by_one:
+        parser.parse(sent)
+    threaded = [Input.from_untagged(s) for s in strings]
+    def parse_every_third(offset):
+        for sent in threaded[offset::3]:
+            parser.parse(sent)
+    threads = [threading.Thread(target=parse_every_third, args=(i,)) for i in range(3)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    for sent1, sent2 in zip(one_by_one, threaded):
+        assert sent1.to_conll() == sent2.to_conll()
+
+
+def test_counters(parser):
+    from redshift.sentence import Input
+    parser.reset_counters()
+    parser.set_sample_rate(2)
+    sents = [Input.from_untagged(s) for s in ['This is a test .', 'Another one',
+                                              'And a third sentence']]
+    parser.parse(sents[0])
+    parser.parse_batch(sents[1:])
+    counters = parser.get_counters()
+    assert counters['n_sents'] == 3
+    assert counters['n_tokens'] == sum(sent.length for sent in sents)
+    assert counters['n_steps'] > counters['n_sents']
+    assert 0 <= counters['memo_hits'] <= counters['memo_lookups']
+    assert counters['n_sampled'] == 1
+    assert counters['search_seconds'] > 0
+    parser.set_sample_rate(0)
+    parser.reset_counters()
+    assert parser.get_counters()['n_sents'] == 0
+
+
+def test_transition_systems(tmpdir):
+    import json
+    import redshift.parser
+    from redshift.sentence import Input
+    parsers = []
+    for system in [u'arc_eager', u'arc_hybrid']:
+        model_dir = str(tmpdir.join(system))
+        redshift.parser.train(train_str, model_dir, n_iter=2, beam_width=2,
+                              transition_system=system)
+        config = json.load(open(os.path.join(model_dir, 'config.json')))
+        assert config['transition_system'] == system
+        parsers.append(redshift.parser.Parser(model_dir))
+    for parser in parsers:
+        sent = Input.from_untagged('This is a test .')
+        parser.parse(sent)
+        for token in sent.tokens:
+            assert 0 <= token.head < sent.length
+    with pytest.raises(ValueError):
+        redshift.parser.train(train_str, str(tmpdir.join('x')), n_iter=1,
+                              transition_system=u'arc_standard')
+
+
+def test_label_sets(tmpdir):
+    import json
+    import redshift.parser
+    from redshift.sentence import Input
+    import index.hashes
+    first_dir = str(tmpdir.join('first'))
+    redshift.parser.train(train_str, first_dir, n_iter=2, beam_width=2,
+                          transition_system=u'arc_hybrid')
+    first = redshift.parser.Parser(first_dir)
+    sent = Input.from_untagged('This is a much longer test , with a comma .')
+    first.parse(sent)
+    # A second model, with labels the first doesn't have
+    second_dir = str(tmpdir.join('second'))
+    relabelled = train_str.replace('\tnsubj\t', '\tsubj\t').replace('\tdet\t', '\tdt\t')
+    redshift.parser.train(relabelled, second_dir, n_iter=2, beam_width=2,
+                          transition_system=u'arc_hybrid', use_break=True)
+    n_labels = index.hashes.get_nr_labels()
+    second = redshift.parser.Parser(second_dir)
+    subj = index.hashes.encode_label('subj')
+    for model_dir, has_subj in [(first_dir, False), (second_dir, True)]:
+        config = json.load(open(os.path.join(model_dir, 'config.json')))
+        assert (subj in config['left_labels'] + config['right_labels']) == has_subj
+    again = Input.from_untagged('This is a much longer test , with a comma .')
+    first.parse(again)
+    assert again.to_conll() == sent.to_conll()
+    # A model trained in another process can give the labels other codes
+    strings = [index.hashes.decode_label(code) for code in range(1, n_labels)]
+    index.hashes.Index(strings[:4] + strings[4:][::-1]).save(
+        os.path.join(second_dir, 'labels'))
+    with pytest.raises(ValueError):
+        redshift.parser.Parser(second_dir)
+    # The failed load left the labels alone
+    again = Input.from_untagged('This is a much longer test , with a comma .')
+    first.parse(again)
+    assert again.to_conll() == sent.to_conll()
+
+
+def test_train_stream(tmpdir):
+    import redshift.parser
+    train_loc = tmpdir.join('train.conll')
+    train_loc.write(train_str)
+    models = []
+    for name in ['a', 'b']:
+        model_dir = str(tmpdir.join(name))
+        redshift.parser.train_stream(str(train_loc), model_dir, n_iter=3,
+                                     beam_width=2, seed=7, shuffle_buffer=4)
+        models.append(open(os.path.join(model_dir, 'model')).read())
+    assert models[0] == models[1]
+
+
+def test_train_mixed(tmpdir):
+    import redshift.parser
+    from redshift.sentence import Input
+    train_loc = tmpdir.join('train.conll')
+    train_loc.write(train_str)
+    models = []
+    for name in ['a', 'b']:
+        model_dir = str(tmpdir.join(name))
+        redshift.parser.train_stream(str(train_loc), model_dir, n_iter=3,
+                                     beam_width=2, seed=7, n_workers=2)
+        models.append(open(os.path.join(model_dir, 'model')).read())
+    assert models[0] == models[1]
+    parser = redshift.parser.Parser(model_dir)
+    sent = Input.from_untagged('The cat sat .')
+    parser.parse(sent)
+
+
+def test_mix_updates():
+    # Mixing the workers' updates gives the mean of the workers' weights
+    import random
+    from thinc.learner import LinearModel
+    import redshift.parser
+    rng = random.Random(0)
+    def get_updates(n):
+        return [dict((rng.randrange(4), {(0, rng.randrange(1, 20)): rng.choice([-1.0, 1.0])})
+                     for _ in range(3)) for _ in range(n)]
+    start = get_updates(10)
+    shards = [get_updates(8), get_updates(5)]
+    models = []
+    for updates in [[]] + shards:
+        model = LinearModel(4, 1)
+        for update in start + updates:
+            model.update(update)
+        models.append(model)
+    mixed, first, second = models
+    redshift.parser._mix_updates(mixed, shards)
+    for feat in range(1, 20):
+        assert mixed([feat]) == [(a + b) / 2 for a, b in zip(first([feat]), second([feat]))]
+
+
+def test_train_metrics(tmpdir):
+    import json
+    import redshift.parser
+    metrics = []
+    redshift.parser.train(train_str, str(tmpdir.join('model')), n_iter=2,
+                          beam_width=2, on_iter=metrics.append)
+    assert [m['iter'] for m in metrics] == [0, 1]
+    for m in metrics:
+        assert m['sents'] == 10
+        assert m['tokens'] > m['sents']
+        assert 0 <= m['early_update_rate'] <= 1
+        assert m['phases']['fill_costs'] <= m['phases']['advance_beam'] <= m['seconds']
+        assert m['model_feats'] > 0
+        assert 0 <= m['memo_hit_rate'] <= 1
+        json.dumps(m)
+
+
+def test_train_trials(tmpdir):
+    import redshift.parser
+    train_loc = tmpdir.join('train.conll')
+    train_loc.write(train_str)
+    out_dir = str(tmpdir.join('trials'))
+    trials = [{'seed': 1, 'n_iter': 2, 'beam_width': 2},
+              {'name': 'other', 'seed': 2, 'n_iter': 2, 'beam_width': 2}]
+    report = redshift.parser.train_trials(str(train_loc), out_dir, trials,
+                                          dev_loc=str(train_loc), n_workers=2)
+    assert [r['name'] for r in report] == ['trial0', 'other']
+    for result in report:
+        assert os.path.exists(os.path.join(out_dir, result['name'], 'model'))
+        assert 0 <= result['las'] <= result['uas'] <= 100
+    assert os.path.exists(os.path.join(out_dir, 'report.json'))
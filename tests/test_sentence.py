@@ -0,0 +1,50 @@
+"""
+Test reading sentences
+"""
+import os.path
+
+import pytest
+
+
+def local_path(filename):
+    return os.path.join(os.path.dirname(__file__), filename)
+
+
+train_str = open(local_path('train.10.conll')).read()
+
+
+def _fields(sent):
+    return (sent.words, sent.tags, sent.heads, sent.labels, sent.edits,
+            sent.to_conll())
+
+
+def test_iter_conll_str():
+    from redshift.sentence import Input
+    expected = [_fields(Input.from_conll(s)) for s in
+                train_str.strip().split('\n\n') if s.strip()]
+    assert [_fields(s) for s in Input.iter_conll_str(train_str)] == expected
+
+
+def test_iter_conll_disfluencies():
+    from redshift.sentence import Input
+    conll_str = ('1\tuh\t_\tUH\tUH\t0.0|F|0|-\t3\tdiscourse\t_\t_\n'
+                 '2\tI\t_\tPRP\tPRP\t0.0|-|1|-\t3\tnsubj\t_\t_\n'
+                 '3\twant\t_\tVBP\tVBP\t0.1|-|0|-\t0\tROOT\t_\t_\n')
+    sent, = Input.iter_conll_str('\n\n' + conll_str + '\n\n\n')
+    assert _fields(sent) == _fields(Input.from_conll(conll_str.strip()))
+    assert sent.labels[1:3] == ['fillerF', 'erased']
+    assert sent.edits[1:3] == [True, True]
+
+
+def test_iter_conll(tmpdir):
+    from redshift.sentence import Input
+    loc = tmpdir.join('train.conll')
+    loc.write(train_str)
+    expected = [_fields(s) for s in Input.iter_conll_str(train_str)]
+    assert [_fields(s) for s in Input.iter_conll(str(loc))] == expected
+
+
+def test_iter_conll_bad_line():
+    from redshift.sentence import Input
+    with pytest.raises(ValueError):
+        list(Input.iter_conll_str('1\tuh\t_\tUH\n'))
@@ -13,9 +13,7 @@ model_dir = local_path('model')
 train_str = open(local_path('train.10.conll')).read()
 
 
-@pytest.fixture
-def train_dir():
-    import redshift.tagger
+def get_train_pos():
     sent_strs = []
     for sent_str in train_str.strip().split('\n\n'):
         sent = []
@@ -23,8 +21,13 @@ def train_dir():
             fields = tok_str.split()
             sent.append('%s/%s' % (fields[1], fields[3]))
         sent_strs.append(' '.join(sent))
-    train_pos = '\n'.join(sent_strs)
-    redshift.tagger.train(train_pos, model_dir)
+    return '\n'.join(sent_strs)
+
+
+@pytest.fixture
+def train_dir():
+    import redshift.tagger
+    redshift.tagger.train(get_train_pos(), model_dir)
     return model_dir
 
 
@@ -61,3 +64,53 @@ def test_tag(tagger, sentence):
     assert tokens[2].word == 'a'
     assert tokens[3].word == 'test'
     assert tokens[4].word == '.'
+
+
+def test_beam_top_k():
+    from redshift._tagger_beam import Beam
+    import random
+    rng = random.Random(0)
+    nr_class = 40
+    width = 5
+    beam = Beam(nr_class, width)
+    # Few distinct values, so there are lots of ties
+    scores = [float(rng.randint(0, 10)) for _ in range(nr_class)]
+    assert beam.fill_from_list([scores]) == max(scores)
+    candidates = sorted(((score, (0, clas)) for clas, score in enumerate(scores)),
+                        reverse=True)
+    assert [beam.pop() for _ in range(width)] == [c for s, c in candidates[:width]]
+    with pytest.raises(StopIteration):
+        beam.pop()
+
+
+def test_tagdict(tmpdir):
+    import redshift.tagger
+    from redshift.sentence import Input
+    tagdict_dir = str(tmpdir.join('model'))
+    tagger = redshift.tagger.train(get_train_pos(), tagdict_dir, tagdict_freq=3)
+    tagdict = dict(line.split() for line in open(os.path.join(tagdict_dir, 'tagdict')))
+    assert tagdict
+    words = sorted(tagdict)[:5]
+    sentence = Input.from_pos(' '.join('%s/??' % word for word in words))
+    tagger.tag(sentence)
+    assert [token.tag for token in sentence.tokens] == [tagdict[w] for w in words]
+
+
+def test_tag_lattice(tmpdir):
+    import redshift.tagger
+    from redshift.sentence import Input
+    lattice_dir = str(tmpdir.join('model'))
+    train_pos = get_train_pos()
+    tagger = redshift.tagger.train(train_pos, lattice_dir, tagdict_freq=0,
+                                   lattice_freq=2)
+    word_tags = {}
+    for line in open(os.path.join(lattice_dir, 'taglattice')):
+        kind, word, tags = line.rstrip('\n').split('\t')
+        if kind == 'word':
+            word_tags[word] = tags.split()
+    assert word_tags
+    sentence = Input.from_pos(train_pos.split('\n')[0])
+    tagger.tag(sentence)
+    for token in sentence.tokens:
+        if token.word in word_tags:
+            assert token.tag in word_tags[token.word]